@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import GenericUser, Genre, Movie, Rating, WatchedMovie, Comment, FriendRequest, Actor, Director, Keyword
+from .models import GenericUser, Genre, Movie, Rating, WatchedMovie, Comment, FriendRequest, Actor, Director, Keyword, UserRecommendation, UserRecommendationState, RecommendationEvent, Friendship
 
 # Register your models here.
 admin.site.register(GenericUser)
@@ -11,5 +11,8 @@ admin.site.register(Rating)
 admin.site.register(WatchedMovie)
 admin.site.register(Comment)
 admin.site.register(FriendRequest)
+admin.site.register(Friendship)
 admin.site.register(Keyword)
-
+admin.site.register(UserRecommendation)
+admin.site.register(UserRecommendationState)
+admin.site.register(RecommendationEvent)
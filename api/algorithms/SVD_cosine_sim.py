@@ -1,40 +1,72 @@
 from ..models import Movie, Rating
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from scipy import sparse
 from sklearn.decomposition import TruncatedSVD
 from django.contrib.auth import get_user_model
+from .registry import registry
+from .factors import SVDFactors
 
 # This file contains the code for the SVD + Cosine Similarity recommendation model
+# The factors are fitted offline on a sparse user-item matrix (see the build_svd_factors
+# command) and saved to svd_factors.npz (see factors.py). At request time a recommendation
+# is a single dot product against the normalised item factors plus a partial sort.
 
 User = get_user_model()
 
+
 def get_user_item_matrix():
-    # Fetch all user ratings from the database
-    ratings = Rating.objects.all().values_list('user_id', 'movie_id', 'rating')
-    
-    # Convert to DataFrame
-    ratings_df = pd.DataFrame(ratings, columns=['user_id', 'movie_id', 'rating'])
-    
-    # Pivot to create the user-item matrix
-    user_item_matrix = ratings_df.pivot(index='user_id', columns='movie_id', values='rating').fillna(0)
-    
-    # Generate mappings for user IDs to matrix indices and vice versa
-    user_ids = list(user_item_matrix.index)
-    movie_ids = list(user_item_matrix.columns)
-    
+    # Fetch all user ratings from the database as flat arrays
+    ratings = np.array(Rating.objects.values_list('user_id', 'movie_id', 'rating'), dtype=np.float64).reshape(-1, 3)
+
+    # Map user and movie IDs to matrix rows and columns
+    user_ids, user_rows = np.unique(ratings[:, 0].astype(np.int64), return_inverse=True)
+    movie_ids, movie_columns = np.unique(ratings[:, 1].astype(np.int64), return_inverse=True)
+
+    # Sparse user-item matrix; unrated cells are implicit zeros
+    user_item_matrix = sparse.csr_matrix(
+        (ratings[:, 2].astype(np.float32), (user_rows, movie_columns)),
+        shape=(len(user_ids), len(movie_ids)),
+    )
     return user_item_matrix, user_ids, movie_ids
 
 
-def get_user_factors_items_factors():
+def get_user_factors_items_factors(n_components=20):
     user_item_matrix, user_ids, movie_ids = get_user_item_matrix()
-    user_item_matrix_values = user_item_matrix.values  # Convert DataFrame to numpy array for SVD
-    
-    svd = TruncatedSVD(n_components=20, random_state=42)
-    user_factors = svd.fit_transform(user_item_matrix_values)
+
+    svd = TruncatedSVD(n_components=n_components, random_state=42)
+    user_factors = svd.fit_transform(user_item_matrix)
     item_factors = svd.components_.T  # Transpose item factors for alignment
-    
-    return user_factors, item_factors, user_ids, movie_ids
 
+    return SVDFactors(user_ids, movie_ids, user_factors.astype(np.float32), item_factors.astype(np.float32))
+
+
+def factor_movie_ids(factors, user_id, ratings, top_n=10, exclude=()):
+    # Returns up to top_n Movie ids ranked by cosine similarity, best first
+    # ratings is the user's [(movie_id, rating)], as the request path reads them
+    user_vector = factors.user_vector(user_id, ratings)
+    norm = np.linalg.norm(user_vector)
+    if norm == 0 or top_n <= 0:
+        return []
+    similarity_scores = factors.normalized_item_factors @ (user_vector / norm)
+
+    # Exclude movies that have already been rated (and any other excluded ids)
+    for movie_id in [movie_id for movie_id, _ in ratings] + list(exclude):
+        column = factors.movie_index.get(movie_id)
+        if column is not None:
+            similarity_scores[column] = -np.inf
+
+    # Partial sort of the top N similarity scores
+    top_n = min(top_n, len(similarity_scores))
+    top_columns = np.argpartition(-similarity_scores, top_n - 1)[:top_n]
+    top_columns = top_columns[np.argsort(-similarity_scores[top_columns], kind='stable')]
+    top_columns = top_columns[np.isfinite(similarity_scores[top_columns])]
+
+    return factors.movie_ids[top_columns].tolist()
+
+
+def recommend_movie_ids(user, top_n=10, exclude=()):
+    ratings = list(Rating.objects.filter(user=user).values_list('movie_id', 'rating'))
+    return factor_movie_ids(registry.get('svd_factors'), user.id, ratings, top_n, exclude)
 
 
 def recommend_movies(username, top_n=10):
@@ -42,38 +74,15 @@ def recommend_movies(username, top_n=10):
         user = User.objects.get(username=username)  # Fetch user by username
     except User.DoesNotExist:
         return []
-    
-    # Check if the user has rated at least 10 movies
+
+    # Check if the user has rated at least 5 movies
     if Rating.objects.filter(user=user).count() < 5:
         # Not enough data to generate recommendations so it returns the first 10 movies in the database
         movies = Movie.objects.all()[:10]
         return list(movies.values_list('title', flat=True))
-    
-    user_factors, item_factors, user_ids, movie_ids = get_user_factors_items_factors()
-    
-    user_index = user_ids.index(user.id)
-    user_vector = user_factors[user_index].reshape(1, -1)  # User vector for cosine similarity
-    
-    similarity_scores = cosine_similarity(user_vector, item_factors)[0]
-    
-    # Fetch rated movie IDs by the user
-    rated_movie_ids = Rating.objects.filter(user=user).values_list('movie_id', flat=True)
-    
-    # Exclude movies that have already been rated by filtering out their indices
-    # Only consider movie indices that are not in the user's rated movie IDs
-    movie_indices_filtered = [index for index, movie_id in enumerate(movie_ids) if movie_id not in rated_movie_ids]
-    
-    # Adjust similarity scores to only include indices of non-rated movies
-    similarity_scores_filtered = similarity_scores[movie_indices_filtered]
-    movie_ids_filtered = [movie_ids[index] for index in movie_indices_filtered]
-    
-    # Get top N similar item indices from the filtered list based on similarity scores
-    top_item_indices = similarity_scores_filtered.argsort()[-top_n:][::-1]
-    
-    # Map filtered indices back to movie IDs
-    recommended_movie_ids = [movie_ids_filtered[index] for index in top_item_indices]
-    
+
+    recommended_movie_ids = recommend_movie_ids(user, top_n)
     recommended_movies = Movie.objects.filter(id__in=recommended_movie_ids).values_list('title', flat=True)
-    
+
     # Return the list of movies which is currently set to 10
-    return list(recommended_movies)
\ No newline at end of file
+    return list(recommended_movies)
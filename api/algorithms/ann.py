@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+from scipy import sparse
+
+# This file holds the inverted-file (IVF) nearest-neighbour index used by similarity.py.
+# Unit-length embeddings are clustered with spherical k-means and stored grouped by
+# cluster; a query scores the centroids, then only the movies in its N_PROBE closest clusters.
+
+TOP_K = 10
+KMEANS_ITERATIONS = 20
+N_PROBE = 8
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def kmeans(embeddings, n_clusters, iterations=KMEANS_ITERATIONS, seed=42):
+    # Spherical k-means: centroids are kept unit length so assignment is a dot product
+    rng = np.random.default_rng(seed)
+    centroids = embeddings[rng.choice(len(embeddings), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(embeddings @ centroids.T, axis=1)
+        # Sum the members of every cluster at once with a sparse one-hot matrix;
+        # empty clusters keep their previous centroid
+        members = sparse.csr_matrix(
+            (np.ones(len(assignments), dtype=np.float32), (assignments, np.arange(len(assignments)))),
+            shape=(n_clusters, len(embeddings)),
+        )
+        sums = members @ embeddings
+        occupied = np.asarray(members.sum(axis=1)).ravel() > 0
+        centroids[occupied] = sums[occupied]
+        centroids = normalize_rows(centroids)
+    return centroids.astype(np.float32), np.argmax(embeddings @ centroids.T, axis=1)
+
+
+class SimilarityIndex:
+    def __init__(self, movie_ids, embeddings, centroids, assignments, sources=None):
+        # Movies are stored grouped by cluster so each cluster is one contiguous slice
+        order = np.argsort(assignments, kind='stable')
+        self.movie_ids = np.asarray(movie_ids)[order]
+        self.embeddings = embeddings[order]
+        self.centroids = centroids
+        self.assignments = assignments[order]
+        self.offsets = np.searchsorted(self.assignments, np.arange(len(centroids) + 1))
+        self.movie_index = {movie_id: row for row, movie_id in enumerate(self.movie_ids.tolist())}
+        # Checksums of the artifacts the embeddings were computed with (see similarity.py)
+        self.sources = sources
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def save(self, path):
+        np.savez(path, movie_ids=self.movie_ids, embeddings=self.embeddings,
+                 centroids=self.centroids, assignments=self.assignments, sources=json.dumps(self.sources))
+
+    def search(self, vector, k=TOP_K, exclude=(), n_probe=N_PROBE):
+        # Returns up to k (movie_id, similarity) pairs, most similar first
+        clusters = np.argsort(-(self.centroids @ vector))[:n_probe]
+        rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in clusters])
+        scores = self.embeddings[rows] @ vector
+        excluded = np.isin(self.movie_ids[rows], list(exclude))
+        rows, scores = rows[~excluded], scores[~excluded]
+
+        if len(rows) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return list(zip(self.movie_ids[rows[order]].tolist(), scores[order].tolist()))
+
+    def neighbours(self, movie_id, k=TOP_K):
+        row = self.movie_index[movie_id]
+        return self.search(self.embeddings[row], k, exclude=(movie_id,))
+
+
+def load_similarity_index(path):
+    data = np.load(path)
+    # Indexes saved before the sources were recorded have none
+    sources = json.loads(data['sources'].item()) if 'sources' in data.files else None
+    return SimilarityIndex(data['movie_ids'], data['embeddings'], data['centroids'], data['assignments'], sources)
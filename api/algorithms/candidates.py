@@ -0,0 +1,96 @@
+import itertools
+from collections import defaultdict
+from api.models import Movie, Rating, GenericUser, WatchedMovie
+from api.algorithms.registry import registry
+from api.algorithms.features import NEUTRAL_RATING
+from api.algorithms.SVD_cosine_sim import factor_movie_ids
+from api.algorithms.friends import friend_movie_ids
+
+# This file is the first stage of the recommendation pipeline (see ranking.py): it
+# retrieves a few hundred candidate movies per user from cheap sources, which the
+# XGBoost model then re-ranks. The sources, in order:
+#
+#   factors   nearest movies to the user in the SVD factor space (SVD_cosine_sim.py)
+#   similar   the stored Movie.similar_movies of the user's most recently liked movies
+#   friends   movies the user's friends and friends-of-friends liked (friends.py)
+#   popular   the most popular movies, which fill the list up to CANDIDATES
+#
+# Each source contributes at most its quota; movies the user rated, watched or put on
+# their watchlist are never candidates. Everything works on Movie ids (pks). Without
+# svd_factors.npz (see build_svd_factors) the factors source is skipped.
+
+CANDIDATES = 500
+
+# Most candidates taken from each source before the popular movies fill the rest
+SOURCE_QUOTAS = {'factors': 200, 'similar': 150, 'friends': 50}
+
+# The user's latest liked movies whose neighbours are candidates
+SIMILAR_SEEDS = 50
+LIKED_RATING = 4.0
+
+
+def user_histories(user_ids):
+    # ({user_id: [(movie_id, rating)] latest first}, {user_id: movie ids rated, watched or watchlisted})
+    ratings = {user_id: [] for user_id in user_ids}
+    rows = Rating.objects.filter(user_id__in=user_ids).order_by('-timestamp', '-id').values_list('user_id', 'movie_id', 'rating')
+    for user_id, movie_id, rating in rows:
+        ratings[user_id].append((movie_id, rating))
+
+    seen = {user_id: {movie_id for movie_id, _ in rated} for user_id, rated in ratings.items()}
+    for user_id, movie_id in itertools.chain(
+        WatchedMovie.objects.filter(user_id__in=user_ids).values_list('user_id', 'movie_id'),
+        GenericUser.watchlist.through.objects.filter(genericuser_id__in=user_ids).values_list('genericuser_id', 'movie_id'),
+    ):
+        seen[user_id].add(movie_id)
+    return ratings, seen
+
+
+def similar_candidates(ratings, seen, top_n):
+    # {user_id: [movie_id, ...]}: neighbours of the liked movies, each weighted by how much
+    # the user liked the movie and by its rank among that movie's neighbours
+    seeds = {
+        user_id: [(movie_id, rating) for movie_id, rating in rated if rating >= LIKED_RATING][:SIMILAR_SEEDS]
+        for user_id, rated in ratings.items()
+    }
+    neighbours = defaultdict(list)
+    seed_ids = {movie_id for liked in seeds.values() for movie_id, _ in liked}
+    # Insertion order is the neighbour rank (see build_similar_movies)
+    rows = Movie.similar_movies.through.objects.filter(from_movie_id__in=seed_ids).order_by('id')
+    for movie_id, neighbour in rows.values_list('from_movie_id', 'to_movie_id'):
+        neighbours[movie_id].append(neighbour)
+
+    candidates = {}
+    for user_id, liked in seeds.items():
+        scores = defaultdict(float)
+        for movie_id, rating in liked:
+            for rank, neighbour in enumerate(neighbours[movie_id]):
+                if neighbour not in seen[user_id]:
+                    scores[neighbour] += (rating - NEUTRAL_RATING) / (rank + 1)
+        candidates[user_id] = sorted(scores, key=lambda movie_id: (-scores[movie_id], movie_id))[:top_n]
+    return candidates
+
+
+def popular_movie_ids(count):
+    return list(Movie.objects.filter(popularity_score__isnull=False).order_by('-popularity_score', 'id').values_list('id', flat=True)[:count])
+
+
+def generate_candidates(user_ids, count=CANDIDATES):
+    # Returns {user_id: [movie_id, ...]} with up to count Movie ids per user, by source
+    user_ids = list(user_ids)
+    ratings, seen = user_histories(user_ids)
+    factors = registry.get_optional('svd_factors')
+    similar = similar_candidates(ratings, seen, SOURCE_QUOTAS['similar'])
+    # One list is enough to fill up every user once their own seen movies are skipped
+    popular = popular_movie_ids(count + max((len(movies) for movies in seen.values()), default=0))
+
+    candidates = {}
+    for user_id in user_ids:
+        sources = (
+            factor_movie_ids(factors, user_id, ratings[user_id], SOURCE_QUOTAS['factors'], seen[user_id]) if factors is not None else (),
+            similar[user_id],
+            friend_movie_ids(user_id, SOURCE_QUOTAS['friends']),
+            popular,
+        )
+        chosen = dict.fromkeys(movie_id for movie_id in itertools.chain(*sources) if movie_id not in seen[user_id])
+        candidates[user_id] = list(itertools.islice(chosen, count))
+    return candidates
@@ -0,0 +1,188 @@
+import os
+import tempfile
+import zipfile
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from django.db.models import Max
+
+from api.models import Movie, Rating
+
+# This file exports the training datasets (see the export_datasets command) as
+# typed, columnar .npz files in one streaming pass over the database:
+#
+#   movies.npz   one row per movie: ids, title, overview, runtime, adult,
+#                release_date, rating totals and the genre, director, actor and
+#                keyword names. Covers what build_datasets, build_w2v_dataset and
+#                build_xgboost_data used to write as separate CSVs.
+#   ratings.npz  one row per rating: user_id, movie (pk), movie_id, rating and a
+#                unix timestamp.
+#
+# Rows are read with values_list().iterator() in chunks, never as model instances.
+# Strings are stored like Arrow does: the UTF-8 bytes of every value back to back
+# in `<name>__data` and their end offsets in `<name>__offsets`; a list column
+# adds `<name>__lists`, the end offset of each row's values. Rating columns are
+# filled in place in memory-mapped .npy files and zipped from disk, so memory use
+# does not grow with the number of ratings.
+
+CHUNK_SIZE = 50000
+
+MOVIE_RELATIONS = {
+    'genres': (Movie.genres.through, 'genre__name'),
+    'directors': (Movie.directors.through, 'director__name'),
+    'actors': (Movie.actors.through, 'actor__name'),
+    'keywords': (Movie.keywords.through, 'keyword__name'),
+}
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def encode_strings(values):
+    encoded = [(value or '').encode('utf-8') for value in values]
+    offsets = np.cumsum([len(value) for value in encoded], dtype=np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets):
+    data = data.tobytes()
+    starts = np.concatenate([[0], offsets[:-1]]).tolist()
+    return [data[start:end].decode('utf-8') for start, end in zip(starts, offsets.tolist())]
+
+
+def string_column(name, values):
+    data, offsets = encode_strings(values)
+    return {f'{name}__data': data, f'{name}__offsets': offsets}
+
+
+def list_column(name, lists):
+    columns = string_column(name, [value for values in lists for value in values])
+    columns[f'{name}__lists'] = np.cumsum([len(values) for values in lists], dtype=np.int64)
+    return columns
+
+
+def load_columns(path):
+    # {column: numpy array or list of str / list of lists of str}
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in data.files}
+    columns = {}
+    for key in list(arrays):
+        name, _, part = key.partition('__')
+        if not part:
+            columns[name] = arrays[key]
+        elif part == 'offsets':
+            values = decode_strings(arrays[f'{name}__data'], arrays[key])
+            lists = arrays.get(f'{name}__lists')
+            if lists is not None:
+                starts = np.concatenate([[0], lists[:-1]]).tolist()
+                values = [values[start:end] for start, end in zip(starts, lists.tolist())]
+            columns[name] = values
+    return columns
+
+
+def movie_relation_names(through, field, chunk_size=CHUNK_SIZE):
+    # {Movie pk: [names]} in insertion order, streamed from the through table
+    names = {}
+    rows = through.objects.order_by('movie_id', 'id').values_list('movie_id', field).iterator(chunk_size=chunk_size)
+    for movie_pk, name in rows:
+        names.setdefault(movie_pk, []).append(name)
+    return names
+
+
+def export_movies(path, chunk_size=CHUNK_SIZE):
+    relations = {name: movie_relation_names(through, field, chunk_size) for name, (through, field) in MOVIE_RELATIONS.items()}
+    fields = ('id', 'movie_id', 'tmdb_id', 'title', 'overview', 'runtime', 'adult', 'release_date',
+              'avg_rating', 'rating_count', 'popularity_score')
+    rows = list(Movie.objects.order_by('id').values_list(*fields).iterator(chunk_size=chunk_size))
+    values = dict(zip(fields, zip(*rows))) if rows else {field: () for field in fields}
+
+    def numbers(field, dtype, missing):
+        return np.array([missing if value is None else value for value in values[field]], dtype=dtype)
+
+    columns = {
+        'id': numbers('id', np.int64, -1),
+        'movie_id': numbers('movie_id', np.int64, -1),
+        'tmdb_id': numbers('tmdb_id', np.int64, -1),
+        'runtime': numbers('runtime', np.float32, np.nan),
+        'adult': numbers('adult', bool, False),
+        'release_date': np.array([value or 'NaT' for value in values['release_date']], dtype='datetime64[D]'),
+        'avg_rating': numbers('avg_rating', np.float32, np.nan),
+        'rating_count': numbers('rating_count', np.int32, 0),
+        'popularity_score': numbers('popularity_score', np.float32, np.nan),
+        **string_column('title', values['title']),
+        **string_column('overview', values['overview']),
+    }
+    for name, names in relations.items():
+        columns.update(list_column(name, [names.get(pk, []) for pk in values['id']]))
+    np.savez(path, **columns)
+    return len(rows)
+
+
+RATING_COLUMNS = {
+    'user_id': np.int64,
+    'movie': np.int64,
+    'movie_id': np.int64,
+    'rating': np.float32,
+    'timestamp': np.int64,
+}
+
+
+def export_ratings(path, chunk_size=CHUNK_SIZE):
+    # Ratings up to the current highest id, streamed into memory-mapped columns
+    last_id = Rating.objects.aggregate(last=Max('id'))['last'] or 0
+    ratings = Rating.objects.filter(id__lte=last_id)
+    count = ratings.count()
+
+    # MovieLens movie_id of every Movie pk, as a dense lookup array
+    movie_pks, movie_ids = zip(*Movie.objects.values_list('id', 'movie_id')) if Movie.objects.exists() else ((0,), (None,))
+    movie_id_lookup = np.full(max(movie_pks) + 1, -1, dtype=np.int64)
+    movie_id_lookup[list(movie_pks)] = [-1 if movie_id is None else movie_id for movie_id in movie_ids]
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryDirectory(dir=directory) as scratch:
+        files = {name: os.path.join(scratch, f'{name}.npy') for name in RATING_COLUMNS}
+        columns = {name: np.lib.format.open_memmap(files[name], mode='w+', dtype=dtype, shape=(count,)) for name, dtype in RATING_COLUMNS.items()}
+
+        written = 0
+        rows = ratings.order_by('id').values_list('user_id', 'movie_id', 'rating', 'timestamp').iterator(chunk_size=chunk_size)
+        for chunk in chunks(rows, chunk_size):
+            chunk = chunk[:count - written]
+            end = written + len(chunk)
+            user_ids, movies, values, timestamps = zip(*chunk)
+            columns['user_id'][written:end] = user_ids
+            columns['movie'][written:end] = movies
+            columns['movie_id'][written:end] = movie_id_lookup[np.array(movies, dtype=np.int64)]
+            columns['rating'][written:end] = values
+            columns['timestamp'][written:end] = [int(timestamp.timestamp()) for timestamp in timestamps]
+            written = end
+
+        for name, column in columns.items():
+            column.flush()
+            if written < count:
+                # Ratings were deleted during the export
+                np.save(files[name], np.array(column[:written]))
+        del columns
+
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, file in files.items():
+                archive.write(file, f'{name}.npy')
+    return written
+
+
+def read_movie_dataset(path):
+    # The movie columns the XGBoost feature builder reads (see features.read_movie_csv),
+    # with genres comma-separated and director and keyword names space-separated
+    columns = load_columns(path)
+    movie_df = pd.DataFrame({
+        'movie_id': columns['movie_id'],
+        'runtime': columns['runtime'],
+        'adult': columns['adult'].astype(int),
+        'genres': [', '.join(names) for names in columns['genres']],
+        'directors': [' '.join(names) for names in columns['directors']],
+        'keywords': [' '.join(names) for names in columns['keywords']],
+    })
+    return movie_df[movie_df['movie_id'] >= 0].reset_index(drop=True)
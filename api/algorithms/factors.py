@@ -0,0 +1,44 @@
+import numpy as np
+
+# This file holds the fitted SVD user and item factors used by SVD_cosine_sim.py
+
+
+class SVDFactors:
+    def __init__(self, user_ids, movie_ids, user_factors, item_factors):
+        self.user_ids = user_ids
+        self.movie_ids = movie_ids
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+
+        # Unit-length item factors so cosine similarity is a plain dot product
+        norms = np.linalg.norm(item_factors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.normalized_item_factors = item_factors / norms
+
+        self.user_index = {user_id: row for row, user_id in enumerate(user_ids.tolist())}
+        self.movie_index = {movie_id: column for column, movie_id in enumerate(movie_ids.tolist())}
+
+    def save(self, path):
+        np.savez(path, user_ids=self.user_ids, movie_ids=self.movie_ids,
+                 user_factors=self.user_factors, item_factors=self.item_factors)
+
+    def fold_in(self, ratings):
+        # Project a user who was not part of the fit into the factor space:
+        # the same X @ V transform TruncatedSVD applies to the training rows
+        vector = np.zeros(self.item_factors.shape[1], dtype=self.item_factors.dtype)
+        for movie_id, rating in ratings:
+            column = self.movie_index.get(movie_id)
+            if column is not None:
+                vector += rating * self.item_factors[column]
+        return vector
+
+    def user_vector(self, user_id, ratings):
+        row = self.user_index.get(user_id)
+        if row is not None:
+            return self.user_factors[row]
+        return self.fold_in(ratings)
+
+
+def load_svd_factors(path):
+    data = np.load(path)
+    return SVDFactors(data['user_ids'], data['movie_ids'], data['user_factors'], data['item_factors'])
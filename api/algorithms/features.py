@@ -0,0 +1,256 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# This file builds the item feature matrices used by the XGBoost recommenders.
+# Every feature except the user columns depends only on the movie, so the matrix is
+# built once offline (see the build_feature_matrix command) and saved as a float32
+# array. At request time only the user columns have to be filled in before scoring.
+#
+# Models trained with train_recommender describe the user by profile features
+# computed from their ratings (see UserProfiles and api/algorithms/profiles.py)
+# instead of a raw user_id: their mean rating and number of ratings, their genre
+# affinity (one user_<genre> column per genre, and its dot product with the movie's
+# genres) and the cosine similarity of the movie's director and keyword vectors to
+# the user's taste centroids. The shipped models still use user_id; the columns a
+# matrix fills in follow the feature names it was built with.
+
+W2V_SIZE = 50
+
+PROFILE_FEATURES = ['user_mean_rating', 'user_rating_count', 'genre_affinity', 'director_similarity', 'keyword_similarity']
+
+# Ratings above this pull a user's affinity and centroids towards the movie, ratings below push them away
+NEUTRAL_RATING = 3.0
+
+# Profile features built from each vector block of the matrix
+BLOCK_SIMILARITY = {'directors': 'director_similarity', 'keywords': 'keyword_similarity'}
+
+
+def unit_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class UserProfiles:
+    # Per user: number of ratings, rating total and, for each vector block of the
+    # feature matrix (genres, directors, keywords), the sum of the rated movies'
+    # vectors weighted by rating - NEUTRAL_RATING. Keeping sums rather than means
+    # makes leaving ratings out a subtraction
+    def __init__(self, counts, totals, sums):
+        self.counts = counts
+        self.totals = totals
+        self.sums = sums
+
+    def __len__(self):
+        return len(self.counts)
+
+    @classmethod
+    def from_ratings(cls, matrix, user_rows, movie_rows, ratings, n_users):
+        # One sparse (users x movies) product per block for every user at once
+        ratings = np.asarray(ratings, dtype=np.float32)
+        weights = sparse.csr_matrix((ratings - NEUTRAL_RATING, (user_rows, movie_rows)), shape=(n_users, len(matrix)))
+        return cls(
+            np.bincount(user_rows, minlength=n_users).astype(np.float32),
+            np.bincount(user_rows, weights=ratings, minlength=n_users).astype(np.float32),
+            {name: np.asarray(weights @ matrix.block(name), dtype=np.float32) for name in matrix.blocks},
+        )
+
+    def take(self, indices):
+        return UserProfiles(self.counts[indices], self.totals[indices], {name: sums[indices] for name, sums in self.sums.items()})
+
+    def without(self, other):
+        # The profiles of the ratings in self but not in other (aligned row by row)
+        return UserProfiles(
+            self.counts - other.counts,
+            self.totals - other.totals,
+            {name: sums - other.sums[name] for name, sums in self.sums.items()},
+        )
+
+    def pack(self):
+        # One float32 row per user, for caching
+        return np.column_stack([self.counts, self.totals, *self.sums.values()]).astype(np.float32)
+
+    @classmethod
+    def unpack(cls, matrix, rows):
+        rows = np.asarray(rows, dtype=np.float32).reshape(-1, 2 + sum(len(columns) for columns in matrix.blocks.values()))
+        sums, start = {}, 2
+        for name, columns in matrix.blocks.items():
+            sums[name] = rows[:, start:start + len(columns)]
+            start += len(columns)
+        return cls(rows[:, 0], rows[:, 1], sums)
+
+
+class FeatureMatrix:
+    def __init__(self, movie_ids, features, feature_names):
+        self.movie_ids = movie_ids
+        self.features = features
+        self.feature_names = list(feature_names)
+        self._movie_index = None
+        self._blocks = {}
+        self._unit_blocks = {}
+        self._fingerprint = None
+
+        index = {name: column for column, name in enumerate(self.feature_names)}
+        self.user_column = index.get('user_id')
+        self.profile_columns = {name: index[name] for name in PROFILE_FEATURES if name in index}
+        # Vector blocks the profiles are built from; genres are the columns with a user_<genre> counterpart
+        genres = [name for name in self.feature_names if f'user_{name}' in index]
+        self.user_genre_columns = [index[f'user_{name}'] for name in genres]
+        self.blocks = {}
+        if genres:
+            self.blocks['genres'] = [index[name] for name in genres]
+        for name, suffix in (('directors', 'director'), ('keywords', 'keyword')):
+            if f'1{suffix}' in index:
+                self.blocks[name] = [index[f'{i+1}{suffix}'] for i in range(W2V_SIZE)]
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    @property
+    def movie_index(self):
+        # Maps each movie_id to its row in the matrix
+        if self._movie_index is None:
+            self._movie_index = {movie_id: row for row, movie_id in enumerate(self.movie_ids.tolist())}
+        return self._movie_index
+
+    @property
+    def fingerprint(self):
+        # Identifies the features the cached user profiles were computed against
+        if self._fingerprint is None:
+            digest = hashlib.sha1(self.features.tobytes())
+            digest.update(' '.join(self.feature_names).encode())
+            self._fingerprint = digest.hexdigest()[:12]
+        return self._fingerprint
+
+    def block(self, name):
+        if name not in self._blocks:
+            self._blocks[name] = self.features[:, self.blocks[name]]
+        return self._blocks[name]
+
+    def unit_block(self, name):
+        if name not in self._unit_blocks:
+            self._unit_blocks[name] = unit_rows(self.block(name))
+        return self._unit_blocks[name]
+
+    def for_user(self, user_id, profiles=None):
+        # Copy the shared matrix and fill in the user columns
+        return self.for_users([user_id], profiles)
+
+    def for_users(self, user_ids, profiles=None):
+        # Stack one copy of the matrix per user so a whole chunk of users can be scored at once
+        matrix = np.tile(self.features, (len(user_ids), 1))
+        if self.user_column is not None:
+            matrix[:, self.user_column] = np.repeat(np.asarray(user_ids, dtype=np.float32), len(self.movie_ids))
+        if self.profile_columns:
+            self.fill_profiles(matrix, profiles)
+        return matrix
+
+    def for_candidates(self, user_ids, rows, profiles=None):
+        # One row per (user, candidate movie): rows[i] holds the matrix rows of user_ids[i]'s
+        # candidates, so the cost follows the number of candidates rather than the catalog
+        movie_rows = np.concatenate([np.asarray(user_rows, dtype=np.int64) for user_rows in rows] or [np.empty(0, dtype=np.int64)])
+        user_index = np.repeat(np.arange(len(user_ids)), [len(user_rows) for user_rows in rows])
+        matrix = self.features[movie_rows]
+        if self.user_column is not None:
+            matrix[:, self.user_column] = np.asarray(user_ids, dtype=np.float32)[user_index]
+        if self.profile_columns:
+            self.fill_profiles(matrix, profiles.take(user_index), movie_rows)
+        return matrix
+
+    def fill_profiles(self, matrix, profiles, movie_rows=None):
+        # Fills the profile columns of `matrix` in place. Without movie_rows the matrix holds
+        # the whole catalog once per user (as for_users lays it out); with it, row i is the
+        # movie at movie_rows[i] for the user of profiles row i
+        counts = profiles.counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(counts > 0, profiles.totals / counts, np.nan)
+        genres = profiles.sums['genres'] / np.maximum(counts, 1)[:, None]
+        columns = self.profile_columns
+        user_columns = [columns['user_mean_rating'], columns['user_rating_count'], *self.user_genre_columns]
+        user_values = np.column_stack([mean, counts, genres])
+        # (user vectors, movie vectors) whose dot product is each profile match feature
+        matches = {columns['genre_affinity']: (genres, self.block('genres'))}
+        for name, feature in BLOCK_SIMILARITY.items():
+            if feature in columns:
+                matches[columns[feature]] = (unit_rows(profiles.sums[name]), self.unit_block(name))
+
+        if movie_rows is None:
+            # A view with one (movies x features) block per user: the user values broadcast over it
+            blocks = matrix.reshape(len(profiles), len(self), -1)
+            blocks[:, :, user_columns] = user_values[:, None, :]
+            for column, (users, movies) in matches.items():
+                blocks[:, :, column] = users @ movies.T
+        else:
+            matrix[:, user_columns] = user_values
+            for column, (users, movies) in matches.items():
+                matrix[:, column] = np.einsum('ij,ij->i', users, movies[movie_rows])
+
+    def save(self, path):
+        np.savez(path, movie_ids=self.movie_ids, features=self.features, feature_names=np.array(self.feature_names))
+
+
+def load_feature_matrix(path):
+    data = np.load(path)
+    return FeatureMatrix(data['movie_ids'], data['features'], data['feature_names'].tolist())
+
+
+def word2vec_means(model, documents):
+    # Mean Word2Vec vector of the in-vocabulary words of each document, computed as
+    # one sparse (documents x vocabulary) count matrix times the embedding table
+    rows, cols = [], []
+    for row, document in enumerate(documents):
+        for word in document.split():
+            index = model.wv.key_to_index.get(word)
+            if index is not None:
+                rows.append(row)
+                cols.append(index)
+
+    counts = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(documents), len(model.wv.key_to_index)),
+    )
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+    totals[totals == 0] = 1
+    return np.asarray(sparse.diags(1 / totals) @ counts @ model.wv.vectors, dtype=np.float32)
+
+
+def read_movie_csv(path):
+    movie_df = pd.read_csv(path)
+    movie_df.dropna(subset=['movie_id'], inplace=True)
+    movie_df.reset_index(drop=True, inplace=True)
+    movie_df['movie_id'] = movie_df['movie_id'].astype(np.int64)
+    movie_df['adult'] = movie_df['adult'].fillna(False).astype(bool).astype(int)
+    for column in ('genres', 'directors', 'keywords'):
+        if column in movie_df.columns:
+            movie_df[column] = movie_df[column].fillna('')
+    return movie_df
+
+
+def build_feature_matrix(movie_df, feature_names, vectorizer, w2v_director=None, w2v_keyword=None):
+    columns = {
+        'movie_id': movie_df['movie_id'].to_numpy(),
+        'runtime': movie_df['runtime'].to_numpy(dtype=np.float32),
+        'adult': movie_df['adult'].to_numpy(),
+    }
+
+    genres_tfidf = vectorizer.transform(movie_df['genres']).toarray()
+    for index, name in enumerate(vectorizer.get_feature_names_out()):
+        columns.setdefault(name, genres_tfidf[:, index])
+
+    if w2v_director is not None:
+        director_vectors = word2vec_means(w2v_director, movie_df['directors'])
+        columns.update({f'{i+1}director': director_vectors[:, i] for i in range(W2V_SIZE)})
+    if w2v_keyword is not None:
+        keyword_vectors = word2vec_means(w2v_keyword, movie_df['keywords'])
+        columns.update({f'{i+1}keyword': keyword_vectors[:, i] for i in range(W2V_SIZE)})
+
+    # Lay the columns out in the exact order the model was trained with; the user
+    # columns (user_id or the profile features) are left at zero until scoring
+    features = np.zeros((len(movie_df), len(feature_names)), dtype=np.float32)
+    for index, name in enumerate(feature_names):
+        if name not in PROFILE_FEATURES and not name.startswith('user_'):
+            features[:, index] = columns[name]
+
+    return FeatureMatrix(columns['movie_id'].astype(np.int64), features, feature_names)
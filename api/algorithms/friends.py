@@ -0,0 +1,136 @@
+import itertools
+import numpy as np
+from scipy import sparse
+from api.models import GenericUser, Rating, WatchedMovie, Friendship
+from api.cache import cached
+
+# This file contains the "friends liked" recommender. It scores the movies that a
+# user's friends and friends-of-friends rated highly, weighting each of them by
+# how close they are in the social graph and how similar their ratings are to the
+# user's. Everything is computed with sparse matrix products over the user's
+# neighbourhood: one query for each hop of the graph and one for the ratings.
+#
+# Results are cached per user; the cache entry is invalidated when the user rates
+# something or their friendships change (see api/signals.py), and otherwise
+# expires after CACHE_TIMEOUT so new ratings by friends show up.
+
+TOP_N = 20
+CACHE_TIMEOUT = 15 * 60
+
+# Social weight of a direct friend and of a friend-of-friend (per mutual friend)
+FRIEND_WEIGHT = 1.0
+FRIEND_OF_FRIEND_WEIGHT = 0.25
+
+# Friends-of-friends with the most mutual friends that are kept
+MAX_FRIENDS_OF_FRIENDS = 500
+
+# A neighbour liked a movie if they rated it at least this and above their own mean
+MIN_LIKED_RATING = 3.5
+
+
+def social_neighbourhood(user_id):
+    # Returns (neighbour_ids, social_weights): friends, then the friends-of-friends
+    # with the most mutual friends, weighted through a sparse adjacency matrix
+    friend_ids = list(Friendship.objects.filter(user_id=user_id).values_list('friend_id', flat=True))
+    if not friend_ids:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+    edges = np.array(
+        Friendship.objects.filter(user_id__in=friend_ids).exclude(friend_id=user_id).values_list('user_id', 'friend_id'),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+
+    friends = np.unique(np.array(friend_ids, dtype=np.int64))
+    second_hop = np.setdiff1d(np.unique(edges[:, 1]), friends)
+
+    # friend -> friend-of-friend adjacency; the column sums count mutual friends
+    keep = np.isin(edges[:, 1], second_hop)
+    adjacency = sparse.csr_matrix(
+        (
+            np.ones(keep.sum(), dtype=np.float32),
+            (np.searchsorted(friends, edges[keep, 0]), np.searchsorted(second_hop, edges[keep, 1])),
+        ),
+        shape=(len(friends), len(second_hop)),
+    )
+    mutual = np.asarray(adjacency.sum(axis=0)).ravel()
+    if len(second_hop) > MAX_FRIENDS_OF_FRIENDS:
+        top = np.argpartition(-mutual, MAX_FRIENDS_OF_FRIENDS - 1)[:MAX_FRIENDS_OF_FRIENDS]
+        second_hop, mutual = second_hop[top], mutual[top]
+
+    neighbour_ids = np.concatenate([friends, second_hop])
+    weights = np.concatenate([
+        np.full(len(friends), FRIEND_WEIGHT, dtype=np.float32),
+        (FRIEND_OF_FRIEND_WEIGHT * mutual).astype(np.float32),
+    ])
+    return neighbour_ids, weights
+
+
+def rating_matrix(user_ids):
+    # Sparse (users x movies) matrix of mean-centred ratings plus the raw ratings
+    ratings = np.array(
+        Rating.objects.filter(user_id__in=user_ids.tolist()).values_list('user_id', 'movie_id', 'rating'),
+        dtype=np.float64,
+    ).reshape(-1, 3)
+    rows = np.searchsorted(user_ids, ratings[:, 0].astype(np.int64))
+    movie_ids, columns = np.unique(ratings[:, 1].astype(np.int64), return_inverse=True)
+    shape = (len(user_ids), len(movie_ids))
+
+    raw = sparse.csr_matrix((ratings[:, 2].astype(np.float32), (rows, columns)), shape=shape)
+    counts = np.maximum(np.diff(raw.indptr), 1)
+    means = np.asarray(raw.sum(axis=1)).ravel() / counts
+    centred = raw.copy()
+    centred.data = centred.data - np.repeat(means, np.diff(raw.indptr)).astype(np.float32)
+    return movie_ids, raw, centred
+
+
+def score_friend_movies(user_id, top_n=TOP_N):
+    # Returns up to top_n Movie ids, best first
+    neighbour_ids, social_weights = social_neighbourhood(user_id)
+    if not len(neighbour_ids):
+        return []
+
+    # rating_matrix needs sorted ids; reorder its rows so row 0 is the user and the
+    # remaining rows line up with social_weights
+    user_ids = np.concatenate([[user_id], neighbour_ids])
+    order = np.argsort(user_ids)
+    movie_ids, raw, centred = rating_matrix(user_ids[order])
+    if not len(movie_ids):
+        return []
+    rows = np.argsort(order)
+    raw, centred = raw[rows], centred[rows]
+
+    # Cosine similarity of each neighbour's centred ratings to the user's, mapped to [0, 1]
+    user_vector = centred[0]
+    norms = np.sqrt(np.asarray(centred.multiply(centred).sum(axis=1)).ravel())
+    dots = np.asarray((centred[1:] @ user_vector.T).todense()).ravel()
+    denominator = norms[1:] * norms[0]
+    similarity = np.divide(dots, denominator, out=np.zeros_like(dots), where=denominator > 0)
+    weights = social_weights * (1 + similarity) / 2
+
+    # Weighted sum of how much each neighbour liked each movie (above their own mean)
+    liked = centred[1:].multiply(raw[1:] >= MIN_LIKED_RATING).tocsr()
+    liked.data = np.maximum(liked.data, 0)
+    liked.eliminate_zeros()
+    scores = np.asarray(liked.T @ weights).ravel()
+
+    # Exclude movies the user has rated (row 0), watched or put on their watchlist
+    seen = set(movie_ids[raw[0].indices].tolist())
+    seen.update(itertools.chain(
+        WatchedMovie.objects.filter(user_id=user_id).values_list('movie_id', flat=True),
+        GenericUser.watchlist.through.objects.filter(genericuser_id=user_id).values_list('movie_id', flat=True),
+    ))
+    scores[np.isin(movie_ids, list(seen))] = 0
+
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > top_n:
+        candidates = candidates[np.argpartition(-scores[candidates], top_n - 1)[:top_n]]
+    candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+    return movie_ids[candidates].tolist()
+
+
+def friend_movie_ids(user_id, top_n=TOP_N):
+    return cached(f'friends:{user_id}:{top_n}', [f'friends:{user_id}'], lambda: score_friend_movies(user_id, top_n), CACHE_TIMEOUT)
+
+
+def friend_recommendations(user, top_n=TOP_N):
+    return friend_movie_ids(user.id, top_n)
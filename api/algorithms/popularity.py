@@ -0,0 +1,73 @@
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import timezone
+from api.models import Movie
+
+# This file ranks movies for the popular list. A movie's average rating is shrunk
+# towards the catalogue mean by PRIOR_VOTES imaginary votes (a Bayesian average), so
+# a single 5.0 rating no longer outranks films with thousands of votes, and then
+# weighted by release recency. The score is stored in Movie.popularity_score: the
+# Rating signals update it for the rated movie and the update_popularity command
+# recomputes every movie (the recency weight and the catalogue mean drift over time).
+
+PRIOR_VOTES = 25
+DEFAULT_PRIOR_MEAN = 3.5
+
+# Share of the score that depends on recency, and the age at which that share halves
+RECENCY_WEIGHT = 0.2
+RECENCY_HALF_LIFE_YEARS = 10
+
+PRIOR_MEAN_KEY = 'popularity:prior_mean'
+PRIOR_MEAN_TIMEOUT = 24 * 60 * 60
+
+
+def compute_prior_mean():
+    totals = Movie.objects.aggregate(count=Sum('rating_count'), total=Sum('rating_sum'))
+    if not totals['count']:
+        return DEFAULT_PRIOR_MEAN
+    return totals['total'] / totals['count']
+
+
+def prior_mean(refresh=False):
+    # Mean rating over all ratings; cached because it barely moves with a single rating
+    mean = None if refresh else cache.get(PRIOR_MEAN_KEY)
+    if mean is None:
+        mean = compute_prior_mean()
+        cache.set(PRIOR_MEAN_KEY, mean, PRIOR_MEAN_TIMEOUT)
+    return mean
+
+
+def popularity_score(rating_count, rating_sum, release_date, mean, today=None):
+    if not rating_count:
+        return None
+    bayesian_average = (rating_sum + PRIOR_VOTES * mean) / (rating_count + PRIOR_VOTES)
+
+    today = today or timezone.now().date()
+    if release_date is None:
+        recency = 0.0
+    else:
+        age_years = max((today - release_date).days, 0) / 365.25
+        recency = 0.5 ** (age_years / RECENCY_HALF_LIFE_YEARS)
+    return bayesian_average * (1 - RECENCY_WEIGHT + RECENCY_WEIGHT * recency)
+
+
+def update_movie_popularity(movie_id):
+    movie = Movie.objects.filter(pk=movie_id).values('rating_count', 'rating_sum', 'release_date').first()
+    if movie is not None:
+        score = popularity_score(movie['rating_count'], movie['rating_sum'], movie['release_date'], prior_mean())
+        Movie.objects.filter(pk=movie_id).update(popularity_score=score)
+
+
+def update_all_popularity(batch_size=1000):
+    # Returns (changed, total); only movies whose score moved are written
+    mean = prior_mean(refresh=True)
+    today = timezone.now().date()
+    movies = list(Movie.objects.only('id', 'rating_count', 'rating_sum', 'release_date', 'popularity_score'))
+    changed = []
+    for movie in movies:
+        score = popularity_score(movie.rating_count, movie.rating_sum, movie.release_date, mean, today)
+        if score != movie.popularity_score:
+            movie.popularity_score = score
+            changed.append(movie)
+    Movie.objects.bulk_update(changed, ['popularity_score'], batch_size=batch_size)
+    return len(changed), len(movies)
@@ -0,0 +1,64 @@
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+
+from api.models import Rating
+from api.algorithms.features import UserProfiles
+
+# This file loads the per-user profile features of the XGBoost recommenders (see
+# features.UserProfiles). The profiles of a batch of users are computed from one
+# Rating query and one sparse product per vector block, and cached per user.
+# A cache key holds the state of the user's ratings as stored in the database
+# (their number, total, latest timestamp and highest id, read with one aggregate
+# query for the batch) and the fingerprint of the feature matrix the profile was
+# computed against. Every process sees the same state, so a rating change made
+# anywhere (the API, a bulk import, the admin) or a retrain never serves a stale profile.
+
+PROFILE_TIMEOUT = 24 * 60 * 60
+
+
+def profile_key(matrix, user_id, state):
+    return f'profile:{matrix.fingerprint}:{user_id}:{state}'
+
+
+def rating_states(user_ids):
+    # {user_id: a string that changes whenever one of the user's ratings is added, edited or removed}
+    rows = Rating.objects.filter(user_id__in=user_ids).values('user_id').annotate(
+        count=Count('id'), total=Sum('rating'), latest=Max('timestamp'), last_id=Max('id'),
+    ).order_by()
+    states = {user_id: '0' for user_id in user_ids}
+    for row in rows:
+        states[row['user_id']] = f"{row['count']}-{row['total']}-{row['latest'].timestamp()}-{row['last_id']}"
+    return states
+
+
+def compute_user_profiles(matrix, user_ids):
+    user_rows = {user_id: row for row, user_id in enumerate(user_ids)}
+    rows = Rating.objects.filter(user_id__in=user_ids).values_list('user_id', 'movie__movie_id', 'rating')
+    users, movies, values = [], [], []
+    for user_id, movie_id, rating in rows:
+        movie_row = matrix.movie_index.get(movie_id)
+        if movie_row is not None:
+            users.append(user_rows[user_id])
+            movies.append(movie_row)
+            values.append(rating)
+    return UserProfiles.from_ratings(
+        matrix, np.array(users, dtype=np.int64), np.array(movies, dtype=np.int64), np.array(values, dtype=np.float32), len(user_ids),
+    )
+
+
+def load_user_profiles(matrix, user_ids):
+    # UserProfiles aligned with user_ids, from the cache where possible
+    user_ids = list(user_ids)
+    states = rating_states(user_ids)
+    keys = [profile_key(matrix, user_id, states[user_id]) for user_id in user_ids]
+    cached = cache.get_many(keys)
+
+    missing = [user_id for user_id, key in zip(user_ids, keys) if key not in cached]
+    if missing:
+        computed = compute_user_profiles(matrix, missing).pack()
+        keys_by_user = dict(zip(user_ids, keys))
+        fresh = {keys_by_user[user_id]: row for user_id, row in zip(missing, computed)}
+        cache.set_many(fresh, PROFILE_TIMEOUT)
+        cached.update(fresh)
+    return UserProfiles.unpack(matrix, [cached[key] for key in keys])
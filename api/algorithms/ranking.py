@@ -0,0 +1,84 @@
+import numpy as np
+from api.models import Movie
+from api.algorithms.registry import registry
+from api.algorithms.profiles import load_user_profiles
+from api.algorithms.candidates import generate_candidates
+
+# This file runs the two-stage recommendation pipeline for the XGBoost recommenders:
+#
+#   1. candidates.generate_candidates retrieves about CANDIDATES movies per user
+#   2. the model scores only those movies (FeatureMatrix.for_candidates), so the
+#      cost grows with the number of candidates, not with the catalog
+#   3. diversify re-ranks the scored candidates: a greedy maximal marginal relevance
+#      pass over the similar-movies embeddings (similarity.py) trades a little
+#      likelihood for variety, and a small exploration bonus drawn from a generator
+#      seeded with the user id lifts some lower scored movies. The same user, ratings
+#      and models always give the same list, so it can be stored and cached. Without
+#      similar_movies.npz (see build_similar_movies) the list is ordered by likelihood
+#      and exploration bonus only.
+
+# Penalty on a candidate's highest similarity to the movies already picked
+DIVERSITY = 0.15
+# Largest exploration bonus added to a likelihood
+EXPLORATION = 0.05
+SEED = 42
+
+
+def score_candidates(model, features, user_ids, candidates):
+    # Returns {user_id: (movie pks, MovieLens movie_ids, likelihoods)} for the candidates in the feature matrix
+    movie_ids = dict(Movie.objects.filter(
+        id__in={pk for pks in candidates.values() for pk in pks}, movie_id__isnull=False,
+    ).values_list('id', 'movie_id'))
+
+    kept = {}
+    for user_id in user_ids:
+        pks = [pk for pk in candidates[user_id] if movie_ids.get(pk) in features.movie_index]
+        kept[user_id] = (np.array(pks, dtype=np.int64), np.array([movie_ids[pk] for pk in pks], dtype=np.int64))
+
+    # Models trained with profile features describe each user by their ratings (cached per user)
+    profiles = load_user_profiles(features, user_ids) if features.profile_columns else None
+    rows = [[features.movie_index[movie_id] for movie_id in kept[user_id][1].tolist()] for user_id in user_ids]
+    matrix = features.for_candidates(user_ids, rows, profiles)
+    predictions = model.predict_proba(matrix)[:, 1] if len(matrix) else np.empty(0, dtype=np.float32)
+
+    ends = np.cumsum([len(user_rows) for user_rows in rows])
+    return {
+        user_id: (*kept[user_id], scores)
+        for user_id, scores in zip(user_ids, np.split(predictions, ends[:-1]))
+    }
+
+
+def diversify(user_id, movie_ids, scores, index, top_n, seed=SEED):
+    # Returns the positions of up to top_n of the movies (pks), in the order they are shown.
+    # Without a similarity index every movie counts as unlike the others
+    vectors = np.zeros((len(movie_ids), index.embeddings.shape[1] if index is not None else 1), dtype=np.float32)
+    for row, movie_id in enumerate(movie_ids.tolist() if index is not None else ()):
+        position = index.movie_index.get(movie_id)
+        if position is not None:
+            vectors[row] = index.embeddings[position]
+
+    relevance = scores + EXPLORATION * np.random.default_rng([seed, user_id]).random(len(scores))
+    closest = np.zeros(len(movie_ids), dtype=np.float32)
+    available = np.ones(len(movie_ids), dtype=bool)
+    order = []
+    for _ in range(min(top_n, len(movie_ids))):
+        gains = np.where(available, relevance - DIVERSITY * closest, -np.inf)
+        best = int(np.argmax(gains))
+        order.append(best)
+        available[best] = False
+        closest = np.maximum(closest, vectors @ vectors[best])
+    return order
+
+
+def rank_movies_for_users(model, features, user_ids, top_n=100, seed=SEED):
+    # Returns {user_id: [(movie_id, likelihood), ...]} using MovieLens movie_ids, in the
+    # order they are shown, without movies the user rated, watched or has on their watchlist
+    user_ids = list(user_ids)
+    scored = score_candidates(model, features, user_ids, generate_candidates(user_ids))
+
+    index = registry.get_optional('similar_index')
+    recommendations = {}
+    for user_id, (pks, movie_ids, scores) in scored.items():
+        order = diversify(user_id, pks, scores, index, top_n, seed)
+        recommendations[user_id] = list(zip(movie_ids[order].tolist(), scores[order].tolist()))
+    return recommendations
@@ -0,0 +1,65 @@
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from api.models import Movie, UserRecommendation, UserRecommendationState, RecommendationEvent
+from api.algorithms.xgboost_w2v_opt import top_movies_for_users
+
+# This file materialises each user's ranked recommendation list into the
+# UserRecommendation table (see the build_recommendations command) and serves
+# it back to RetrieveMovies. A user's list is stale while they have unprocessed
+# RecommendationEvents (see api/signals.py); stale and missing lists are scored
+# online and stored for next time. UserRecommendationState records that a user
+# was scored, so a user with nothing to recommend is not rescored on every request.
+
+TOP_N = 100
+
+
+def store_recommendations(recommendations):
+    # recommendations is {user_id: [(movie_id, likelihood), ...]} using MovieLens movie_ids
+    movie_ids = {movie_id for ranked in recommendations.values() for movie_id, _ in ranked}
+    movie_pks = dict(Movie.objects.filter(movie_id__in=movie_ids).values_list('movie_id', 'id'))
+
+    generated_at = timezone.now()
+    rows = [
+        UserRecommendation(user_id=user_id, movie_id=movie_pks[movie_id], rank=rank, score=score, generated_at=generated_at)
+        for user_id, ranked in recommendations.items()
+        for rank, (movie_id, score) in enumerate(ranked)
+        if movie_id in movie_pks
+    ]
+
+    counts = dict.fromkeys(recommendations, 0)
+    for row in rows:
+        counts[row.user_id] += 1
+    states = [UserRecommendationState(user_id=user_id, generated_at=generated_at, count=count) for user_id, count in counts.items()]
+
+    with transaction.atomic():
+        UserRecommendation.objects.filter(user_id__in=list(recommendations)).delete()
+        UserRecommendation.objects.bulk_create(rows, batch_size=1000, ignore_conflicts=True)
+        UserRecommendationState.objects.bulk_create(
+            states, update_conflicts=True, unique_fields=['user'], update_fields=['generated_at', 'count'],
+        )
+    return len(rows)
+
+
+def generate_recommendations(user_ids, top_n=TOP_N):
+    # Events recorded while scoring are left pending so they trigger another refresh
+    started_at = timezone.now()
+    rows = store_recommendations(top_movies_for_users(user_ids, top_n))
+    RecommendationEvent.objects.filter(
+        user_id__in=list(user_ids), processed_at__isnull=True, created_at__lte=started_at
+    ).update(processed_at=timezone.now())
+    return rows
+
+
+def is_fresh(user):
+    # Scored before, and nothing changed since: one query for both
+    pending = RecommendationEvent.objects.filter(user_id=OuterRef('user_id'), processed_at__isnull=True)
+    state = UserRecommendationState.objects.filter(user=user).annotate(stale=Exists(pending)).values_list('stale', flat=True)
+    return list(state) == [False]
+
+
+def get_recommendations(user, top_n=TOP_N):
+    # Returns the user's recommended Movie ids, best first
+    if not is_fresh(user):
+        generate_recommendations([user.id], top_n)
+    return list(UserRecommendation.objects.filter(user=user).order_by('rank').values_list('movie_id', flat=True))
@@ -0,0 +1,264 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+import joblib
+from xgboost import XGBClassifier
+from gensim.models import Word2Vec
+
+from api.algorithms.features import load_feature_matrix
+from api.algorithms.factors import load_svd_factors
+from api.algorithms.ann import load_similarity_index
+
+# This file contains the process-wide registry for the recommender artifacts.
+# Each gunicorn worker loads an artifact once, the first time it is requested (or
+# at worker start when RECOMMENDER_PRELOAD is set, see mcbackend/wsgi.py), and keeps
+# it in memory. When the file on disk changes the artifact is reloaded on the next lookup.
+# A model and its feature matrix form a group (register_group): they are reloaded
+# together, only once the new booster's features match the new matrix's columns,
+# and read together with get_group.
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_DIR = Path(__file__).resolve().parent
+
+# How often (in seconds) an artifact's file is stat'ed to look for changes
+CHECK_INTERVAL = float(os.getenv('RECOMMENDER_CHECK_INTERVAL', '5'))
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def resident_memory():
+    # Resident set size of this process in bytes (Linux only, 0 elsewhere)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class Artifact:
+    def __init__(self, name, path, loader):
+        self.name = name
+        self.path = Path(path)
+        self.loader = loader
+        self.value = None
+        self.loaded = False
+        self.mtime = None
+        self.size = None
+        self.checksum = None
+        self.load_seconds = None
+        self.memory_bytes = None
+        self.loaded_at = None
+        self.load_count = 0
+        self.last_checked = 0.0
+
+    def read(self):
+        # Loads the file without serving it yet (see commit)
+        stat = self.path.stat()
+        rss_before = resident_memory()
+        start = time.perf_counter()
+        value = self.loader(self.path)
+        seconds = time.perf_counter() - start
+        return value, stat, file_checksum(self.path), seconds, max(resident_memory() - rss_before, 0)
+
+    def load(self):
+        self.commit(self.read())
+
+    def commit(self, read):
+        value, stat, checksum, self.load_seconds, self.memory_bytes = read
+        self.value = value
+        self.loaded = True
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.checksum = checksum
+        self.loaded_at = time.time()
+        self.last_checked = time.monotonic()
+        self.load_count += 1
+        logger.info(
+            'Loaded recommender artifact %s from %s in %.1f ms (%.1f MB)',
+            self.name, self.path, self.load_seconds * 1000, self.memory_bytes / 1e6,
+        )
+
+    def is_outdated(self):
+        # Cheap mtime/size check first; only hash the file when those changed so
+        # that a plain `touch` does not trigger a reload
+        stat = self.path.stat()
+        if stat.st_mtime == self.mtime and stat.st_size == self.size:
+            return False
+        checksum = file_checksum(self.path)
+        if checksum == self.checksum:
+            self.mtime = stat.st_mtime
+            self.size = stat.st_size
+            return False
+        return True
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'path': str(self.path),
+            'loaded': self.loaded,
+            'load_seconds': self.load_seconds,
+            'memory_bytes': self.memory_bytes,
+            'checksum': self.checksum,
+            'loaded_at': self.loaded_at,
+            'load_count': self.load_count,
+        }
+
+
+class ModelRegistry:
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._artifacts = {}
+        self._groups = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, path, loader):
+        with self._lock:
+            self._artifacts[name] = Artifact(name, path, loader)
+
+    def register_group(self, names, check):
+        # Artifacts that only work together (a model and its feature matrix) are checked
+        # and reloaded together, and a reload is only served once check(*values) accepts
+        # the new files. While their files are replaced one at a time (train_recommender
+        # --install) the previous set keeps being served
+        with self._lock:
+            for name in names:
+                self._groups[name] = (tuple(names), check)
+
+    def path(self, name):
+        return self._artifacts[name].path
+
+    def get(self, name):
+        artifact = self._artifacts[name]
+        if artifact.loaded and time.monotonic() - artifact.last_checked < self.check_interval:
+            return artifact.value
+
+        with self._lock:
+            if not artifact.loaded or time.monotonic() - artifact.last_checked >= self.check_interval:
+                names, check = self._groups.get(name, ((name,), None))
+                self.refresh([self._artifacts[member] for member in names], check)
+        return artifact.value
+
+    def checksum(self, name):
+        # Checksum of the file the served value of an artifact was loaded from
+        with self._lock:
+            self.get(name)
+            return self._artifacts[name].checksum
+
+    def get_group(self, names):
+        # The values of a group (see register_group) from one snapshot. Two get() calls could
+        # straddle a reload and pair a new model with an old matrix; here the group is
+        # checked, reloaded if needed and read under the lock
+        with self._lock:
+            members, check = self._groups.get(names[0], (tuple(names), None))
+            artifacts = [self._artifacts[name] for name in members]
+            if any(not artifact.loaded or time.monotonic() - artifact.last_checked >= self.check_interval for artifact in artifacts):
+                self.refresh(artifacts, check)
+            return tuple(self._artifacts[name].value for name in names)
+
+    def refresh(self, members, check):
+        changed = []
+        for artifact in members:
+            artifact.last_checked = time.monotonic()
+            if not artifact.loaded:
+                changed.append(artifact)
+                continue
+            try:
+                if artifact.is_outdated():
+                    changed.append(artifact)
+            except OSError:
+                # The file is being replaced; keep serving the loaded copy
+                pass
+        if not changed:
+            return
+
+        reloading = all(artifact.loaded for artifact in members)
+        if reloading:
+            logger.info('Recommender artifacts %s changed on disk, reloading', ', '.join(artifact.name for artifact in changed))
+        try:
+            reads = {artifact.name: artifact.read() for artifact in changed}
+        except OSError:
+            if not reloading:
+                raise
+            logger.warning('Could not read the changed recommender artifacts; keeping the loaded copies', exc_info=True)
+            return
+
+        if check is not None:
+            values = [reads[artifact.name][0] if artifact.name in reads else artifact.value for artifact in members]
+            if not check(*values):
+                names = ', '.join(artifact.name for artifact in members)
+                if reloading:
+                    # Probably halfway through an install; a later check sees the rest
+                    logger.warning('Recommender artifacts %s do not match yet; keeping the loaded copies', names)
+                    return
+                logger.error('Recommender artifacts %s do not match each other', names)
+        for artifact in changed:
+            artifact.commit(reads[artifact.name])
+
+    def get_optional(self, name):
+        # For artifacts the recommendations can do without: None (with a warning) when the
+        # file was never built, so the caller skips what it is used for instead of failing
+        try:
+            return self.get(name)
+        except FileNotFoundError:
+            logger.warning('Recommender artifact %s is missing (%s); skipping it', name, self.path(name))
+            return None
+
+    def preload(self, names=None):
+        for name in names or list(self._artifacts):
+            try:
+                self.get(name)
+            except Exception:
+                logger.exception('Failed to preload recommender artifact %s', name)
+
+    def clear(self):
+        with self._lock:
+            for name, artifact in self._artifacts.items():
+                self._artifacts[name] = Artifact(artifact.name, artifact.path, artifact.loader)
+
+    def stats(self):
+        return [artifact.stats() for artifact in self._artifacts.values()]
+
+
+def load_xgboost(path):
+    model = XGBClassifier()
+    model.load_model(path)
+    return model
+
+
+def load_word2vec(path):
+    return Word2Vec.load(str(path))
+
+
+def features_match(model, matrix):
+    # The booster scores the matrix's columns by position, so they must be the ones it was trained on
+    booster = model.get_booster()
+    names = booster.feature_names
+    return booster.num_features() == len(matrix.feature_names) and (names is None or list(names) == matrix.feature_names)
+
+
+registry = ModelRegistry()
+
+registry.register('xgboost_simple', ARTIFACT_DIR / 'MC_rec.json', load_xgboost)
+registry.register('tfidf_simple', ARTIFACT_DIR / 'tfidf.joblib', joblib.load)
+registry.register('xgboost_w2v', ARTIFACT_DIR / 'mc_rec_w2v.json', load_xgboost)
+registry.register('tfidf_w2v', ARTIFACT_DIR / 'tfidf_w2v.joblib', joblib.load)
+registry.register('w2v_director', ARTIFACT_DIR / 'Word2Vec_director', load_word2vec)
+registry.register('w2v_keyword', ARTIFACT_DIR / 'Word2Vec_keyword', load_word2vec)
+registry.register('features_simple', ARTIFACT_DIR / 'features_simple.npz', load_feature_matrix)
+registry.register('features_w2v', ARTIFACT_DIR / 'features_w2v.npz', load_feature_matrix)
+registry.register('svd_factors', ARTIFACT_DIR / 'svd_factors.npz', load_svd_factors)
+registry.register('similar_index', ARTIFACT_DIR / 'similar_movies.npz', load_similarity_index)
+
+registry.register_group(['xgboost_simple', 'features_simple'], features_match)
+registry.register_group(['xgboost_w2v', 'features_w2v'], features_match)
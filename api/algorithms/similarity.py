@@ -0,0 +1,101 @@
+import logging
+
+import numpy as np
+from api.models import Movie
+from api.algorithms.registry import registry
+from api.algorithms.features import word2vec_means
+from api.algorithms.ann import SimilarityIndex, TOP_K, kmeans, normalize_rows
+
+# This file contains the similar-movies engine. Every movie gets one embedding made of
+# four L2-normalised, weighted blocks:
+#   genres     TF-IDF of the genre list (tfidf_w2v)
+#   directors  mean Word2Vec vector of the director names (w2v_director)
+#   keywords   mean Word2Vec vector of the keywords (w2v_keyword)
+#   ratings    SVD item factors (svd_factors), for movies that were part of the fit
+# and cosine similarity between embeddings ranks the neighbours.
+#
+# Lookups go through the IVF index in ann.py (clusters of about sqrt(N) movies). The
+# build_similar_movies command builds the index, saves it to similar_movies.npz and
+# writes every movie's top-k neighbours to Movie.similar_movies in one bulk insert.
+# Movies added after that are embedded and looked up on the fly (see similar_movie_ids),
+# as long as the embedding artifacts are still the ones the index was built with: the
+# index records their checksums, and after a retrain (train_recommender --install) new
+# vectors would not be comparable with the saved ones until build_similar_movies reruns.
+
+logger = logging.getLogger(__name__)
+
+# The artifacts the embeddings are computed from
+EMBEDDING_ARTIFACTS = ('tfidf_w2v', 'w2v_director', 'w2v_keyword', 'svd_factors')
+
+BLOCK_WEIGHTS = {'genres': 1.0, 'directors': 0.5, 'keywords': 1.0, 'ratings': 1.0}
+
+
+def movie_documents(movie_ids):
+    # Genre, director and keyword strings per movie, in the format the models were trained on
+    # (see export_datasets), from one query per relation
+    documents = {movie_id: {'genres': [], 'directors': [], 'keywords': []} for movie_id in movie_ids}
+    relations = (
+        ('genres', Movie.genres.through, 'genre__name'),
+        ('directors', Movie.directors.through, 'director__name'),
+        ('keywords', Movie.keywords.through, 'keyword__name'),
+    )
+    for name, through, field in relations:
+        # Large batches read the whole relation instead of sending thousands of ids
+        rows = through.objects.all() if len(movie_ids) > 1000 else through.objects.filter(movie_id__in=movie_ids)
+        for movie_id, value in rows.values_list('movie_id', field).order_by('id').iterator(chunk_size=10000):
+            if movie_id in documents:
+                documents[movie_id][name].append(value)
+    return (
+        [', '.join(documents[movie_id]['genres']) for movie_id in movie_ids],
+        [' '.join(documents[movie_id]['directors']) for movie_id in movie_ids],
+        [' '.join(documents[movie_id]['keywords']) for movie_id in movie_ids],
+    )
+
+
+def embed_movies(movie_ids):
+    # One row per Movie id (pk), unit length
+    movie_ids = list(movie_ids)
+    genres, directors, keywords = movie_documents(movie_ids)
+
+    blocks = {
+        'genres': registry.get('tfidf_w2v').transform(genres).toarray().astype(np.float32),
+        'directors': word2vec_means(registry.get('w2v_director'), directors),
+        'keywords': word2vec_means(registry.get('w2v_keyword'), keywords),
+    }
+
+    factors = registry.get('svd_factors')
+    ratings = np.zeros((len(movie_ids), factors.item_factors.shape[1]), dtype=np.float32)
+    for row, movie_id in enumerate(movie_ids):
+        column = factors.movie_index.get(movie_id)
+        if column is not None:
+            ratings[row] = factors.normalized_item_factors[column]
+    blocks['ratings'] = ratings
+
+    embeddings = np.hstack([normalize_rows(blocks[name]) * weight for name, weight in BLOCK_WEIGHTS.items()])
+    return normalize_rows(embeddings).astype(np.float32)
+
+
+def embedding_sources():
+    return {name: registry.checksum(name) for name in EMBEDDING_ARTIFACTS}
+
+
+def build_similarity_index(movie_ids=None):
+    if movie_ids is None:
+        movie_ids = list(Movie.objects.order_by('id').values_list('id', flat=True))
+    embeddings = embed_movies(movie_ids)
+    n_clusters = max(1, min(len(movie_ids), int(np.sqrt(len(movie_ids)))))
+    centroids, assignments = kmeans(embeddings, n_clusters)
+    return SimilarityIndex(np.array(movie_ids, dtype=np.int64), embeddings, centroids, assignments, embedding_sources())
+
+
+def similar_movie_ids(movie_id, k=TOP_K):
+    # Neighbours of a movie from the saved index; movies added after the index was
+    # built are embedded from their current genres, directors and keywords
+    index = registry.get('similar_index')
+    if movie_id in index.movie_index:
+        return [neighbour for neighbour, _ in index.neighbours(movie_id, k)]
+    if index.sources != embedding_sources():
+        logger.warning('The similar movies index was built with other embedding models; rerun build_similar_movies')
+        return []
+    vector = embed_movies([movie_id])[0]
+    return [neighbour for neighbour, _ in index.search(vector, k, exclude=(movie_id,))]
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from gensim.models import Word2Vec
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import log_loss, roc_auc_score
+from xgboost import XGBClassifier
+
+from api.algorithms.datasets import load_columns, read_movie_dataset
+from api.algorithms.features import build_feature_matrix, UserProfiles, PROFILE_FEATURES, BLOCK_SIMILARITY, W2V_SIZE
+
+# This file trains the XGBoost recommenders (xgboost_w2v_opt, and xgboost_simple_opt
+# without the Word2Vec features) from the datasets written by export_datasets (see
+# the train_recommender command):
+#
+#   1. Word2Vec models on the director and keyword names of every movie and a
+#      TF-IDF vectorizer on their genres, with the settings of the shipped models
+#   2. the movie feature matrix (features.build_feature_matrix) and one training
+#      row per rating: the rated movie's row with the user's profile features
+#      filled in, labelled liked when the rating is LIKE_THRESHOLD or more. The
+#      profile is built out of fold from the user's training ratings, so the
+#      label never leaks into it
+#   3. an XGBClassifier with the `hist` tree method on all cores, fitted on each
+#      user's earlier ratings and evaluated on their latest VALIDATION_FRACTION
+#
+# Everything is seeded (Word2Vec runs single-threaded with a stable hash), so the
+# same datasets and parameters give the same models; only the Word2Vec files'
+# training log and duration differ between runs.
+
+LIKE_THRESHOLD = 4.0
+VALIDATION_FRACTION = 0.2
+RANKING_K = 10
+PROFILE_FOLDS = 5
+SEED = 42
+
+# Recommender variant -> whether it uses the director and keyword Word2Vec features
+VARIANTS = {'simple': False, 'w2v': True}
+
+WORD2VEC_PARAMS = {'vector_size': W2V_SIZE, 'window': 5, 'min_count': 1, 'sg': 0, 'epochs': 5}
+# 40 rounds at a learning rate of 0.2 score as well as the shipped 100 at 0.3 on
+# held-out ratings, and serving time grows with the number of trees
+XGBOOST_PARAMS = {'n_estimators': 40, 'max_depth': 6, 'learning_rate': 0.2, 'max_bin': 256, 'tree_method': 'hist'}
+
+
+def stable_hash(text):
+    # Word2Vec seeds its vectors with hash(word + seed); Python's str hash changes
+    # between processes, this one does not
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:4], 'little')
+
+
+def dataset_fingerprint(path):
+    # SHA-256 of the columns of an .npz dataset (the file's own bytes include zip timestamps)
+    digest = hashlib.sha256()
+    with np.load(path) as data:
+        for key in sorted(data.files):
+            array = data[key]
+            digest.update(f'{key}:{array.dtype.str}:{array.shape}'.encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def training_params(variant='w2v', seed=SEED, rounds=None):
+    params = {
+        'variant': variant,
+        'like_threshold': LIKE_THRESHOLD,
+        'validation_fraction': VALIDATION_FRACTION,
+        'profile_folds': PROFILE_FOLDS,
+        'ranking_k': RANKING_K,
+        'seed': seed,
+        'xgboost': dict(XGBOOST_PARAMS, n_estimators=rounds or XGBOOST_PARAMS['n_estimators']),
+    }
+    if VARIANTS[variant]:
+        params['word2vec'] = WORD2VEC_PARAMS
+    return params
+
+
+def params_fingerprint(params, data_hashes):
+    return hashlib.sha256(json.dumps([params, data_hashes], sort_keys=True).encode()).hexdigest()
+
+
+def train_word2vec(documents, seed=SEED):
+    sentences = [document.split() for document in documents if document]
+    model = Word2Vec(sentences, seed=seed, workers=1, hashfxn=stable_hash, **WORD2VEC_PARAMS)
+    # Only used to initialise the vectors; the saved model must not depend on this module
+    model.hashfxn = hash
+    return model
+
+
+def fit_tfidf(genres):
+    return TfidfVectorizer(stop_words='english').fit(genres)
+
+
+def feature_order(vectorizer, word2vec=True):
+    genres = list(vectorizer.get_feature_names_out())
+    names = ['movie_id', 'runtime', 'adult'] + genres
+    profile = PROFILE_FEATURES
+    if word2vec:
+        names += [f'{i+1}director' for i in range(W2V_SIZE)] + [f'{i+1}keyword' for i in range(W2V_SIZE)]
+    else:
+        profile = [name for name in PROFILE_FEATURES if name not in BLOCK_SIMILARITY.values()]
+    return names + profile + [f'user_{genre}' for genre in genres]
+
+
+def read_ratings(path, matrix):
+    # Ratings of the movies in the feature matrix, with their row in it and a validation flag
+    columns = load_columns(path)
+    ratings = pd.DataFrame({name: columns[name] for name in ('user_id', 'movie_id', 'rating', 'timestamp')})
+    ratings['row'] = ratings['movie_id'].map(matrix.movie_index)
+    ratings = ratings.dropna(subset=['row']).astype({'row': np.int64})
+
+    # Each user's latest ratings are held out
+    ratings = ratings.sort_values(['user_id', 'timestamp'], kind='stable').reset_index(drop=True)
+    position = ratings.groupby('user_id').cumcount()
+    count = ratings.groupby('user_id')['user_id'].transform('size')
+    ratings['validation'] = position >= np.ceil(count * (1 - VALIDATION_FRACTION))
+    ratings['liked'] = (ratings['rating'] >= LIKE_THRESHOLD).astype(np.int8)
+    return ratings
+
+
+def training_rows(matrix, ratings, seed=SEED):
+    # Profiles from each user's training ratings, one sparse product for all users. The
+    # training ratings are split into PROFILE_FOLDS random folds and a training row's
+    # profile leaves its fold out: with only its own rating left out, the user's mean
+    # rating would move against the label and the trees would learn to read it back
+    users, user_index = np.unique(ratings['user_id'].to_numpy(), return_inverse=True)
+    movie_rows = ratings['row'].to_numpy()
+    values = ratings['rating'].to_numpy(dtype=np.float32)
+    train = ~ratings['validation'].to_numpy()
+    profiles = UserProfiles.from_ratings(matrix, user_index[train], movie_rows[train], values[train], len(users))
+
+    # Validation rows go to an extra, empty fold: they see the whole training profile
+    folds = np.where(train, np.random.default_rng(seed).integers(PROFILE_FOLDS, size=len(values)), PROFILE_FOLDS)
+    buckets = user_index * (PROFILE_FOLDS + 1) + folds
+    fold_profiles = UserProfiles.from_ratings(matrix, buckets[train], movie_rows[train], values[train], len(users) * (PROFILE_FOLDS + 1))
+
+    features = matrix.features[movie_rows]
+    matrix.fill_profiles(features, profiles.take(user_index).without(fold_profiles.take(buckets)), movie_rows)
+    return features
+
+
+def ranking_metrics(user_ids, labels, scores, k=RANKING_K):
+    # precision@k and NDCG@k of each user's held-out movies ranked by score, averaged
+    # over the users with at least one liked movie among them
+    frame = pd.DataFrame({'user_id': user_ids, 'label': labels, 'score': scores})
+    frame = frame[frame.groupby('user_id')['label'].transform('max') > 0]
+    if frame.empty:
+        return {f'precision@{k}': None, f'ndcg@{k}': None, 'ranked_users': 0}
+    frame = frame.sort_values(['user_id', 'score'], ascending=[True, False], kind='stable')
+    frame['rank'] = frame.groupby('user_id').cumcount()
+    top = frame[frame['rank'] < k]
+
+    gains = top['label'] / np.log2(top['rank'] + 2)
+    dcg = gains.groupby(top['user_id']).sum()
+    discounts = np.cumsum(1 / np.log2(np.arange(k) + 2))
+    ideal = frame.groupby('user_id')['label'].sum().clip(upper=k).map(lambda liked: discounts[liked - 1])
+    precision = top.groupby('user_id')['label'].mean()
+    return {
+        f'precision@{k}': float(precision.mean()),
+        f'ndcg@{k}': float((dcg / ideal).mean()),
+        'ranked_users': int(len(dcg)),
+    }
+
+
+def train(movies_path, ratings_path, variant='w2v', seed=SEED, rounds=None, log=None):
+    # Returns the trained artifacts, the feature matrix, metrics and per-step timings
+    log = log or (lambda message: None)
+    params = training_params(variant, seed, rounds)
+    word2vec = VARIANTS[variant]
+    timings = {}
+
+    start = time.perf_counter()
+    movie_df = read_movie_dataset(movies_path)
+    w2v_director = train_word2vec(movie_df['directors'], seed) if word2vec else None
+    w2v_keyword = train_word2vec(movie_df['keywords'], seed) if word2vec else None
+    vectorizer = fit_tfidf(movie_df['genres'])
+    timings['word2vec_tfidf'] = time.perf_counter() - start
+    log(f'{"Word2Vec and TF-IDF" if word2vec else "TF-IDF"} fitted on {len(movie_df)} movies in {timings["word2vec_tfidf"]:.1f} s')
+
+    start = time.perf_counter()
+    matrix = build_feature_matrix(movie_df, feature_order(vectorizer, word2vec), vectorizer, w2v_director, w2v_keyword)
+    ratings = read_ratings(ratings_path, matrix)
+    validation = ratings['validation'].to_numpy()
+    features = training_rows(matrix, ratings, seed)
+    labels = ratings['liked'].to_numpy()
+    timings['features'] = time.perf_counter() - start
+    log(f'Built {features.shape[0]}x{features.shape[1]} training features in {timings["features"]:.1f} s')
+
+    start = time.perf_counter()
+    model = XGBClassifier(**params['xgboost'], random_state=seed, n_jobs=os.cpu_count())
+    model.fit(features[~validation], labels[~validation])
+    # build_feature_matrix lays the served matrix out by the booster's feature names
+    model.get_booster().feature_names = matrix.feature_names
+    timings['xgboost'] = time.perf_counter() - start
+    log(f'XGBoost fitted on {int((~validation).sum())} ratings in {timings["xgboost"]:.1f} s')
+
+    start = time.perf_counter()
+    metrics = {'train_rows': int((~validation).sum()), 'validation_rows': int(validation.sum())}
+    if validation.any():
+        scores = model.predict_proba(features[validation])[:, 1]
+        held_out = labels[validation]
+        metrics['logloss'] = float(log_loss(held_out, scores, labels=[0, 1]))
+        metrics['auc'] = float(roc_auc_score(held_out, scores)) if len(set(held_out.tolist())) == 2 else None
+        metrics.update(ranking_metrics(ratings['user_id'].to_numpy()[validation], held_out, scores))
+    timings['evaluation'] = time.perf_counter() - start
+
+    # Introspection and caching attributes of the vectorizer that pickle differently on every run
+    vectorizer.stop_words_ = None
+    vars(vectorizer).pop('_stop_words_id', None)
+
+    return {
+        'params': params,
+        'model': model,
+        'vectorizer': vectorizer,
+        'w2v_director': w2v_director,
+        'w2v_keyword': w2v_keyword,
+        'matrix': matrix,
+        'metrics': metrics,
+        'timings': timings,
+    }
@@ -1,13 +1,11 @@
-import joblib
 import pandas as pd
 from api.models import Movie, Rating, GenericUser
-from xgboost import XGBClassifier
+from api.algorithms.registry import registry
 
 def recommend_movies(username, top_n=10):
-    # Load the model and vectorizer
-    model = XGBClassifier()
-    model.load_model("api/algorithms/MC_rec.json")
-    vectorizer = joblib.load("api/algorithms/tfidf.joblib")
+    # Get the model and vectorizer (loaded once per worker)
+    model = registry.get('xgboost_simple')
+    vectorizer = registry.get('tfidf_simple')
 
     # Retrieve user info
     user = GenericUser.objects.get(username=username)
@@ -1,17 +1,14 @@
-import joblib
 import pandas as pd
 import numpy as np
 from api.models import Movie, Rating, GenericUser
-from xgboost import XGBClassifier
-from gensim.models import Word2Vec
+from api.algorithms.registry import registry
 
 def recommend_movies(username, top_n=10):
-    # Load the model, vectorizer, and Word2Vec models
-    model = XGBClassifier()
-    model.load_model("api/algorithms/mc_rec_w2v.json")
-    vectorizer = joblib.load("api/algorithms/tfidf_w2v.joblib")
-    w2v_director = Word2Vec.load("api/algorithms/Word2Vec_director")
-    w2v_keyword = Word2Vec.load("api/algorithms/Word2Vec_keyword")
+    # Get the model, vectorizer, and Word2Vec models (loaded once per worker)
+    model = registry.get('xgboost_w2v')
+    vectorizer = registry.get('tfidf_w2v')
+    w2v_director = registry.get('w2v_director')
+    w2v_keyword = registry.get('w2v_keyword')
 
     # Retrieve user info and their rated movie IDs
     user = GenericUser.objects.get(username=username)
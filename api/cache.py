@@ -0,0 +1,118 @@
+import uuid
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from .models import CacheVersion
+
+# Shared response cache for data that is the same for every user (movie pages,
+# similar movie lists, popular lists). Each entry is keyed by the versions of the
+# data it depends on, e.g. 'movie:5' or 'catalog'. Bumping a version (see
+# api/signals.py) makes every entry built from the old version unreachable, so
+# nothing has to be deleted explicitly; stale entries simply expire.
+#
+# The versions are kept in the cache next to the entries, so a warm hit never
+# touches the database. A bump stores a new random version, so a version that was
+# evicted restarts at a value no old entry was stored under.
+#
+# A per-process backend (the default local memory cache) cannot share versions
+# between gunicorn workers, the worker services and management commands. With it
+# a bump is also written to the CacheVersion table, and each process keeps its
+# copy of a version for VERSION_TIMEOUT seconds before reading it again, so a bump
+# made elsewhere is seen within that time. With a shared backend (file or Redis)
+# the table is not used and a bump is seen by every process at once.
+#
+# The backend is configured with CACHE_URL in settings.py: local memory by
+# default, or a file / Redis cache shared by all gunicorn workers.
+
+DEFAULT_TIMEOUT = 60 * 60
+MISSING = object()
+
+# Version of a namespace that was never bumped
+INITIAL_VERSION = '0'
+
+# How long a per-process backend keeps a version before reading the table again
+VERSION_TIMEOUT = 5
+
+
+def shared_versions():
+    return not isinstance(caches['default'], LocMemCache)
+
+
+def version_key(namespace):
+    return f'version:{namespace}'
+
+
+def get_versions(namespaces):
+    keys = {namespace: version_key(namespace) for namespace in namespaces}
+    versions = cache.get_many(list(keys.values()))
+    missing = {namespace for namespace, key in keys.items() if key not in versions}
+    if missing:
+        if shared_versions():
+            # Evicted (or never bumped): start at a fresh version. add() keeps a
+            # version another process stored in the meantime
+            for namespace in missing:
+                cache.add(keys[namespace], uuid.uuid4().hex, None)
+            versions.update(cache.get_many([keys[namespace] for namespace in missing]))
+        else:
+            stored = dict(CacheVersion.objects.filter(namespace__in=missing).values_list('namespace', 'version'))
+            fresh = {keys[namespace]: stored.get(namespace, INITIAL_VERSION) for namespace in missing}
+            cache.set_many(fresh, VERSION_TIMEOUT)
+            versions.update(fresh)
+    return [versions[keys[namespace]] for namespace in namespaces]
+
+
+def bump_version(*namespaces):
+    if not namespaces:
+        return
+    versions = {namespace: uuid.uuid4().hex for namespace in set(namespaces)}
+    if shared_versions():
+        cache.set_many({version_key(namespace): version for namespace, version in versions.items()}, None)
+        return
+    CacheVersion.objects.bulk_create(
+        [CacheVersion(namespace=namespace, version=version) for namespace, version in versions.items()],
+        update_conflicts=True, unique_fields=['namespace'], update_fields=['version'],
+    )
+    cache.set_many({version_key(namespace): version for namespace, version in versions.items()}, VERSION_TIMEOUT)
+
+
+def build_key(name, depends_on):
+    versions = '.'.join(str(version) for version in get_versions(depends_on))
+    return f'response:{name}:{versions}'
+
+
+def record(outcome):
+    try:
+        cache.incr(f'stats:{outcome}')
+    except ValueError:
+        cache.add(f'stats:{outcome}', 0, None)
+        cache.incr(f'stats:{outcome}')
+
+
+def cache_get(key):
+    value = cache.get(key, MISSING)
+    record('misses' if value is MISSING else 'hits')
+    return value
+
+
+def cache_set(key, value, timeout=DEFAULT_TIMEOUT):
+    cache.set(key, value, timeout)
+
+
+def cached(name, depends_on, builder, timeout=DEFAULT_TIMEOUT):
+    # Returns the cached value or builds and stores it; builders returning None are not cached
+    key = build_key(name, depends_on)
+    value = cache_get(key)
+    if value is MISSING:
+        value = builder()
+        if value is not None:
+            cache_set(key, value, timeout)
+    return value
+
+
+def cache_stats():
+    stats = cache.get_many(['stats:hits', 'stats:misses'])
+    hits, misses = stats.get('stats:hits', 0), stats.get('stats:misses', 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+    }
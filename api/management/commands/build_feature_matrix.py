@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.algorithms.features import read_movie_csv, build_feature_matrix
+from api.algorithms.datasets import read_movie_dataset
+from api.algorithms.registry import registry
+import time
+
+class Command(BaseCommand):
+    help = 'Precompute the item feature matrices used by the XGBoost recommenders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--static-csv', type=str, default=str(settings.BASE_DIR / 'data' / 'xgboost_static_data.csv'),
+                            help='Movie data for the simple model')
+        parser.add_argument('--enhanced-csv', type=str, default=str(settings.BASE_DIR / 'data' / 'xgboost_enhanced_data.csv'),
+                            help='Movie data for the Word2Vec model')
+        parser.add_argument('--movies', type=str,
+                            help='movies.npz written by export_datasets; replaces both CSVs')
+
+    def read_movies(self, path, options):
+        try:
+            return read_movie_dataset(options['movies']) if options['movies'] else read_movie_csv(path)
+        except FileNotFoundError:
+            raise CommandError(f'File "{options["movies"] or path}" does not exist')
+
+    def handle(self, *args, **options):
+        # Simple model: movie_id, runtime, adult, user_id and genre TF-IDF
+        start = time.perf_counter()
+        movie_df = self.read_movies(options['static_csv'], options)
+        model = registry.get('xgboost_simple')
+        matrix = build_feature_matrix(movie_df, model.get_booster().feature_names, registry.get('tfidf_simple'))
+        path = registry.path('features_simple')
+        matrix.save(path)
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {matrix.features.shape[0]}x{matrix.features.shape[1]} feature matrix to {path} in {time.perf_counter() - start:.2f}s'))
+
+        # Word2Vec model: adds director and keyword Word2Vec means
+        start = time.perf_counter()
+        movie_df = self.read_movies(options['enhanced_csv'], options)
+        try:
+            w2v_director = registry.get('w2v_director')
+            w2v_keyword = registry.get('w2v_keyword')
+        except FileNotFoundError as e:
+            raise CommandError(f'Missing Word2Vec model: {e.filename}')
+        model = registry.get('xgboost_w2v')
+        matrix = build_feature_matrix(movie_df, model.get_booster().feature_names, registry.get('tfidf_w2v'), w2v_director, w2v_keyword)
+        path = registry.path('features_w2v')
+        matrix.save(path)
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {matrix.features.shape[0]}x{matrix.features.shape[1]} feature matrix to {path} in {time.perf_counter() - start:.2f}s'))
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from api.algorithms.recommendations import generate_recommendations, TOP_N
+from api.models import Rating
+import datetime
+import time
+
+User = get_user_model()
+
+class Command(BaseCommand):
+    help = 'Batch score users and store their top-N recommendations in the UserRecommendation table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', nargs='+', type=str, help='Only score these usernames')
+        parser.add_argument('--since', type=str, help='Only score users who rated a movie since this date/datetime (ISO 8601)')
+        parser.add_argument('--workers', type=int, default=1, help='Number of chunks scored in parallel')
+        parser.add_argument('--chunk-size', type=int, default=16, help='Number of users scored per model call')
+        parser.add_argument('--top-n', type=int, default=TOP_N, help='Number of recommendations stored per user')
+
+    def parse_since(self, value):
+        since = parse_datetime(value)
+        if since is None:
+            date = parse_date(value)
+            if date is None:
+                raise CommandError(f'Invalid --since value "{value}"')
+            since = datetime.datetime.combine(date, datetime.time.min)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    def score_chunk(self, user_ids, top_n):
+        # Runs in a worker thread, which gets its own database connection
+        try:
+            return generate_recommendations(user_ids, top_n)
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['users']:
+            users = users.filter(username__in=options['users'])
+        if options['since']:
+            since = self.parse_since(options['since'])
+            users = users.filter(id__in=Rating.objects.filter(timestamp__gte=since).values('user_id'))
+
+        user_ids = list(users.order_by('id').values_list('id', flat=True))
+        if not user_ids:
+            self.stdout.write(self.style.WARNING('No users to score.'))
+            return
+
+        chunk_size = max(options['chunk_size'], 1)
+        chunks = [user_ids[i:i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+        self.stdout.write(f'Scoring {len(user_ids)} users in {len(chunks)} chunks with {options["workers"]} workers...')
+
+        start = time.perf_counter()
+        rows_written = 0
+        with ThreadPoolExecutor(max_workers=max(options['workers'], 1)) as executor:
+            results = executor.map(lambda chunk: self.score_chunk(chunk, options['top_n']), chunks)
+            for index, rows in enumerate(results, start=1):
+                rows_written += rows
+                self.stdout.write(f'Chunk {index}/{len(chunks)} done ({rows} recommendations)')
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {rows_written} recommendations for {len(user_ids)} users in {elapsed:.1f}s '
+            f'({len(user_ids) / elapsed:.1f} users/s).'))
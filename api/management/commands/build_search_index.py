@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.search import get_backend
+import time
+
+class Command(BaseCommand):
+    help = 'Creates the movie full-text search index (Postgres tsvector + pg_trgm, or SQLite FTS5) and indexes every movie'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        start = time.perf_counter()
+        with transaction.atomic():
+            backend.install()
+            indexed = backend.index()
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {indexed} movies with {type(backend).__name__} in {time.perf_counter() - start:.1f} s'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.algorithms.SVD_cosine_sim import get_user_factors_items_factors
+from api.algorithms.registry import registry
+import time
+
+class Command(BaseCommand):
+    help = 'Fit the SVD recommender on the sparse user-item rating matrix and save its factors'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--components', type=int, default=20, help='Number of latent factors')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            factors = get_user_factors_items_factors(options['components'])
+        except ValueError as e:
+            raise CommandError(f'Could not fit SVD factors: {e}')
+
+        path = registry.path('svd_factors')
+        factors.save(path)
+        self.stdout.write(self.style.SUCCESS(
+            f'Saved {len(factors.user_ids)} user and {len(factors.movie_ids)} item factors to {path} '
+            f'in {time.perf_counter() - start:.2f}s'))
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.algorithms.datasets import export_movies, export_ratings, CHUNK_SIZE
+import os
+import time
+
+class Command(BaseCommand):
+    help = 'Export the movie and rating training datasets as typed columnar .npz files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', type=str, default=str(settings.BASE_DIR / 'data'), help='Where to write movies.npz and ratings.npz')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows fetched from the database per chunk')
+        parser.add_argument('--skip-ratings', action='store_true', help='Only export movies.npz')
+
+    def handle(self, *args, **options):
+        # movies.npz holds everything the old build_datasets, build_w2v_dataset and
+        # build_xgboost_data CSVs did (see api/algorithms/datasets.py for the format).
+        # Files are written under a temporary name and renamed, so readers never see a partial export
+        output_dir = options['output_dir']
+        if not os.path.isdir(output_dir):
+            raise CommandError(f'Directory "{output_dir}" does not exist')
+
+        exports = [('movies', export_movies)]
+        if not options['skip_ratings']:
+            exports.append(('ratings', export_ratings))
+
+        for name, export in exports:
+            path = os.path.join(output_dir, f'{name}.npz')
+            partial = os.path.join(output_dir, f'.{name}.partial.npz')
+            start = time.perf_counter()
+            try:
+                rows = export(partial, options['chunk_size'])
+            except BaseException:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            os.replace(partial, path)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(self.style.SUCCESS(
+                f'Exported {rows} {name} to {path} in {elapsed:.1f} s ({rows / max(elapsed, 1e-9) * 60:,.0f} rows/min, '
+                f'{os.path.getsize(path) / 2 ** 20:.1f} MiB).'
+            ))
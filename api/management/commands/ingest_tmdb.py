@@ -0,0 +1,184 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q, Exists, OuterRef
+from api.models import Movie, Actor, Director, Keyword
+from api.cache import bump_version
+from api.search import index_movies
+from api.tmdb import ResponseCache, fetch_movies, movie_metadata, credit_names, keyword_names, REQUESTS_PER_SECOND, CONCURRENCY
+import os
+import time
+
+PARTS = ('metadata', 'credits', 'keywords')
+
+# Rows per multi-row INSERT of through rows (two parameters each, under SQLite's limit of 999)
+LINKS_PER_INSERT = 400
+
+class Command(BaseCommand):
+    help = 'Fetch metadata, credits and keywords from the TMDb API for the movies missing them'
+
+    # The parts this command fetches; query_metadata, query_credits and query_keywords narrow it
+    parts = PARTS
+
+    def add_arguments(self, parser):
+        if len(self.parts) > 1:
+            parser.add_argument('--only', action='append', choices=self.parts, help='Only fetch this part (repeatable)')
+        parser.add_argument('--all', action='store_true', help='Refetch movies that already have the data')
+        parser.add_argument('--limit', type=int, help='Fetch at most this many movies')
+        parser.add_argument('--rate', type=float, default=REQUESTS_PER_SECOND, help='Requests per second across all connections')
+        parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='Requests in flight at once')
+        parser.add_argument('--base-url', type=str, help='TMDb API root (defaults to the TMDB_API_URL setting)')
+        parser.add_argument('--batch-size', type=int, default=200, help='Movies written per transaction')
+        parser.add_argument('--offline', action='store_true', help='Only use cached responses (no requests, no TMDB_KEY needed)')
+        parser.add_argument('--refresh', action='store_true', help='Revalidate cached responses even when they are fresh')
+        parser.add_argument('--no-cache', action='store_true', help='Neither read nor write the response cache')
+        parser.add_argument('--log-file', type=str, default=os.path.join('Logs', 'failed_tmdb_ids.txt'), help='Where to list the movies that failed')
+
+    def movies_to_fetch(self, parts, refetch):
+        # {tmdb_id: Movie pk} of the movies missing any of the requested parts, in one query
+        movies = Movie.objects.exclude(tmdb_id=None)
+        if not refetch:
+            missing = Q()
+            if 'metadata' in parts:
+                for field in ('poster_url', 'overview', 'runtime', 'release_date'):
+                    missing |= Q(**{f'{field}__isnull': True})
+                missing |= Q(poster_url='') | Q(overview='')
+            if 'credits' in parts:
+                missing |= ~Exists(Movie.actors.through.objects.filter(movie_id=OuterRef('pk'))) \
+                    & ~Exists(Movie.directors.through.objects.filter(movie_id=OuterRef('pk')))
+            if 'keywords' in parts:
+                missing |= ~Exists(Movie.keywords.through.objects.filter(movie_id=OuterRef('pk')))
+            movies = movies.filter(missing)
+        return dict(movies.order_by('id').values_list('tmdb_id', 'id'))
+
+    def insert_links(self, through, column, pairs):
+        # Multi-row INSERT ... ON CONFLICT DO NOTHING of (movie pk, related pk) pairs; at this
+        # volume building a model instance per row in bulk_create costs more than the insert
+        sql = f'INSERT INTO {through._meta.db_table} (movie_id, {column}) VALUES {{}} ON CONFLICT DO NOTHING'
+        with connection.cursor() as cursor:
+            for i in range(0, len(pairs), LINKS_PER_INSERT):
+                chunk = pairs[i:i + LINKS_PER_INSERT]
+                cursor.execute(sql.format(', '.join(['(%s, %s)'] * len(chunk))), [value for pair in chunk for value in pair])
+
+    def link(self, model, through, column, names_by_movie):
+        # Resolves the names of a batch to ids, creating the missing ones with one
+        # bulk_create(ignore_conflicts=True), then replaces the movies' links with them.
+        # Links are inserted in credit order: the movie page reads the first actor rows
+        # (by id) as the leads. Returns the links written
+        max_length = model._meta.get_field('name').max_length
+        names_by_movie = {
+            movie_pk: list(dict.fromkeys(name[:max_length] for name in names))
+            for movie_pk, names in names_by_movie.items() if names
+        }
+        names = set().union(*names_by_movie.values())
+        if not names:
+            return 0
+        ids = dict(model.objects.filter(name__in=names).values_list('name', 'id'))
+        missing = names - ids.keys()
+        if missing:
+            model.objects.bulk_create([model(name=name) for name in missing], ignore_conflicts=True)
+            ids.update(model.objects.filter(name__in=missing).values_list('name', 'id'))
+        pairs = [(movie_pk, ids[name]) for movie_pk, movie_names in names_by_movie.items() for name in movie_names]
+        # A refetch (--all) rewrites the links so their order follows TMDb again
+        through.objects.filter(movie_id__in=list(names_by_movie)).delete()
+        self.insert_links(through, column, pairs)
+        return len(pairs)
+
+    @transaction.atomic
+    def apply_batch(self, batch, parts):
+        # batch: {Movie pk: TMDb response}; returns the number of through rows written
+        rows = 0
+        if 'metadata' in parts:
+            # One executemany; bulk_update's CASE WHEN per field and row is slower to build than to run
+            rows_by_movie = {movie_pk: movie_metadata(data) for movie_pk, data in batch.items()}
+            fields = list(next(iter(rows_by_movie.values())))
+            columns = ', '.join(f'{Movie._meta.get_field(field).column} = %s' for field in fields)
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f'UPDATE {Movie._meta.db_table} SET {columns} WHERE id = %s',
+                    [[metadata[field] for field in fields] + [movie_pk] for movie_pk, metadata in rows_by_movie.items()],
+                )
+        if 'credits' in parts:
+            credits = {movie_pk: credit_names(data) for movie_pk, data in batch.items()}
+            rows += self.link(Actor, Movie.actors.through, 'actor_id', {pk: actors for pk, (actors, _) in credits.items()})
+            rows += self.link(Director, Movie.directors.through, 'director_id', {pk: directors for pk, (_, directors) in credits.items()})
+        if 'keywords' in parts:
+            rows += self.link(Keyword, Movie.keywords.through, 'keyword_id', {pk: keyword_names(data) for pk, data in batch.items()})
+        return rows
+
+    def handle(self, *args, **options):
+        api_key = os.getenv('TMDB_KEY')
+        if not api_key and not options['offline']:
+            raise CommandError('TMDB_KEY environment variable not found.')
+        if options['offline'] and options['no_cache']:
+            raise CommandError('--offline needs the response cache.')
+        cache = None if options['no_cache'] else ResponseCache()
+
+        parts = tuple(options.get('only') or self.parts)
+        movies = self.movies_to_fetch(parts, options['all'])
+        tmdb_ids = list(movies)[:options['limit']]
+        self.stdout.write(f'Fetching {", ".join(parts)} for {len(tmdb_ids)} movies...')
+
+        start = time.perf_counter()
+        stats = {}
+        not_found = rows = 0
+        write_seconds = 0.0
+        failed = []
+        updated = []
+        batch = {}
+
+        def flush():
+            nonlocal rows, write_seconds
+            write_start = time.perf_counter()
+            rows += self.apply_batch(batch, parts)
+            write_seconds += time.perf_counter() - write_start
+            updated.extend(batch)
+            batch.clear()
+
+        results = fetch_movies(
+            tmdb_ids, api_key, stats=stats, base_url=options['base_url'], rate=options['rate'],
+            concurrency=options['concurrency'], append=[part for part in parts if part != 'metadata'],
+            cache=cache, offline=options['offline'], refresh=options['refresh'],
+        )
+        for done, (tmdb_id, data, error) in enumerate(results, 1):
+            if error:
+                failed.append((tmdb_id, error))
+                self.stdout.write(self.style.ERROR(f'Failed to fetch tmdb_id {tmdb_id}: {error}'))
+            elif data is None:
+                not_found += 1
+                failed.append((tmdb_id, 'not found'))
+            else:
+                batch[movies[tmdb_id]] = data
+                if len(batch) >= options['batch_size']:
+                    flush()
+            if done % 500 == 0:
+                self.stdout.write(f'{done}/{len(tmdb_ids)} movies ({done / (time.perf_counter() - start):.1f} movies/s)')
+        if batch:
+            flush()
+
+        # The bulk writes skip the model signals: reindex search (overviews and keywords)
+        # and invalidate the cached pages of the updated movies
+        if updated:
+            if 'metadata' in parts or 'keywords' in parts:
+                index_movies(updated if len(updated) <= options['batch_size'] else None)
+            bump_version('popular', 'catalog', *[f'movie:{pk}' for pk in updated])
+
+        elapsed = time.perf_counter() - start
+        if cache is not None:
+            cache.close()
+        if failed:
+            with open(options['log_file'], 'w') as log_file:
+                log_file.writelines(f'{tmdb_id}: {error}\n' for tmdb_id, error in failed)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Update completed. {len(updated)} movies updated in {elapsed:.1f} s '
+            f'({len(tmdb_ids) / max(elapsed, 1e-9):.1f} movies/s, {stats.get("requests", 0)} requests, {stats.get("retries", 0)} retries, '
+            f'{stats.get("cache_hits", 0)} served from cache, {stats.get("revalidated", 0)} revalidated).'
+        ))
+        self.stdout.write(
+            f'Database writes: {rows} credit/keyword links in {write_seconds:.1f} s '
+            f'({len(updated) / max(write_seconds, 1e-9):.0f} movies/s, {rows / max(write_seconds, 1e-9):.0f} links/s).'
+        )
+        if failed:
+            self.stdout.write(self.style.WARNING(
+                f'{len(failed)} movies failed to update ({not_found} not found on TMDb). Check {options["log_file"]} for details.'
+            ))
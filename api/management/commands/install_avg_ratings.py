@@ -1,13 +1,37 @@
 from django.core.management.base import BaseCommand
-from django.db.models import Avg
+from django.db import transaction
+from django.db.models import Count, Sum
 from api.models import Movie, Rating
+from api.cache import bump_version
+from api.algorithms.popularity import update_all_popularity
 
 class Command(BaseCommand):
-    help = 'Calculates average ratings for each movie and updates the database'
+    help = 'Calculates rating counts, sums, average ratings and popularity scores for every movie in one pass and updates the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Movies written per UPDATE batch')
 
     def handle(self, *args, **options):
-        for movie in Movie.objects.all():
-            average = movie.movie_ratings.aggregate(avg_rating=Avg('rating'))['avg_rating']
-            movie.avg_rating = average
-            movie.save()
-            self.stdout.write(self.style.SUCCESS(f'Successfully updated avg_rating for {movie.title} as {average}'))
+        # One GROUP BY over the ratings table instead of one aggregate per movie
+        totals = {
+            row['movie_id']: (row['count'], row['total'])
+            for row in Rating.objects.values('movie_id').annotate(count=Count('id'), total=Sum('rating')).order_by()
+        }
+
+        movies = list(Movie.objects.only('id', 'rating_count', 'rating_sum', 'avg_rating'))
+        changed = []
+        for movie in movies:
+            count, total = totals.get(movie.id, (0, 0.0))
+            average = total / count if count else None
+            if (movie.rating_count, movie.rating_sum, movie.avg_rating) != (count, total, average):
+                movie.rating_count, movie.rating_sum, movie.avg_rating = count, total, average
+                changed.append(movie)
+
+        with transaction.atomic():
+            Movie.objects.bulk_update(changed, ['rating_count', 'rating_sum', 'avg_rating'], batch_size=options['batch_size'])
+            update_all_popularity(options['batch_size'])
+        bump_version('popular', *[f'movie:{movie.pk}' for movie in changed])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully updated rating totals for {len(changed)} of {len(movies)} movies ({len(totals)} rated)'
+        ))
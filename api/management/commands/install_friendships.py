@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.models import FriendRequest, Friendship
+
+class Command(BaseCommand):
+    help = 'Rebuilds the Friendship table (both directions of every accepted friend request)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT batch')
+
+    def handle(self, *args, **options):
+        edges = {}
+        accepted = FriendRequest.objects.filter(accepted=True).order_by('id').values_list('id', 'from_user_id', 'to_user_id')
+        for request_id, from_user_id, to_user_id in accepted.iterator():
+            # The oldest accepted request of a pair wins, as in api/signals.py
+            edges.setdefault((from_user_id, to_user_id), request_id)
+            edges.setdefault((to_user_id, from_user_id), request_id)
+
+        with transaction.atomic():
+            Friendship.objects.all().delete()
+            Friendship.objects.bulk_create(
+                [Friendship(user_id=user_id, friend_id=friend_id, request_id=request_id) for (user_id, friend_id), request_id in edges.items()],
+                batch_size=options['batch_size'],
+            )
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully installed {len(edges) // 2} friendships'))
@@ -1,63 +1,97 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from api.models import Movie
+from api.cache import bump_version
 import csv
+import time
 
 class Command(BaseCommand):
     help = 'Updates movies tmdb_id from a CSV file'
 
     def add_arguments(self, parser):
         parser.add_argument('csv_file', type=str, help='Path to the CSV file containing movieId and tmdbId')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Movies written per UPDATE batch')
 
     def handle(self, *args, **kwargs):
 
-        # This script loops through links.csv and finds the corresponding movie_id in the database
-        # to update that movie's tmdb_id field
+        # This script reads links.csv and sets each movie's tmdb_id from its movie_id
         # We need to map each movie_id to a tmdb_id for fetching other metadata from TMDb API later
-
+        #
+        # The file is parsed once and checked in memory, then only the movies whose tmdb_id
+        # differs are written with bulk_update, so the import is idempotent and a rerun
+        # picks up where an interrupted one stopped
 
         csv_file_path = kwargs['csv_file']
-        updated_count = 0
+        start = time.perf_counter()
         not_found_count = 0
         error_count = 0
         duplicate_count = 0
 
+        links = {}
         try:
             with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
                 reader = csv.reader(csvfile)
                 next(reader)  # Skip the header row
-                for row in reader:
-                    movie_id, _, tmdb_id_str = row
-                    if tmdb_id_str.strip():
-                        try:
-                            tmdb_id = int(tmdb_id_str)
-                            # Check for existing tmdb_id in the database
-                            if Movie.objects.filter(tmdb_id=tmdb_id).exists():
-                                duplicate_count += 1
-                                self.stdout.write(self.style.ERROR(f'Duplicate tmdb_id "{tmdb_id}" found for movie_id {movie_id}. Skipping.'))
-                                continue
-                            movie = Movie.objects.get(movie_id=movie_id)
-                            movie.tmdb_id = tmdb_id
-                            movie.save()
-                            updated_count += 1
-                        except Movie.DoesNotExist:
-                            not_found_count += 1
-                            self.stdout.write(self.style.WARNING(f'Movie with movie_id {movie_id} not found.'))
-                        except ValueError:
-                            error_count += 1
-                            self.stdout.write(self.style.ERROR(f'Invalid tmdb_id "{tmdb_id_str}" for movie_id {movie_id}.'))
-                    else:
+                for movie_id, _, tmdb_id_str in reader:
+                    try:
+                        links[int(movie_id)] = int(tmdb_id_str)
+                    except ValueError:
                         error_count += 1
-                        self.stdout.write(self.style.ERROR(f'Empty tmdb_id for movie_id {movie_id}.'))
-
+                        if kwargs['verbosity'] > 1:
+                            self.stdout.write(self.style.ERROR(f'Invalid tmdb_id "{tmdb_id_str}" for movie_id {movie_id}.'))
         except FileNotFoundError:
             raise CommandError('File "%s" does not exist' % csv_file_path)
 
-        self.stdout.write(self.style.SUCCESS(f'Successfully updated {updated_count} movies.'))
+        movies = {movie.movie_id: movie for movie in Movie.objects.exclude(movie_id=None).only('id', 'movie_id', 'tmdb_id')}
+        # tmdb_ids held by movies the file does not reassign stay reserved
+        claimed = {movie.tmdb_id: movie.movie_id for movie in movies.values() if movie.tmdb_id is not None and movie.movie_id not in links}
+
+        targets = {}
+        for movie_id, tmdb_id in links.items():
+            movie = movies.get(movie_id)
+            if movie is None:
+                not_found_count += 1
+                if kwargs['verbosity'] > 1:
+                    self.stdout.write(self.style.WARNING(f'Movie with movie_id {movie_id} not found.'))
+                continue
+            if tmdb_id in claimed:
+                # Another row of the file, or a movie outside it, already has this tmdb_id
+                duplicate_count += 1
+                self.stdout.write(self.style.ERROR(f'Duplicate tmdb_id "{tmdb_id}" found for movie_id {movie_id}. Skipping.'))
+                continue
+            claimed[tmdb_id] = movie_id
+            if movie.tmdb_id != tmdb_id:
+                targets[movie] = tmdb_id
+
+        # A skipped movie keeps its current tmdb_id; drop the updates that would collide with it
+        while True:
+            kept = {movie.tmdb_id for movie in movies.values() if movie not in targets and movie.tmdb_id is not None}
+            colliding = [movie for movie, tmdb_id in targets.items() if tmdb_id in kept]
+            if not colliding:
+                break
+            for movie in colliding:
+                duplicate_count += 1
+                del targets[movie]
+
+        changed = list(targets)
+        for movie, tmdb_id in targets.items():
+            movie.tmdb_id = tmdb_id
+
+        batch_size = kwargs['batch_size']
+        with transaction.atomic():
+            # Clear the changed rows first so swapped tmdb_ids never collide on the unique index
+            for i in range(0, len(changed), batch_size):
+                Movie.objects.filter(pk__in=[movie.pk for movie in changed[i:i + batch_size]]).update(tmdb_id=None)
+            Movie.objects.bulk_update(changed, ['tmdb_id'], batch_size=batch_size)
+        bump_version(*[f'movie:{movie.pk}' for movie in changed])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully updated {len(changed)} movies ({len(links) - len(changed) - not_found_count - duplicate_count} already linked) '
+            f'in {time.perf_counter() - start:.1f} s.'
+        ))
         if not_found_count > 0:
             self.stdout.write(self.style.WARNING(f'{not_found_count} movies not found and were skipped.'))
         if error_count > 0:
             self.stdout.write(self.style.ERROR(f'{error_count} rows had invalid tmdb_id values and were skipped.'))
         if duplicate_count > 0:
             self.stdout.write(self.style.ERROR(f'{duplicate_count} rows had duplicate tmdb_id values and were skipped.'))
-
-
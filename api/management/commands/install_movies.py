@@ -1,99 +1,93 @@
 import csv
-from datetime import datetime
-from django.core.management.base import BaseCommand
-from django.contrib.auth import get_user_model
+import time
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from api.models import Movie, Genre, Rating
-
-User = get_user_model()
+from api.models import Movie, Genre
+from api.cache import bump_version
+from api.search import index_movies
 
 class Command(BaseCommand):
-    help = 'Efficiently import movies, links, and ratings from CSV files'
+    help = 'Import movies and their genres from a MovieLens movies CSV file in bulk'
 
     def add_arguments(self, parser):
         parser.add_argument('movies_file', type=str)
-        # parser.add_argument('links_file', type=str)
-        # parser.add_argument('ratings_file', type=str)
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT/UPDATE batch')
 
     def handle(self, *args, **options):
         self.stdout.write(self.style.SUCCESS('Starting import process...'))
-        
-        # Uncomment when ready
-        # self.import_movies(options['movies_file'])
+        start = time.perf_counter()
 
         # Adds all movies and their genres from movies.csv
         # movies.csv is the local pool of movies we want to work with in this project
         # This csv only gives us the movieId, title, and genres for each movie
+        try:
+            created, updated, genres_added, genres_removed = self.import_movies(options['movies_file'], options['batch_size'])
+        except FileNotFoundError:
+            raise CommandError('File "%s" does not exist' % options['movies_file'])
 
-        # self.update_movies_with_tmdb(options['links_file'])
-        # self.import_ratings(options['ratings_file'])
-        self.stdout.write(self.style.SUCCESS('Finished importing data.'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Finished importing data: {created} movies created, {updated} retitled, '
+            f'{genres_added} genre links added and {genres_removed} removed in {time.perf_counter() - start:.1f} s.'
+        ))
 
     @transaction.atomic
-    def import_movies(self, movies_file):
-        genres_dict = {genre.name: genre for genre in Genre.objects.all()}
-        movies_list = []
-        movie_genres_relations = []
-
+    def import_movies(self, movies_file, batch_size):
+        # Set-based and idempotent: the file is parsed once, then the movies, genres and
+        # movie-genre links that differ from the database are written with bulk queries,
+        # so rerunning an interrupted or repeated import only applies what is missing
+        titles = {}
+        movie_genres = {}
         with open(movies_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                movie = Movie(movie_id=row['movieId'], title=row['title'])
-                movies_list.append(movie)
-                for genre_name in row['genres'].split('|'):
-                    if genre_name not in genres_dict:
-                        genre = Genre.objects.create(name=genre_name)
-                        genres_dict[genre_name] = genre
-                    movie_genres_relations.append((row['movieId'], genre_name))
-
-        Movie.objects.bulk_create(movies_list, ignore_conflicts=True)
-
-        # After movies are created, fetch them to create M2M relations
-        movies_dict = {movie.movie_id: movie for movie in Movie.objects.all()}
-        for movie_id, genre_name in movie_genres_relations:
-            movie = movies_dict[int(movie_id)]
-            genre = genres_dict[genre_name]
-            movie.genres.add(genre)
-
-    # @transaction.atomic
-    # def update_movies_with_tmdb(self, links_file):
-    #     with open(links_file, 'r', encoding='utf-8') as f:
-    #         reader = csv.DictReader(f)
-    #         for row in reader:
-    #             tmdb_id_str = row['tmdbId'].strip()
-    #             if tmdb_id_str:  # Check if tmdbId is not an empty string
-    #                 try:
-    #                     tmdb_id = int(tmdb_id_str)
-    #                     Movie.objects.filter(movie_id=row['movieId']).update(tmdb_id=tmdb_id)
-    #                 except ValueError as e:
-    #                     self.stdout.write(self.style.ERROR(f"Invalid tmdbId '{tmdb_id_str}' for movieId {row['movieId']}: {e}"))
-    #             else:
-    #                 self.stdout.write(self.style.WARNING(f"No tmdbId for movieId {row['movieId']}. Skipping."))
+            for row in csv.DictReader(f):
+                movie_id = int(row['movieId'])
+                titles[movie_id] = row['title']
+                movie_genres[movie_id] = {name for name in row['genres'].split('|') if name}
 
-    # @transaction.atomic
-    # def import_ratings(self, ratings_file):
-    #     users_dict = {}
-    #     ratings_list = []
+        names = set().union(*movie_genres.values())
+        Genre.objects.bulk_create([Genre(name=name) for name in names], ignore_conflicts=True)
+        genres_dict = dict(Genre.objects.filter(name__in=names).values_list('name', 'id'))
 
-    #     with open(ratings_file, 'r', encoding='utf-8') as f:
-    #         reader = csv.DictReader(f)
-    #         for row in reader:
-    #             if row['userId'] not in users_dict:
-    #                 # Create a user with a dummy email and default password
-    #                 user, created = User.objects.get_or_create(
-    #                     username=f"user_{row['userId']}",
-    #                     defaults={'email': f"user_{row['userId']}@example.com"}
-    #                 )
-    #                 if created:
-    #                     user.set_password('default_password')
-    #                     user.save()
-    #                 users_dict[row['userId']] = user
-    #             else:
-    #                 user = users_dict[row['userId']]
-    #             movie = Movie.objects.get(movie_id=row['movieId'])
-    #             timestamp = datetime.fromtimestamp(int(row['timestamp']))
-    #             rating_value = int(float(row['rating']))
-    #             ratings_list.append(Rating(user=user, movie=movie, rating=rating_value, timestamp=timestamp))
+        movies_dict = {movie.movie_id: movie for movie in Movie.objects.exclude(movie_id=None).only('id', 'movie_id', 'title')}
+        new_movies = Movie.objects.bulk_create(
+            [Movie(movie_id=movie_id, title=title) for movie_id, title in titles.items() if movie_id not in movies_dict],
+            batch_size=batch_size,
+        )
+        retitled = [movie for movie in movies_dict.values() if movie.movie_id in titles and movie.title != titles[movie.movie_id]]
+        for movie in retitled:
+            movie.title = titles[movie.movie_id]
+        Movie.objects.bulk_update(retitled, ['title'], batch_size=batch_size)
+        movies_dict.update((movie.movie_id, movie) for movie in new_movies)
 
-    #     Rating.objects.bulk_create(ratings_list, ignore_conflicts=True)
+        # Diff the movie-genre links of the movies in the file against it in memory
+        through = Movie.genres.through
+        listed = {movies_dict[movie_id].pk for movie_id in titles}
+        stored = {
+            (movie_pk, genre_id): link_id
+            for link_id, movie_pk, genre_id in through.objects.values_list('id', 'movie_id', 'genre_id').iterator(chunk_size=10000)
+            if movie_pk in listed
+        }
+        wanted = {
+            (movies_dict[movie_id].pk, genres_dict[name])
+            for movie_id, genre_names in movie_genres.items()
+            for name in genre_names
+        }
+        added = wanted - stored.keys()
+        stale = [stored[link] for link in stored.keys() - wanted]
+        through.objects.bulk_create(
+            [through(movie_id=movie_pk, genre_id=genre_id) for movie_pk, genre_id in added],
+            batch_size=batch_size, ignore_conflicts=True,
+        )
+        for i in range(0, len(stale), batch_size):
+            through.objects.filter(id__in=stale[i:i + batch_size]).delete()
 
+        # Bulk writes skip the model signals: index the new and retitled movies for search
+        # and invalidate the cached pages of the movies that changed
+        relinked = {movie_pk for movie_pk, _ in added} | {movie_pk for movie_pk, _ in stored.keys() - wanted}
+        changed = {movie.pk for movie in new_movies} | {movie.pk for movie in retitled} | relinked
+        if changed:
+            transaction.on_commit(lambda: bump_version('catalog', 'popular', *[f'movie:{pk}' for pk in changed]))
+        if new_movies or retitled:
+            # A large import reindexes everything in one statement instead of listing the ids
+            reindex = [movie.pk for movie in new_movies + retitled]
+            index_movies(reindex if len(reindex) <= batch_size else None)
+        return len(new_movies), len(retitled), len(added), len(stale)
@@ -1,60 +1,117 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth import get_user_model
-from api.models import Movie, Rating
-import csv
-from datetime import datetime
-import pytz
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from api.models import Movie, Rating, RecommendationEvent
+from api.signals import enqueue_recommendation_refresh
+from api.cache import bump_version
+from datetime import datetime, timezone
+from io import StringIO
+import pandas as pd
+import time
 
 User = get_user_model()
 
 class Command(BaseCommand):
-    help = 'Import users and their ratings from a CSV file'
+    help = 'Import users and their ratings from a MovieLens ratings CSV file in bulk'
 
     def add_arguments(self, parser):
         parser.add_argument('csv_file', type=str, help='Path to the CSV file containing the ratings')
+        parser.add_argument('--chunk-size', type=int, default=100000, help='CSV rows read and written per transaction')
+        parser.add_argument('--password', type=str, default='genericpassword123', help='Password of the created users')
+        parser.add_argument('--skip-totals', action='store_true', help='Do not run install_avg_ratings after the import')
 
-    def handle(self, *args, **kwargs):
-        csv_file_path = kwargs['csv_file']
-        users_created = 0
-        ratings_created = 0
+    # Creates users and ratings from ratings.csv to populate the database with enough
+    # user data to use the recommendation system. The file is streamed in chunks so
+    # memory stays bounded for MovieLens 25M-sized files; every chunk is one transaction
+    # with one bulk insert of its users and one COPY (Postgres) or executemany of its
+    # ratings. Ratings keep the CSV's timestamps, which bypasses the model signals, so
+    # the movie totals and popularity are recomputed once at the end.
 
-        # Creates users and ratings from ratings.csv to populate the database with
-        # enough user data to use the recommendation system
+    def insert_ratings(self, rows):
+        # rows: (user_id, movie_id, rating, timestamp); raw SQL because Rating.timestamp is auto_now
+        table = Rating._meta.db_table
+        columns = [Rating._meta.get_field(name).column for name in ('user', 'movie', 'rating', 'timestamp')]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                buffer = StringIO(''.join(f'{user_id}\t{movie_id}\t{rating}\t{timestamp.isoformat()}\n' for user_id, movie_id, rating, timestamp in rows))
+                cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buffer)
+            else:
+                adapt = connection.ops.adapt_datetimefield_value
+                cursor.executemany(
+                    f'INSERT INTO {table} ({", ".join(columns)}) VALUES (%s, %s, %s, %s)',
+                    [(user_id, movie_id, rating, adapt(timestamp)) for user_id, movie_id, rating, timestamp in rows],
+                )
+
+    def handle(self, *args, **options):
+        csv_file_path = options['csv_file']
+        start = time.perf_counter()
+
+        # One query each for the movie map and the users from earlier imports
+        movie_map = dict(Movie.objects.exclude(movie_id=None).values_list('movie_id', 'id'))
+        user_map = dict(User.objects.filter(username__startswith='user').values_list('username', 'id'))
+        existing_user_ids = set(user_map.values())
+        password = make_password(options['password'])
+
+        rows_read = users_created = ratings_created = skipped = 0
+        missing_movies = set()
+        updated_users = set()
 
         try:
-            with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    userId = row['userId']
-                    username = f'user{userId}'
-                    # Check if user exists, otherwise create a new one
-                    user, created = User.objects.get_or_create(
-                        username=username,
-                        defaults={
-                            'email': f'{username}@example.com',
-                            'password': 'genericpassword123'  
-                        }
-                    )
-                    if created:
-                        users_created += 1
-                    
-                    movieId = row['movieId']
-                    rating = row['rating']
-
-
-                    # Ensure the movie exists before creating the rating
-                    if Movie.objects.filter(movie_id=movieId).exists():
-                        movie = Movie.objects.get(movie_id=movieId)
-                        Rating.objects.create(
-                            user=user,
-                            movie=movie,
-                            rating=rating 
-                        )
-                        ratings_created += 1
-                    else:
-                        self.stdout.write(self.style.WARNING(f'Movie with movie_id {movieId} not found.'))
+            chunks = pd.read_csv(
+                csv_file_path, chunksize=options['chunk_size'],
+                dtype={'userId': 'int64', 'movieId': 'int64', 'rating': 'float64', 'timestamp': 'int64'},
+            )
+            for chunk in chunks:
+                rows_read += len(chunk)
+                known = chunk['movieId'].isin(movie_map.keys())
+                missing_movies.update(chunk.loc[~known, 'movieId'].unique().tolist())
+                chunk = chunk[known]
+
+                with transaction.atomic():
+                    usernames = {f'user{user_id}' for user_id in chunk['userId'].unique().tolist()}
+                    new_users = User.objects.bulk_create([
+                        User(username=username, email=f'{username}@example.com', password=password)
+                        for username in sorted(usernames - user_map.keys())
+                    ])
+                    user_map.update((user.username, user.pk) for user in new_users)
+                    users_created += len(new_users)
+
+                    user_ids = [user_map[f'user{user_id}'] for user_id in chunk['userId'].tolist()]
+                    movie_ids = [movie_map[movie_id] for movie_id in chunk['movieId'].tolist()]
 
+                    # Rerunning an import must not duplicate ratings of users that already had some
+                    rerated = existing_user_ids.intersection(user_ids)
+                    stored = set(Rating.objects.filter(user_id__in=rerated).values_list('user_id', 'movie_id')) if rerated else set()
+
+                    rows = []
+                    for user_id, movie_id, rating, timestamp in zip(user_ids, movie_ids, chunk['rating'].tolist(), chunk['timestamp'].tolist()):
+                        if (user_id, movie_id) in stored:
+                            skipped += 1
+                            continue
+                        rows.append((user_id, movie_id, rating, datetime.fromtimestamp(timestamp, tz=timezone.utc)))
+                    self.insert_ratings(rows)
+                    ratings_created += len(rows)
+                    updated_users.update(user_id for user_id, _, _, _ in rows if user_id in existing_user_ids)
+
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f'{rows_read} rows read, {ratings_created} ratings written ({rows_read / elapsed:.0f} rows/s)')
         except FileNotFoundError:
             raise CommandError(f'File "{csv_file_path}" does not exist')
 
-        self.stdout.write(self.style.SUCCESS(f'Successfully created {users_created} users and {ratings_created} ratings.'))
+        # The signals that keep stored recommendations and cached friend lists fresh did not run
+        if updated_users:
+            enqueue_recommendation_refresh(updated_users, RecommendationEvent.RATING)
+            bump_version(*[f'friends:{user_id}' for user_id in updated_users])
+
+        elapsed = time.perf_counter() - start
+        if missing_movies:
+            self.stdout.write(self.style.WARNING(f'Skipped ratings of {len(missing_movies)} movie_ids that are not installed.'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully created {users_created} users and {ratings_created} ratings '
+            f'({skipped} already stored) in {elapsed:.1f} s ({rows_read / max(elapsed, 1e-9):.0f} rows/s).'
+        ))
+
+        if not options['skip_totals']:
+            call_command('install_avg_ratings', stdout=self.stdout)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from api.algorithms.registry import registry
+
+class Command(BaseCommand):
+    help = 'Load every recommender artifact and print its load time and memory usage.'
+
+    def handle(self, *args, **options):
+        registry.preload()
+
+        for artifact in registry.stats():
+            if not artifact['loaded']:
+                self.stdout.write(self.style.ERROR(f"{artifact['name']}: failed to load {artifact['path']}"))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f"{artifact['name']}: {artifact['load_seconds'] * 1000:.1f} ms, "
+                f"{artifact['memory_bytes'] / 1e6:.1f} MB, sha256 {artifact['checksum'][:12]}"
+            ))
@@ -1,5 +1,5 @@
-from django.core.management.base import BaseCommand
-import requests
+from django.core.management.base import BaseCommand, CommandError
+from api.tmdb import ResponseCache, TMDbError, fetch_movie
 import json
 import os
 
@@ -30,15 +30,27 @@ import os
 
 
 class Command(BaseCommand):
+    help = 'Prints the TMDb response for a movie, through the on-disk response cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tmdb_id', type=int, help='TMDb id of the movie')
+        parser.add_argument('--append', type=str, default='', help='Comma-separated append_to_response parts, e.g. credits,keywords')
+        parser.add_argument('--offline', action='store_true', help='Only print a cached response (no request, no TMDB_KEY needed)')
+        parser.add_argument('--refresh', action='store_true', help='Revalidate a cached response even when it is fresh')
 
     def handle(self, *args, **options):
-        movie_id = 187017
         api_key = os.getenv('TMDB_KEY')
-        url = f'https://api.themoviedb.org/3/movie/{movie_id}?api_key={api_key}'
-
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            self.stdout.write(json.dumps(data, indent=2))
-        else:
-            self.stdout.write(self.style.ERROR('Failed to fetch data from TMDB'))
+        if not api_key and not options['offline']:
+            raise CommandError('TMDB_KEY environment variable not found.')
+        append = [part for part in options['append'].split(',') if part]
+        cache = ResponseCache()
+        try:
+            data = fetch_movie(options['tmdb_id'], api_key, append, cache=cache, offline=options['offline'], refresh=options['refresh'])
+        except TMDbError as e:
+            raise CommandError(f'Failed to fetch data from TMDB: {e}')
+        finally:
+            cache.close()
+
+        if data is None:
+            raise CommandError(f'TMDB has no movie with id {options["tmdb_id"]}')
+        self.stdout.write(json.dumps(data, indent=2))
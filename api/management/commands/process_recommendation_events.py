@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from api.algorithms.recommendations import generate_recommendations
+from api.models import RecommendationEvent
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Worker that rebuilds the stored recommendations of users with pending rating/watchlist/watched events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the pending events once and exit')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when there is nothing to do')
+        parser.add_argument('--batch-size', type=int, default=16, help='Maximum number of users rebuilt per model call')
+        parser.add_argument('--keep-days', type=int, default=7, help='Delete processed events older than this many days')
+
+    def process_batch(self, batch_size):
+        # Users are picked oldest event first; all of a user's pending events are
+        # marked processed by generate_recommendations
+        user_ids = []
+        pending = RecommendationEvent.objects.filter(processed_at__isnull=True).order_by('id').values_list('user_id', flat=True)
+        for user_id in pending.iterator(chunk_size=batch_size * 4):
+            if user_id not in user_ids:
+                user_ids.append(user_id)
+                if len(user_ids) == batch_size:
+                    break
+
+        if not user_ids:
+            return 0
+
+        start = time.perf_counter()
+        generate_recommendations(user_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed recommendations for {len(user_ids)} users in {(time.perf_counter() - start) * 1000:.0f} ms'))
+        return len(user_ids)
+
+    def purge(self, keep_days):
+        cutoff = timezone.now() - datetime.timedelta(days=keep_days)
+        deleted = RecommendationEvent.objects.filter(processed_at__lt=cutoff).delete()[0]
+        if deleted:
+            self.stdout.write(f'Deleted {deleted} processed events.')
+
+    def handle(self, *args, **options):
+        batch_size = max(options['batch_size'], 1)
+        self.purge(options['keep_days'])
+
+        if options['once']:
+            while self.process_batch(batch_size):
+                pass
+            return
+
+        self.stdout.write('Waiting for recommendation events...')
+        last_purge = time.monotonic()
+        while True:
+            close_old_connections()
+            try:
+                if not self.process_batch(batch_size):
+                    time.sleep(options['interval'])
+                if time.monotonic() - last_purge > 3600:
+                    self.purge(options['keep_days'])
+                    last_purge = time.monotonic()
+            except Exception:
+                # A failed batch (lost connection, missing artifact, ...) is retried after
+                # the interval; its events stay pending, so the worker must keep running
+                logger.exception('Recommendation batch failed')
+                time.sleep(options['interval'])
@@ -0,0 +1,139 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.algorithms.registry import registry, ARTIFACT_DIR, file_checksum
+from api.algorithms.training import train, training_params, dataset_fingerprint, params_fingerprint, VARIANTS, SEED
+from datetime import datetime, timezone
+import joblib
+import json
+import os
+import shutil
+import time
+
+# Per variant: training result -> (registry artifact, file name inside a version directory)
+ARTIFACTS = {
+    'simple': {
+        'model': ('xgboost_simple', 'MC_rec.json'),
+        'vectorizer': ('tfidf_simple', 'tfidf.joblib'),
+        'matrix': ('features_simple', 'features_simple.npz'),
+    },
+    'w2v': {
+        'model': ('xgboost_w2v', 'mc_rec_w2v.json'),
+        'vectorizer': ('tfidf_w2v', 'tfidf_w2v.joblib'),
+        'w2v_director': ('w2v_director', 'Word2Vec_director'),
+        'w2v_keyword': ('w2v_keyword', 'Word2Vec_keyword'),
+        'matrix': ('features_w2v', 'features_w2v.npz'),
+    },
+}
+
+class Command(BaseCommand):
+    help = 'Train an XGBoost recommender from the export_datasets files into a versioned artifact directory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--variant', choices=list(VARIANTS), default='w2v', help='w2v (xgboost_w2v_opt) or simple (xgboost_simple_opt)')
+        parser.add_argument('--movies', type=str, default=str(settings.BASE_DIR / 'data' / 'movies.npz'), help='movies.npz written by export_datasets')
+        parser.add_argument('--ratings', type=str, default=str(settings.BASE_DIR / 'data' / 'ratings.npz'), help='ratings.npz written by export_datasets')
+        parser.add_argument('--output-dir', type=str, default=str(ARTIFACT_DIR / 'versions'), help='Where the version directories are written')
+        parser.add_argument('--rounds', type=int, help='Boosting rounds')
+        parser.add_argument('--seed', type=int, default=SEED)
+        parser.add_argument('--force', action='store_true', help='Retrain even if a version was trained on the same data and parameters')
+        parser.add_argument('--install', action='store_true', help='Copy the artifacts over the ones the recommender serves')
+
+    def manifests(self, output_dir, variant):
+        # Manifests of the existing versions of the variant, oldest first
+        manifests = []
+        for name in sorted(os.listdir(output_dir)):
+            if name.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(output_dir, name, 'manifest.json')) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if manifest['params']['variant'] == variant:
+                manifests.append(manifest)
+        return manifests
+
+    def install(self, version_dir, variant):
+        # Replace each served file atomically. The files still change one at a time, so the
+        # registry keeps serving the old model and feature matrix until both are in place
+        for name, file_name in ARTIFACTS[variant].values():
+            target = registry.path(name)
+            partial = target.with_name(f'.{target.name}.partial')
+            shutil.copyfile(os.path.join(version_dir, file_name), partial)
+            os.replace(partial, target)
+        self.stdout.write(self.style.SUCCESS(f'Installed {os.path.basename(version_dir)} into {ARTIFACT_DIR}.'))
+
+    def handle(self, *args, **options):
+        for path in (options['movies'], options['ratings']):
+            if not os.path.exists(path):
+                raise CommandError(f'File "{path}" does not exist (see export_datasets)')
+        output_dir = options['output_dir']
+        os.makedirs(output_dir, exist_ok=True)
+
+        variant = options['variant']
+        artifacts = ARTIFACTS[variant]
+        params = training_params(variant, options['seed'], options['rounds'])
+        data = {name: dataset_fingerprint(options[name]) for name in ('movies', 'ratings')}
+        fingerprint = params_fingerprint(params, data)
+        manifests = self.manifests(output_dir, variant)
+        same = [manifest for manifest in manifests if manifest['fingerprint'] == fingerprint]
+        if same and not options['force']:
+            version = same[-1]['version']
+            self.stdout.write(f'Version {version} was trained on the same data and parameters; use --force to retrain.')
+            if options['install']:
+                self.install(os.path.join(output_dir, version), variant)
+            return
+
+        start = time.perf_counter()
+        result = train(options['movies'], options['ratings'], variant, options['seed'], options['rounds'], log=self.stdout.write)
+        if not result['metrics']['train_rows']:
+            raise CommandError('No ratings to train on.')
+
+        created = datetime.now(timezone.utc)
+        version = f'{variant}-{created:%Y%m%dT%H%M%S}-{fingerprint[:8]}'
+        version_dir = os.path.join(output_dir, version)
+        partial_dir = os.path.join(output_dir, f'.{version}.partial')
+        os.makedirs(partial_dir)
+        try:
+            for key, (_, file_name) in artifacts.items():
+                path = os.path.join(partial_dir, file_name)
+                if key == 'vectorizer':
+                    joblib.dump(result[key], path)
+                elif key == 'model':
+                    result[key].save_model(path)
+                else:
+                    result[key].save(path)
+
+            manifest = {
+                'version': version,
+                'created_at': created.isoformat(),
+                'fingerprint': fingerprint,
+                'data': data,
+                'params': params,
+                'feature_names': result['matrix'].feature_names,
+                'metrics': result['metrics'],
+                'timings': {step: round(seconds, 3) for step, seconds in result['timings'].items()},
+                'artifacts': {
+                    name: {'file': file_name, 'sha256': file_checksum(os.path.join(partial_dir, file_name))}
+                    for name, file_name in artifacts.values()
+                },
+            }
+            with open(os.path.join(partial_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(partial_dir, version_dir)
+        except BaseException:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            raise
+
+        metrics = result['metrics']
+        self.stdout.write(self.style.SUCCESS(f'Trained {version} in {time.perf_counter() - start:.1f} s: ' + ', '.join(
+            f'{name} {value:.4f}' for name, value in metrics.items() if isinstance(value, float)
+        )))
+        if manifests:
+            previous = manifests[-1]
+            self.stdout.write(f'Compared with {previous["version"]}: ' + ', '.join(
+                f'{name} {value - previous["metrics"][name]:+.4f}' for name, value in metrics.items()
+                if isinstance(value, float) and isinstance(previous['metrics'].get(name), float)
+            ))
+        if options['install']:
+            self.install(version_dir, variant)
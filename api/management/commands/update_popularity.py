@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from api.algorithms.popularity import update_all_popularity
+from api.cache import bump_version
+import time
+
+class Command(BaseCommand):
+    help = 'Recomputes the popularity_score of every movie (Bayesian average rating weighted by recency)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0, help='Repeat every this many seconds instead of running once')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Movies written per UPDATE batch')
+
+    def recompute(self, batch_size):
+        start = time.perf_counter()
+        changed, total = update_all_popularity(batch_size)
+        bump_version('popular')
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated popularity_score for {changed} of {total} movies in {time.perf_counter() - start:.1f} s'))
+
+    def handle(self, *args, **options):
+        self.recompute(options['batch_size'])
+        while options['interval'] > 0:
+            time.sleep(options['interval'])
+            close_old_connections()
+            self.recompute(options['batch_size'])
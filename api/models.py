@@ -57,6 +57,12 @@ class Movie(models.Model):
     actors = models.ManyToManyField(Actor, related_name='movies')
     directors = models.ManyToManyField(Director, related_name='movies')
     avg_rating = models.FloatField(null=True, blank=True)
+    # Running totals of the movie's ratings, kept in step by the Rating signals (api/signals.py).
+    # avg_rating is derived from them as rating_sum / rating_count
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.FloatField(default=0)
+    # Bayesian average rating weighted by recency (api/algorithms/popularity.py); null until rated
+    popularity_score = models.FloatField(null=True, blank=True, db_index=True)
     similar_movies = models.ManyToManyField('self', symmetrical=False, related_name='related_to+', blank=True)
 
 
@@ -70,6 +76,13 @@ class Rating(models.Model):
     rating = models.FloatField()
     timestamp = models.DateTimeField(auto_now=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored values so an update can be applied to the movie's totals as a delta
+        instance._stored = (instance.__dict__.get('movie_id'), instance.__dict__.get('rating'))
+        return instance
+
 
 class WatchedMovie(models.Model):
     user = models.ForeignKey(GenericUser, on_delete=models.CASCADE, related_name='watched_movies')
@@ -88,10 +101,66 @@ class FriendRequest(models.Model):
 
     class Meta:
         unique_together = ('from_user', 'to_user')
-        
+
+
+# Accepted friendships, one row per direction, so a user's friends are one indexed lookup on user.
+# Kept in sync with FriendRequest by api/signals.py; rebuild with the install_friendships script
+class Friendship(models.Model):
+    user = models.ForeignKey(GenericUser, on_delete=models.CASCADE, related_name='friendships')
+    friend = models.ForeignKey(GenericUser, on_delete=models.CASCADE, related_name='friend_of')
+    request = models.ForeignKey(FriendRequest, on_delete=models.CASCADE, related_name='friendships') # The accepted request
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('user', 'friend')
+
+
+class UserRecommendation(models.Model):
+    user = models.ForeignKey(GenericUser, on_delete=models.CASCADE, related_name='recommendations')
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name='recommended_to')
+    rank = models.PositiveIntegerField() # 0 is the best recommendation
+    score = models.FloatField() # Model likelihood of the user liking the movie
+    generated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('user', 'movie')
+        indexes = [models.Index(fields=['user', 'rank'])]
+
+
+# When a user's UserRecommendation rows were last generated, so a user whose list
+# came out empty counts as scored too
+class UserRecommendationState(models.Model):
+    user = models.OneToOneField(GenericUser, on_delete=models.CASCADE, primary_key=True, related_name='recommendation_state')
+    generated_at = models.DateTimeField(default=timezone.now)
+    count = models.PositiveIntegerField(default=0) # Number of stored recommendations
+
+
+# Outbox of changes that make a user's stored recommendations stale
+# (see api/signals.py and the process_recommendation_events command)
+class RecommendationEvent(models.Model):
+    RATING = 'rating'
+    WATCHLIST = 'watchlist'
+    WATCHED = 'watched'
+    REASON_CHOICES = [(RATING, 'Rating'), (WATCHLIST, 'Watchlist'), (WATCHED, 'Watched')]
+
+    user = models.ForeignKey(GenericUser, on_delete=models.CASCADE, related_name='recommendation_events')
+    reason = models.CharField(max_length=16, choices=REASON_CHOICES)
+    created_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['processed_at', 'user'])]
+
 
 class Comment(models.Model):
     user = models.ForeignKey(GenericUser, on_delete=models.CASCADE, related_name='comments')
     movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name='comments')
     body = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+
+# Version of each response cache namespace (see api/cache.py). Kept in the database
+# rather than the cache so every process sees every bump
+class CacheVersion(models.Model):
+    namespace = models.CharField(max_length=255, primary_key=True)
+    version = models.CharField(max_length=32)
@@ -0,0 +1,36 @@
+from rest_framework.pagination import PageNumberPagination, CursorPagination
+
+# Default pagination for list endpoints (?page=2&page_size=100)
+class StandardResultsSetPagination(PageNumberPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+# Popular movies list (?genre=Drama&page=2)
+class PopularMoviesPagination(StandardResultsSetPagination):
+    page_size = 30
+
+    def paginate_count(self, request, count):
+        # Sets up the requested page of a list of `count` items without querying it, so a
+        # page whose results come from the response cache gets next/previous links built
+        # for this request's host and scheme
+        paginator = self.django_paginator_class(range(count), self.get_page_size(request))
+        self.page = paginator.page(self.get_page_number(request, paginator))
+        self.request = request
+
+
+# Search results, best match first (?cursor=... from the 'next' link)
+class SearchResultsPagination(CursorPagination):
+    ordering = ('-rank', 'id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+# Username search results (see search_users), capped at 50 per page
+class UserSearchPagination(CursorPagination):
+    ordering = 'sort_key'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 50
@@ -0,0 +1,195 @@
+import re
+from django.db import connection
+from django.db.models import FloatField, CharField, Q, Exists, OuterRef, Case, When, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Concat
+from .models import Movie, GenericUser, Friendship
+
+# Full-text movie search over title, keywords and overview.
+#
+# Postgres: api_movie_search holds one weighted tsvector per movie (title A,
+# keywords B, overview C) with a GIN index, and a pg_trgm GIN index on
+# api_movie.title catches misspelt titles. SQLite (local development and tests):
+# api_movie_search is an FTS5 table ranked with bm25.
+#
+# The tables are created and filled by the build_search_index command and kept
+# up to date by the signals in api/signals.py. Until the index is built, search
+# falls back to a title__icontains scan.
+#
+# The last search term is matched as a prefix so the same query serves type-ahead.
+#
+# Usernames are searched with istartswith/icontains, served by a pg_trgm index on
+# UPPER(username) on Postgres (a NOCASE index on SQLite only helps prefixes).
+
+SEARCH_TABLE = 'api_movie_search'
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+class PostgresSearchBackend:
+    def is_installed(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [SEARCH_TABLE])
+            return cursor.fetchone()[0]
+
+    def install(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+                    movie_id integer PRIMARY KEY REFERENCES api_movie (id) ON DELETE CASCADE,
+                    document tsvector NOT NULL
+                )''')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document ON {SEARCH_TABLE} USING gin (document)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS api_movie_title_trgm ON api_movie USING gin (title gin_trgm_ops)')
+            # Matches the UPPER("username"::text) LIKE ... that istartswith/icontains compile to
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS api_genericuser_username_trgm '
+                'ON api_genericuser USING gin ((UPPER(username::text)) gin_trgm_ops)'
+            )
+
+    def index(self, movie_ids=None):
+        where, params = ('WHERE m.id = ANY(%s)', [list(movie_ids)]) if movie_ids is not None else ('', [])
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                INSERT INTO {SEARCH_TABLE} (movie_id, document)
+                SELECT m.id,
+                       setweight(to_tsvector('english', coalesce(m.title, '')), 'A') ||
+                       setweight(to_tsvector('english', coalesce(string_agg(k.name, ' '), '')), 'B') ||
+                       setweight(to_tsvector('english', coalesce(m.overview, '')), 'C')
+                FROM api_movie m
+                LEFT JOIN api_movie_keywords mk ON mk.movie_id = m.id
+                LEFT JOIN api_keyword k ON k.id = mk.keyword_id
+                {where}
+                GROUP BY m.id
+                ON CONFLICT (movie_id) DO UPDATE SET document = EXCLUDED.document''', params)
+            return cursor.rowcount
+
+    def remove(self, movie_ids):
+        # Rows go with the movie (ON DELETE CASCADE)
+        pass
+
+    def search(self, terms, query):
+        tsquery = ' & '.join(terms[:-1] + [terms[-1] + ':*'])
+        matches = RawSQL(f'SELECT movie_id FROM {SEARCH_TABLE} WHERE document @@ to_tsquery(%s, %s)', ['english', tsquery])
+        similar_titles = RawSQL('SELECT id FROM api_movie WHERE title %% %s', [query])
+        rank = RawSQL(
+            f'''COALESCE((SELECT ts_rank_cd(document, to_tsquery(%s, %s)) FROM {SEARCH_TABLE}
+                          WHERE movie_id = "api_movie"."id"), 0) + similarity("api_movie"."title", %s)''',
+            ['english', tsquery, query], output_field=FloatField(),
+        )
+        return Movie.objects.filter(Q(id__in=matches) | Q(id__in=similar_titles)).annotate(rank=rank)
+
+
+class SQLiteSearchBackend:
+    # bm25 column weights for title, keywords and overview
+    WEIGHTS = (10.0, 4.0, 1.0)
+
+    def is_installed(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [SEARCH_TABLE])
+            return cursor.fetchone() is not None
+
+    def install(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+                "USING fts5(title, keywords, overview, tokenize='unicode61 remove_diacritics 2')"
+            )
+            cursor.execute('CREATE INDEX IF NOT EXISTS api_genericuser_username_nocase ON api_genericuser (username COLLATE NOCASE)')
+
+    def index(self, movie_ids=None):
+        if movie_ids is None:
+            where, params = '', []
+        else:
+            movie_ids = list(movie_ids)
+            where, params = f"WHERE m.id IN ({', '.join(['%s'] * len(movie_ids))})", movie_ids
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} {where.replace("m.id", "rowid")}', params)
+            cursor.execute(f'''
+                INSERT INTO {SEARCH_TABLE} (rowid, title, keywords, overview)
+                SELECT m.id, m.title, coalesce(group_concat(k.name, ' '), ''), coalesce(m.overview, '')
+                FROM api_movie m
+                LEFT JOIN api_movie_keywords mk ON mk.movie_id = m.id
+                LEFT JOIN api_keyword k ON k.id = mk.keyword_id
+                {where}
+                GROUP BY m.id''', params)
+            return cursor.rowcount
+
+    def remove(self, movie_ids):
+        movie_ids = list(movie_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(movie_ids))})", movie_ids)
+
+    def search(self, terms, query):
+        match = ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+        matches = RawSQL(f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s', [match])
+        # bm25 is lower-is-better; negate it so every backend ranks descending
+        weights = ', '.join(str(weight) for weight in self.WEIGHTS)
+        rank = RawSQL(
+            f'''SELECT -bm25({SEARCH_TABLE}, {weights}) FROM {SEARCH_TABLE}
+                WHERE {SEARCH_TABLE} MATCH %s AND rowid = "api_movie"."id"''',
+            [match], output_field=FloatField(),
+        )
+        return Movie.objects.filter(id__in=matches).annotate(rank=rank)
+
+
+def get_backend():
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return SQLiteSearchBackend()
+
+
+def search_movies(query):
+    # Movies matching the query, annotated with a relevance rank (higher is better)
+    terms = search_terms(query)
+    unranked = RawSQL('0', [], output_field=FloatField())
+    if not terms:
+        return Movie.objects.none().annotate(rank=unranked)
+    backend = get_backend()
+    if not backend.is_installed():
+        return Movie.objects.filter(title__icontains=query.strip()).annotate(rank=unranked)
+    return backend.search(terms, query.strip())
+
+
+def index_movies(movie_ids=None):
+    # (Re)index the given movies, or every movie when movie_ids is None
+    backend = get_backend()
+    if backend.is_installed():
+        return backend.index(movie_ids)
+    return 0
+
+
+def remove_movies(movie_ids):
+    backend = get_backend()
+    if backend.is_installed():
+        backend.remove(movie_ids)
+
+
+# Shortest query that is also matched inside usernames; shorter ones only match prefixes
+USER_CONTAINS_MIN_LENGTH = 3
+
+
+def search_users(query, user):
+    # Users visible to `user` whose username matches the query, annotated with is_friend
+    # and a unique sort_key: friends first, then prefix before substring matches, then username
+    query = query.strip()
+    is_friend = Exists(Friendship.objects.filter(user=user, friend=OuterRef('pk')))
+    prefix = Q(username__istartswith=query)
+    matches = prefix | Q(username__icontains=query) if len(query) >= USER_CONTAINS_MIN_LENGTH else prefix
+
+    # Private users only show up for their friends
+    return GenericUser.objects.filter(matches).exclude(pk=user.pk).annotate(is_friend=is_friend).filter(
+        Q(is_private=False) | Q(is_friend=True)
+    ).annotate(sort_key=Concat(
+        Case(
+            When(Q(is_friend=True) & prefix, then=Value('0')),
+            When(is_friend=True, then=Value('1')),
+            When(prefix, then=Value('2')),
+            default=Value('3'),
+        ),
+        'username',
+        output_field=CharField(),
+    ))
@@ -54,31 +54,27 @@ class OtherUserProfileSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'username', 'bio', 'is_private', 'is_friend', 'is_outgoing', 'is_incoming']
 
+    def relationship(self, obj):
+        # Every request between the two users in one lookup, shared by the three fields below
+        if getattr(self, '_relationship_user', None) != obj.pk:
+            request_user = self.context['request'].user
+            self._relationship_user = obj.pk
+            self._relationship = list(FriendRequest.objects.filter(
+                Q(from_user=request_user, to_user=obj) | Q(from_user=obj, to_user=request_user)
+            ).order_by('id').values('id', 'from_user_id', 'accepted'))
+        return self._relationship
+
     def get_is_friend(self, obj):
-        request_user = self.context['request'].user
-        friend_request = FriendRequest.objects.filter(
-            Q(from_user=request_user, to_user=obj, accepted=True) |
-            Q(from_user=obj, to_user=request_user, accepted=True)
-        ).first()
-        return friend_request.id if friend_request else None
+        accepted = [request['id'] for request in self.relationship(obj) if request['accepted']]
+        return accepted[0] if accepted else None
 
     def get_is_outgoing(self, obj):
-        request_user = self.context['request'].user
-        friend_request = FriendRequest.objects.filter(
-            from_user=request_user, 
-            to_user=obj, 
-            accepted=False
-        ).first()
-        return friend_request.id if friend_request else None
+        outgoing = [request['id'] for request in self.relationship(obj) if not request['accepted'] and request['from_user_id'] != obj.pk]
+        return outgoing[0] if outgoing else None
 
     def get_is_incoming(self, obj):
-        request_user = self.context['request'].user
-        friend_request = FriendRequest.objects.filter(
-            from_user=obj, 
-            to_user=request_user, 
-            accepted=False
-        ).first()
-        return friend_request.id if friend_request else None
+        incoming = [request['id'] for request in self.relationship(obj) if not request['accepted'] and request['from_user_id'] == obj.pk]
+        return incoming[0] if incoming else None
 
 
 # Serializer for user sign up
@@ -160,6 +156,12 @@ class ActorSerializer(serializers.ModelSerializer):
         fields = ['name']
 
 
+# Serializer for a movie's cast list (rows of the Movie.actors through table)
+class CastMemberSerializer(serializers.Serializer):
+    id = serializers.ReadOnlyField(source='actor.id')
+    name = serializers.ReadOnlyField(source='actor.name')
+
+
 # Serializer for a director
 class DirectorSerializer(serializers.ModelSerializer):
     class Meta:
@@ -177,51 +179,52 @@ class CommentSerializer(serializers.ModelSerializer):
 
 
 # Serializer for displaying the detailed view of a movie for a movie page
+# Only holds the fields shared by every user; the per-user 'rated' and 'on_watchlist'
+# fields come from annotations added by the view (see movie_user_fields)
 class MovieDetailSerializer(serializers.ModelSerializer):
     genres = GenreSerializer(many=True, read_only=True)
-    actors = ActorSerializer(many=True, read_only=True)
+    actors = ActorSerializer(source='top_actors', many=True, read_only=True) # First MOVIE_DETAIL_ACTORS cast members
+    actor_count = serializers.IntegerField(read_only=True)
     directors = DirectorSerializer(many=True, read_only=True)
     average_rating = serializers.SerializerMethodField()
-    rated = serializers.SerializerMethodField()
-    on_watchlist = serializers.SerializerMethodField() 
 
 
     class Meta:
         model = Movie
         fields = [
             'id', 'title', 'poster_url', 'overview', 'runtime', 'adult',
-            'release_date', 'genres', 'actors', 'directors', 'average_rating', 'rated', 'on_watchlist'
+            'release_date', 'genres', 'actors', 'actor_count', 'directors', 'average_rating'
         ]
 
     def get_average_rating(self, obj):
         # Return avg_rating rounded to 1 decimal place, or None if it's null
         return round(obj.avg_rating, 1) if obj.avg_rating is not None else None
 
-    def get_rated(self, obj):
-        user = self.context['request'].user
-        if not user.is_authenticated:
-            return 0
-        rating = Rating.objects.filter(user=user, movie=obj).first()
-        return rating.rating if rating else 0
-    
-    def get_on_watchlist(self, obj):
-        user = self.context['request'].user
-        return obj.watchlisted_by.filter(id=user.id).exists()
+
+# Per-user fields of the movie page, read from the user_rating/on_watchlist annotations
+def movie_user_fields(movie):
+    return {
+        'rated': getattr(movie, 'user_rating', None) or 0,
+        'on_watchlist': bool(getattr(movie, 'on_watchlist', False)),
+    }
 
 
-# Serializer for another user's rated movie list
+# Serializer for a user's rated movie list
+# Serializes Rating rows (with select_related('movie')) so each movie and its rating come from one query
 class UserRatedMoviesSerializer(serializers.ModelSerializer):
-    user_rating = serializers.SerializerMethodField()
+    id = serializers.ReadOnlyField(source='movie.id')
+    title = serializers.ReadOnlyField(source='movie.title')
+    poster_url = serializers.ReadOnlyField(source='movie.poster_url')
+    overview = serializers.ReadOnlyField(source='movie.overview')
+    release_date = serializers.ReadOnlyField(source='movie.release_date')
+    runtime = serializers.ReadOnlyField(source='movie.runtime')
+    adult = serializers.ReadOnlyField(source='movie.adult')
+    user_rating = serializers.ReadOnlyField(source='rating')
 
     class Meta:
-        model = Movie
+        model = Rating
         fields = ['id', 'title', 'poster_url', 'overview', 'release_date', 'runtime', 'adult', 'user_rating']
 
-    def get_user_rating(self, obj):
-        user = self.context.get('user')
-        rating = Rating.objects.filter(user=user, movie=obj).first()
-        return rating.rating if rating else None
-
 
 
 # Serializer for adding or updating a rating
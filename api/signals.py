@@ -0,0 +1,230 @@
+from django.db.models import F, Q, FloatField, Sum, Count
+from django.db.models.functions import Cast, NullIf
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from .models import GenericUser, Genre, Actor, Director, Movie, Rating, WatchedMovie, RecommendationEvent, FriendRequest, Friendship
+from .cache import bump_version
+from .search import index_movies, remove_movies
+from .algorithms.popularity import update_movie_popularity
+
+# Change-event hooks. Every write that affects what a user should be recommended
+# records a RecommendationEvent, which marks that user's stored recommendations
+# stale until the process_recommendation_events worker (or the next request) rebuilds them.
+# Writes to movie data bump the response cache versions of what they affect.
+
+
+def enqueue_recommendation_refresh(user_ids, reason):
+    RecommendationEvent.objects.bulk_create([RecommendationEvent(user_id=user_id, reason=reason) for user_id in user_ids])
+
+
+def deleted_with_user(origin):
+    # Rows removed because their user is being deleted need no refresh (and the
+    # event would reference the deleted user)
+    return isinstance(origin, GenericUser) or getattr(origin, 'model', None) is GenericUser
+
+
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+def rating_changed(sender, instance, origin=None, **kwargs):
+    if not deleted_with_user(origin):
+        enqueue_recommendation_refresh([instance.user_id], RecommendationEvent.RATING)
+        bump_version(f'friends:{instance.user_id}')
+
+
+# Movie rating totals. Each change is applied as a delta in a single UPDATE, so
+# concurrent ratings of the same movie cannot overwrite each other.
+def apply_rating_delta(movie_id, count, total):
+    rating_count = F('rating_count') + count
+    rating_sum = F('rating_sum') + total
+    # The right-hand sides all read the row's old values, so avg_rating uses the new totals
+    Movie.objects.filter(pk=movie_id).update(
+        rating_count=rating_count,
+        rating_sum=rating_sum,
+        avg_rating=Cast(rating_sum, FloatField()) / NullIf(rating_count, 0),
+    )
+    update_movie_popularity(movie_id)
+    bump_version(f'movie:{movie_id}', 'popular')
+
+
+def recompute_movie_rating(movie_id):
+    totals = Rating.objects.filter(movie_id=movie_id).aggregate(count=Count('id'), total=Sum('rating'))
+    count, total = totals['count'], totals['total'] or 0
+    Movie.objects.filter(pk=movie_id).update(
+        rating_count=count, rating_sum=total, avg_rating=total / count if count else None,
+    )
+    update_movie_popularity(movie_id)
+    bump_version(f'movie:{movie_id}', 'popular')
+
+
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, created, **kwargs):
+    stored = getattr(instance, '_stored', None)
+    # The rating may still hold the raw request value (e.g. '4.5') until the instance is reloaded
+    instance.rating = float(instance.rating)
+    if created:
+        apply_rating_delta(instance.movie_id, 1, instance.rating)
+    elif stored is None or stored[1] is None:
+        # Saved without having been loaded (or with the rating deferred): no old value to subtract
+        recompute_movie_rating(instance.movie_id)
+    elif stored[0] != instance.movie_id:
+        apply_rating_delta(stored[0], -1, -stored[1])
+        apply_rating_delta(instance.movie_id, 1, instance.rating)
+    elif stored[1] != instance.rating:
+        apply_rating_delta(instance.movie_id, 0, instance.rating - stored[1])
+    instance._stored = (instance.movie_id, instance.rating)
+
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, Movie) or getattr(origin, 'model', None) is Movie:
+        return
+    stored = getattr(instance, '_stored', None)
+    movie_id, rating = stored if stored is not None and stored[1] is not None else (instance.movie_id, instance.rating)
+    apply_rating_delta(movie_id, -1, -rating)
+
+
+@receiver(post_save, sender=WatchedMovie)
+@receiver(post_delete, sender=WatchedMovie)
+def watched_movie_changed(sender, instance, origin=None, **kwargs):
+    if not deleted_with_user(origin):
+        enqueue_recommendation_refresh([instance.user_id], RecommendationEvent.WATCHED)
+        bump_version(f'friends:{instance.user_id}')
+
+
+@receiver(m2m_changed, sender=GenericUser.watchlist.through)
+def watchlist_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        # user.watchlist.add(movie)
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # movie.watchlisted_by.clear() does not pass the affected users
+        user_ids = list(instance.watchlisted_by.values_list('id', flat=True))
+    else:
+        # movie.watchlisted_by.add(user)
+        user_ids = list(pk_set or [])
+    if user_ids:
+        enqueue_recommendation_refresh(user_ids, RecommendationEvent.WATCHLIST)
+        bump_version(*[f'friends:{user_id}' for user_id in user_ids])
+
+
+# Response cache versions (see api/cache.py). avg_rating only appears on the movie
+# page and the popular list; any other field may appear in every movie list.
+@receiver(post_save, sender=Movie)
+def movie_saved(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {'avg_rating'}:
+        bump_version(f'movie:{instance.pk}', 'popular')
+    elif not created:
+        bump_version(f'movie:{instance.pk}', 'popular', 'catalog')
+
+
+@receiver(post_delete, sender=Movie)
+def movie_deleted(sender, instance, **kwargs):
+    bump_version(f'movie:{instance.pk}', 'popular', 'catalog')
+
+
+# Search index (see api/search.py): reindex a movie when its title, overview or keywords change
+@receiver(post_save, sender=Movie)
+def movie_search_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'title', 'overview'} & set(update_fields):
+        index_movies([instance.pk])
+
+
+@receiver(post_delete, sender=Movie)
+def movie_search_deleted(sender, instance, **kwargs):
+    remove_movies([instance.pk])
+
+
+@receiver(m2m_changed, sender=Movie.keywords.through)
+def movie_keywords_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        index_movies([instance.pk])
+    elif pk_set:
+        index_movies(pk_set)
+    elif action == 'post_clear':
+        # keyword.movies.clear() does not say which movies lost the keyword
+        index_movies()
+
+
+def movie_relation_changed(prefix, instance, action, reverse, pk_set):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        bump_version(f'{prefix}:{instance.pk}')
+    elif pk_set:
+        bump_version(*[f'{prefix}:{pk}' for pk in pk_set])
+    else:
+        # Clearing from the related side does not say which movies changed
+        bump_version('catalog')
+
+
+@receiver(m2m_changed, sender=Movie.similar_movies.through)
+def similar_movies_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    movie_relation_changed('similar', instance, action, reverse, pk_set)
+
+
+@receiver(m2m_changed, sender=Movie.genres.through)
+@receiver(m2m_changed, sender=Movie.actors.through)
+@receiver(m2m_changed, sender=Movie.directors.through)
+def movie_credits_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # actor.movies.clear() does not pass the movies, so bump their pages before the rows go
+        bump_movie_pages(instance)
+    movie_relation_changed('movie', instance, action, reverse, pk_set)
+
+
+def bump_movie_pages(instance):
+    # Movie pages (RetrieveMovieDetail) showing a genre, actor or director
+    bump_version(*[f'movie:{pk}' for pk in instance.movies.values_list('id', flat=True)])
+
+
+# Renaming or deleting a genre, actor or director changes the page of every movie it is on
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Actor)
+@receiver(post_save, sender=Director)
+def movie_credit_saved(sender, instance, created, **kwargs):
+    if not created:
+        bump_movie_pages(instance)
+
+
+@receiver(pre_delete, sender=Genre)
+@receiver(pre_delete, sender=Actor)
+@receiver(pre_delete, sender=Director)
+def movie_credit_deleted(sender, instance, **kwargs):
+    bump_movie_pages(instance)
+
+
+# Friendship edges (see Friendship): rebuilt for a pair whenever one of its requests
+# is accepted, saved or deleted
+def sync_friendship(user_id, friend_id):
+    accepted = FriendRequest.objects.filter(
+        Q(from_user_id=user_id, to_user_id=friend_id) | Q(from_user_id=friend_id, to_user_id=user_id),
+        accepted=True,
+    ).order_by('id').first()
+    Friendship.objects.filter(
+        Q(user_id=user_id, friend_id=friend_id) | Q(user_id=friend_id, friend_id=user_id)
+    ).exclude(request=accepted).delete()
+    # Cached "friends liked" recommendations of both users (see api/algorithms/friends.py)
+    bump_version(f'friends:{user_id}', f'friends:{friend_id}')
+    if accepted is not None:
+        Friendship.objects.bulk_create([
+            Friendship(user_id=user_id, friend_id=friend_id, request=accepted),
+            Friendship(user_id=friend_id, friend_id=user_id, request=accepted),
+        ], ignore_conflicts=True)
+
+
+@receiver(post_save, sender=FriendRequest)
+def friend_request_saved(sender, instance, created, **kwargs):
+    # New pending requests cannot change a friendship
+    if instance.accepted or not created:
+        sync_friendship(instance.from_user_id, instance.to_user_id)
+
+
+@receiver(post_delete, sender=FriendRequest)
+def friend_request_deleted(sender, instance, origin=None, **kwargs):
+    # The request's edges are deleted with it; another accepted request for the pair may remain
+    if instance.accepted and not deleted_with_user(origin):
+        sync_friendship(instance.from_user_id, instance.to_user_id)
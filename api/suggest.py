@@ -0,0 +1,212 @@
+import bisect
+import logging
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+import numpy as np
+
+from .cache import get_versions
+from .models import Movie
+
+# In-process title index for type-ahead suggestions (/api/movie/suggest/).
+# Each gunicorn worker keeps every movie title in memory, so a suggestion is a
+# bisect over a sorted array of title words plus a trigram lookup for typos,
+# without a database round trip.
+#
+# Movies added since the last build are picked up every REFRESH_INTERVAL seconds
+# with one `id > last id` query. At the same check the whole index is rebuilt if
+# the 'catalog' cache version changed (a movie was edited or deleted, see api/signals.py) or
+# every REBUILD_INTERVAL seconds so the popularity tiebreak stays current.
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = 30
+REBUILD_INTERVAL = 10 * 60
+SUGGESTION_LIMIT = 10
+
+# Minimum trigram Jaccard similarity for a fuzzy match
+FUZZY_THRESHOLD = 0.3
+
+# Scores of the three kinds of match; popularity only breaks ties within a kind
+TITLE_PREFIX, WORD_PREFIX, FUZZY = 3.0, 2.0, 1.0
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(''.join(char if char.isalnum() else ' ' for char in text.lower()).split())
+
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TitleIndex:
+    def __init__(self, rows):
+        # rows: (id, title, popularity_score, avg_rating)
+        self.ids = []
+        self.titles = []
+        self.normalized = []
+        self.max_id = 0
+        popularity = []
+
+        # words[i] is a title word; word_movies[i] the position of its movie
+        words = []
+        self.grams = defaultdict(list)
+        self.gram_counts = []
+
+        for movie_id, title, popularity_score, avg_rating in rows:
+            position = len(self.ids)
+            name = normalize(title)
+            self.ids.append(movie_id)
+            self.titles.append(title)
+            self.normalized.append(name)
+            self.max_id = max(self.max_id, movie_id)
+            # Popularity first, then average rating; both scaled below 1 so they never outrank the match kind
+            popularity.append((popularity_score or 0) / 10 + (avg_rating or 0) / 1000)
+            for offset, word in enumerate(name.split()):
+                words.append((word, offset, position))
+            name_grams = trigrams(name)
+            self.gram_counts.append(len(name_grams))
+            for gram in name_grams:
+                self.grams[gram].append(position)
+
+        words.sort()
+        self.words = [word for word, _, _ in words]
+        self.word_offsets = np.array([offset for _, offset, _ in words], dtype=np.int32)
+        self.word_movies = np.array([position for _, _, position in words], dtype=np.int64)
+        self.popularity = np.array(popularity, dtype=np.float64)
+        self.gram_counts = np.array(self.gram_counts, dtype=np.int32)
+        self.built_at = time.monotonic()
+
+        # Movies added after the build; scanned linearly until the next rebuild
+        self.recent = []
+
+    def __len__(self):
+        return len(self.ids) + len(self.recent)
+
+    def add(self, rows):
+        for movie_id, title, popularity_score, avg_rating in rows:
+            self.recent.append((movie_id, title, normalize(title), (popularity_score or 0) / 10 + (avg_rating or 0) / 1000))
+            self.max_id = max(self.max_id, movie_id)
+
+    def prefix_matches(self, query):
+        # Movies with a title word starting with the last query term, as (positions, scores).
+        # A match that covers the whole query from the first word is a title prefix match
+        terms = query.split()
+        start = bisect.bisect_left(self.words, terms[-1])
+        end = bisect.bisect_left(self.words, terms[-1] + '\uffff')
+        positions = self.word_movies[start:end]
+        if len(terms) == 1:
+            kinds = np.where(self.word_offsets[start:end] == 0, TITLE_PREFIX, WORD_PREFIX)
+        else:
+            kinds = np.array([
+                TITLE_PREFIX if self.normalized[position].startswith(query)
+                else WORD_PREFIX if set(terms[:-1]) <= set(self.normalized[position].split())
+                else 0
+                for position in positions.tolist()
+            ], dtype=np.float64)
+            positions, kinds = positions[kinds > 0], kinds[kinds > 0]
+        return positions, kinds + self.popularity[positions]
+
+    def fuzzy_matches(self, query):
+        # Movies sharing enough trigrams with the query, for misspelt titles
+        query_grams = trigrams(query)
+        shared = defaultdict(int)
+        for gram in query_grams:
+            for position in self.grams.get(gram, ()):
+                shared[position] += 1
+        positions = np.fromiter(shared.keys(), dtype=np.int64, count=len(shared))
+        counts = np.fromiter(shared.values(), dtype=np.float64, count=len(shared))
+        similarity = counts / (len(query_grams) + self.gram_counts[positions] - counts)
+        keep = similarity >= FUZZY_THRESHOLD
+        positions, similarity = positions[keep], similarity[keep]
+        return positions, FUZZY + similarity * 0.5 + self.popularity[positions] * 0.01
+
+    def suggest(self, text, limit=SUGGESTION_LIMIT):
+        query = normalize(text)
+        if not query:
+            return []
+
+        positions, scores = self.prefix_matches(query)
+        if len(positions) < limit and len(query) >= 3:
+            fuzzy_positions, fuzzy_scores = self.fuzzy_matches(query)
+            positions = np.concatenate([positions, fuzzy_positions])
+            scores = np.concatenate([scores, fuzzy_scores])
+
+        # Best score per movie (a title can match on several words), then the top `limit`
+        best = {}
+        candidates = limit * 4
+        if len(positions) > candidates:
+            # A few times `limit` so movies matching on several words still leave `limit` distinct ones
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            positions, scores = positions[top], scores[top]
+        for position, score in zip(positions.tolist(), scores.tolist()):
+            if score > best.get(position, 0):
+                best[position] = score
+
+        results = [(score, self.ids[position], self.titles[position]) for position, score in best.items()]
+        # Movies added since the build, matched the way prefix_matches matches the indexed ones
+        terms = query.split()
+        for movie_id, title, name, popularity in self.recent:
+            words = name.split()
+            if name.startswith(query):
+                results.append((TITLE_PREFIX + popularity, movie_id, title))
+            elif any(word.startswith(terms[-1]) for word in words) and set(terms[:-1]) <= set(words):
+                results.append((WORD_PREFIX + popularity, movie_id, title))
+
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return [{'id': movie_id, 'title': title} for _, movie_id, title in results[:limit]]
+
+
+def movie_rows(queryset):
+    return queryset.values_list('id', 'title', 'popularity_score', 'avg_rating').order_by('id')
+
+
+class SuggestionService:
+    def __init__(self, refresh_interval=REFRESH_INTERVAL, rebuild_interval=REBUILD_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.index = None
+        self.catalog_version = None
+        self.last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def build(self):
+        start = time.perf_counter()
+        self.catalog_version = get_versions(['catalog'])[0]
+        index = TitleIndex(movie_rows(Movie.objects.all()))
+        self.index = index
+        self.last_refresh = time.monotonic()
+        logger.info('Built title suggestion index of %d movies in %.1f ms', len(index), (time.perf_counter() - start) * 1000)
+        return index
+
+    def refresh(self):
+        if self.index is None or get_versions(['catalog'])[0] != self.catalog_version \
+                or time.monotonic() - self.index.built_at >= self.rebuild_interval:
+            return self.build()
+        self.index.add(movie_rows(Movie.objects.filter(id__gt=self.index.max_id)))
+        self.last_refresh = time.monotonic()
+        return self.index
+
+    def get_index(self):
+        index = self.index
+        if index is not None and time.monotonic() - self.last_refresh < self.refresh_interval:
+            return index
+        with self._lock:
+            if self.index is None or time.monotonic() - self.last_refresh >= self.refresh_interval:
+                return self.refresh()
+            return self.index
+
+    def suggest(self, text, limit=SUGGESTION_LIMIT):
+        return self.get_index().suggest(text, limit)
+
+    def clear(self):
+        with self._lock:
+            self.index = None
+
+
+suggestions = SuggestionService()
@@ -1,3 +1,1512 @@
-from django.test import TestCase
+from io import StringIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.apps import apps
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from .models import Movie, Rating, WatchedMovie, Genre, Actor, Director, Keyword, FriendRequest, Friendship, UserRecommendation, UserRecommendationState, RecommendationEvent, CacheVersion
+from .views import MOVIE_DETAIL_ACTORS, top_actors
+from .management.commands.ingest_tmdb import Command as IngestCommand
+from .algorithms.popularity import PRIOR_VOTES
+from .suggest import SuggestionService, suggestions
+from .cache import bump_version, get_versions, INITIAL_VERSION, VERSION_TIMEOUT
+from .algorithms.ann import SimilarityIndex, kmeans, normalize_rows, load_similarity_index
+from .algorithms.similarity import similar_movie_ids, EMBEDDING_ARTIFACTS
+from .tmdb import TokenBucket, retry_after, credit_names
+from .algorithms.datasets import load_columns, read_movie_dataset
+from .algorithms.registry import registry, ModelRegistry, features_match
+from .algorithms.features import FeatureMatrix, UserProfiles, PROFILE_FEATURES, build_feature_matrix, load_feature_matrix
+from .algorithms.profiles import load_user_profiles, compute_user_profiles
+from .algorithms.factors import SVDFactors, load_svd_factors
+from .algorithms.SVD_cosine_sim import get_user_factors_items_factors, factor_movie_ids, recommend_movie_ids
+from .algorithms.candidates import generate_candidates
+from .algorithms.ranking import score_candidates, diversify, rank_movies_for_users
+from .algorithms.recommendations import get_recommendations
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import asyncio
+import json
+import threading
+import time
+import datetime
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from xgboost import XGBClassifier
+from gensim.models import Word2Vec
+from sklearn.feature_extraction.text import TfidfVectorizer
 
-# Create your tests here.
+User = get_user_model()
+
+
+class RatedMoviesQueryCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='rater', email='rater@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def rate_movies(self, count):
+        movies = Movie.objects.bulk_create(
+            [Movie(title=f'Movie {i}', movie_id=i) for i in range(Movie.objects.count(), Movie.objects.count() + count)]
+        )
+        Rating.objects.bulk_create([Rating(user=self.user, movie=movie, rating=4.0) for movie in movies])
+
+    def test_rated_movies_query_count_is_constant(self):
+        self.rate_movies(5)
+        # count + page
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('list_rated_movies'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 5)
+
+        self.rate_movies(45)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('list_rated_movies'))
+        self.assertEqual(len(response.data['results']), 50)
+        self.assertEqual(response.data['results'][0]['user_rating'], 4.0)
+
+    def test_other_user_rated_movies_query_count_is_constant(self):
+        self.rate_movies(60)
+        url = reverse('list_user_rated_movies', args=[self.user.id])
+        # user exists + count + page
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'page': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 60)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_other_user_rated_movies_unknown_user(self):
+        response = self.client.get(reverse('list_user_rated_movies', args=[self.user.id + 1]))
+        self.assertEqual(response.status_code, 404)
+
+
+class MovieDetailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='viewer', email='viewer@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.movie = Movie.objects.create(title='Heat', movie_id=6, avg_rating=4.26)
+        self.movie.genres.add(Genre.objects.create(name='Crime'))
+        self.movie.directors.add(Director.objects.create(name='Michael Mann'))
+        self.movie.actors.add(*Actor.objects.bulk_create([Actor(name=f'Actor {i}') for i in range(30)]))
+
+    def test_movie_detail_query_count(self):
+        Rating.objects.create(user=self.user, movie=self.movie, rating=5.0)
+        self.user.watchlist.add(self.movie)
+        # movie with annotations + genres + directors + actors
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('retrieve_movie', args=[self.movie.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rated'], 5.0)
+        self.assertTrue(response.data['on_watchlist'])
+        # the only rating is the user's own
+        self.assertEqual(response.data['average_rating'], 5.0)
+        self.assertEqual(response.data['actor_count'], 30)
+        self.assertEqual(len(response.data['actors']), MOVIE_DETAIL_ACTORS)
+        self.assertEqual(response.data['actors'][0]['name'], 'Actor 0')
+
+    def test_movie_detail_anonymous(self):
+        response = APIClient().get(reverse('retrieve_movie', args=[self.movie.id]))
+        self.assertEqual(response.data['rated'], 0)
+        self.assertFalse(response.data['on_watchlist'])
+
+    def test_cached_page_follows_credit_renames_and_removals(self):
+        url = reverse('retrieve_movie', args=[self.movie.id])
+        self.client.get(url)
+        director = Director.objects.get(name='Michael Mann')
+        director.name = 'M. Mann'
+        director.save()
+        self.assertEqual(self.client.get(url).data['directors'], [{'name': 'M. Mann'}])
+
+        Genre.objects.get(name='Crime').movies.clear()
+        self.assertEqual(self.client.get(url).data['genres'], [])
+        Actor.objects.get(name='Actor 0').delete()
+        response = self.client.get(url)
+        self.assertEqual((response.data['actor_count'], response.data['actors'][0]['name']), (29, 'Actor 1'))
+
+    def test_movie_actors_paginated(self):
+        response = self.client.get(reverse('movie_actors', args=[self.movie.id]), {'page_size': 25, 'page': 2})
+        self.assertEqual(response.data['count'], 30)
+        self.assertEqual([actor['name'] for actor in response.data['results']], [f'Actor {i}' for i in range(25, 30)])
+
+
+def versions_expire():
+    # Moves the local memory cache's clock past VERSION_TIMEOUT, after which this
+    # process reads the cache versions from the database again
+    later = time.time() + VERSION_TIMEOUT + 1
+    return mock.patch('django.core.cache.backends.locmem.time.time', return_value=later)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='cached', email='cached@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.movie = Movie.objects.create(title='Alien', movie_id=1214, avg_rating=3.0, popularity_score=3.0)
+        self.other = Movie.objects.create(title='Aliens', movie_id=1200, avg_rating=3.9, popularity_score=3.9)
+        self.movie.similar_movies.add(self.other)
+
+    def test_popular_movies_served_from_cache(self):
+        self.client.get(reverse('most_popular_movies'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('most_popular_movies'))
+        self.assertEqual([movie['title'] for movie in response.data['results']], ['Aliens', 'Alien'])
+
+    def test_cached_popular_page_links_follow_the_request_host(self):
+        url = reverse('most_popular_movies')
+        self.client.get(url, {'page_size': 1}, HTTP_HOST='django:8000')
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'page_size': 1}, HTTP_HOST='movies.example.com', secure=True)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(response.data['next'], f'https://movies.example.com{url}?page=2&page_size=1')
+        self.assertIsNone(response.data['previous'])
+
+    def test_rating_invalidates_popular_movies(self):
+        self.client.get(reverse('most_popular_movies'))
+        self.client.post(reverse('rate_movie', args=[self.movie.id]), {'rating': 5.0})
+        response = self.client.get(reverse('most_popular_movies'))
+        self.assertEqual(response.data['results'][0]['title'], 'Alien')
+
+    def test_similar_movies_invalidated_on_change(self):
+        url = reverse('similar_movies', args=[self.movie.id])
+        self.assertEqual(len(self.client.get(url).data), 1)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.movie.similar_movies.clear()
+        with mock.patch('api.views.similar_movie_ids', return_value=[]):
+            self.assertEqual(self.client.get(url).data, [])
+
+    def test_bumps_from_other_processes_invalidate(self):
+        url = reverse('similar_movies', args=[self.movie.id])
+        self.client.get(url)
+        # Another worker changed the neighbours and bumped the version; this process's cache never saw it
+        Movie.similar_movies.through.objects.filter(from_movie=self.movie).delete()
+        CacheVersion.objects.update_or_create(namespace=f'similar:{self.movie.id}', defaults={'version': 'elsewhere'})
+        with mock.patch('api.views.similar_movie_ids', return_value=[]), versions_expire():
+            self.assertEqual(self.client.get(url).data, [])
+
+    def test_shared_backend_keeps_versions_out_of_the_database(self):
+        stored = list(CacheVersion.objects.values_list('namespace', 'version'))
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory}}):
+            url = reverse('similar_movies', args=[self.movie.id])
+            self.client.get(url)
+            with self.assertNumQueries(0):
+                self.client.get(url)
+            with self.assertNumQueries(0):
+                bump_version(f'similar:{self.movie.id}')
+            self.movie.similar_movies.through.objects.filter(from_movie=self.movie).delete()
+            with mock.patch('api.views.similar_movie_ids', return_value=[]):
+                self.assertEqual(self.client.get(url).data, [])
+        self.assertEqual(list(CacheVersion.objects.values_list('namespace', 'version')), stored)
+
+    def test_bumped_versions_never_repeat(self):
+        bump_version('catalog')
+        first = get_versions(['catalog'])
+        CacheVersion.objects.all().delete()
+        cache.clear()
+        self.assertEqual(get_versions(['catalog']), [INITIAL_VERSION])
+        bump_version('catalog')
+        self.assertNotIn(get_versions(['catalog'])[0], first + [INITIAL_VERSION])
+
+    def test_similar_movies_unknown_movie(self):
+        response = self.client.get(reverse('similar_movies', args=[self.other.id + 1]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_movie_detail_cache_keeps_user_state(self):
+        url = reverse('retrieve_movie', args=[self.movie.id])
+        self.client.get(url)
+        self.user.watchlist.add(self.movie)
+        # only the user's rating and watchlist state
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertTrue(response.data['on_watchlist'])
+        self.assertEqual(response.data['title'], 'Alien')
+
+        # rating changes the average, so the shared part is rebuilt
+        Rating.objects.create(user=self.user, movie=self.movie, rating=2.0)
+        response = self.client.get(url)
+        self.assertEqual((response.data['rated'], response.data['average_rating']), (2.0, 2.0))
+
+        self.movie.title = 'Alien (1979)'
+        self.movie.save()
+        self.assertEqual(self.client.get(url).data['title'], 'Alien (1979)')
+
+
+class RatingTotalsTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(username=f'voter{i}', email=f'voter{i}@example.com', password='password')
+            for i in range(3)
+        ]
+        self.movie = Movie.objects.create(title='Ran', movie_id=1217)
+
+    def assertTotals(self, count, total, average):
+        self.movie.refresh_from_db()
+        self.assertEqual(self.movie.rating_count, count)
+        self.assertAlmostEqual(self.movie.rating_sum, total)
+        if average is None:
+            self.assertIsNone(self.movie.avg_rating)
+        else:
+            self.assertAlmostEqual(self.movie.avg_rating, average)
+
+    def test_totals_follow_rating_writes(self):
+        first = Rating.objects.create(user=self.users[0], movie=self.movie, rating=4.0)
+        Rating.objects.create(user=self.users[1], movie=self.movie, rating=3.0)
+        self.assertTotals(2, 7.0, 3.5)
+
+        first = Rating.objects.get(pk=first.pk)
+        first.rating = 5.0
+        first.save()
+        self.assertTotals(2, 8.0, 4.0)
+
+        first.delete()
+        self.assertTotals(1, 3.0, 3.0)
+        Rating.objects.filter(movie=self.movie).delete()
+        self.assertTotals(0, 0.0, None)
+
+    def test_rate_movie_view_updates_average(self):
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        url = reverse('rate_movie', args=[self.movie.id])
+        client.post(url, {'rating': '2.5'})
+        client.post(url, {'rating': '4.5'})
+        self.assertTotals(1, 4.5, 4.5)
+
+    def test_deleting_user_removes_their_ratings_from_totals(self):
+        Rating.objects.create(user=self.users[0], movie=self.movie, rating=1.0)
+        Rating.objects.create(user=self.users[1], movie=self.movie, rating=5.0)
+        self.users[0].delete()
+        self.assertTotals(1, 5.0, 5.0)
+
+    def test_install_avg_ratings_backfills_totals(self):
+        Rating.objects.bulk_create([Rating(user=user, movie=self.movie, rating=i + 2.0) for i, user in enumerate(self.users)])
+        unrated = Movie.objects.create(title='Kagemusha', movie_id=1218, avg_rating=4.0, rating_count=1, rating_sum=4.0)
+        call_command('install_avg_ratings', stdout=StringIO())
+        self.assertTotals(3, 9.0, 3.0)
+        unrated.refresh_from_db()
+        self.assertEqual((unrated.rating_count, unrated.avg_rating), (0, None))
+
+
+class PopularMoviesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='popular', email='popular@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.drama = Genre.objects.create(name='Drama')
+
+    def create_movie(self, title, ratings, release_date=None):
+        # Totals as left by install_avg_ratings; scores come from update_popularity
+        return Movie.objects.create(
+            title=title, release_date=release_date, rating_count=len(ratings), rating_sum=sum(ratings),
+            avg_rating=sum(ratings) / len(ratings) if ratings else None,
+        )
+
+    def popular(self, **params):
+        response = self.client.get(reverse('most_popular_movies'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_vote_count_outweighs_single_perfect_rating(self):
+        self.create_movie('One Vote', [5.0])
+        self.create_movie('Classic', [4.5] * PRIOR_VOTES * 4)
+        self.create_movie('Average', [3.0] * 200)
+        self.create_movie('Unrated', [])
+        call_command('update_popularity', stdout=StringIO())
+
+        titles = [movie['title'] for movie in self.popular()['results']]
+        self.assertEqual(titles, ['Classic', 'One Vote', 'Average'])
+
+    def test_recent_movies_rank_above_equally_rated_old_ones(self):
+        today = datetime.date.today()
+        self.create_movie('Old', [4.0] * 50, today - datetime.timedelta(days=365 * 40))
+        self.create_movie('New', [4.0] * 50, today - datetime.timedelta(days=30))
+        call_command('update_popularity', stdout=StringIO())
+        self.assertEqual(self.popular()['results'][0]['title'], 'New')
+
+    def test_genre_filter_and_paging(self):
+        for i in range(5):
+            movie = self.create_movie(f'Drama {i}', [1.0 + i / 2] * 10)
+            movie.genres.add(self.drama)
+        self.create_movie('Comedy', [5.0] * 10)
+        call_command('update_popularity', stdout=StringIO())
+
+        data = self.popular(genre='drama', page_size=2, page=2)
+        self.assertEqual(data['count'], 5)
+        self.assertEqual([movie['title'] for movie in data['results']], ['Drama 2', 'Drama 1'])
+
+    def test_rating_updates_score(self):
+        movie = self.create_movie('Fresh', [])
+        Rating.objects.create(user=self.user, movie=movie, rating=4.0)
+        movie.refresh_from_db()
+        self.assertIsNotNone(movie.popularity_score)
+        self.assertEqual(self.popular()['results'][0]['title'], 'Fresh')
+
+
+class MovieSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher', email='searcher@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.star_wars = Movie.objects.create(title='Star Wars', overview='Luke joins the rebellion.')
+        self.empire = Movie.objects.create(title='The Empire Strikes Back', overview='The rebels flee after the Star Wars battle.')
+        self.empire.keywords.add(Keyword.objects.create(name='space opera'))
+        Movie.objects.create(title='Stardust', overview='A fairy tale.')
+        call_command('build_search_index', stdout=StringIO())
+
+    def search(self, **params):
+        response = self.client.get(reverse('movie_search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def titles(self, data):
+        return [movie['title'] for movie in data['results']]
+
+    def test_title_matches_rank_above_overview_matches(self):
+        self.assertEqual(self.titles(self.search(title='star wars')), ['Star Wars', 'The Empire Strikes Back'])
+
+    def test_last_term_matches_as_prefix(self):
+        self.assertEqual(set(self.titles(self.search(title='sta'))), {'Star Wars', 'Stardust', 'The Empire Strikes Back'})
+
+    def test_keywords_are_searchable(self):
+        self.assertEqual(self.titles(self.search(title='opera')), ['The Empire Strikes Back'])
+
+    def test_cursor_pagination(self):
+        first = self.search(title='sta', page_size=2)
+        self.assertEqual(len(first['results']), 2)
+        second = self.client.get(first['next']).data
+        self.assertEqual(len(second['results']), 1)
+        self.assertIsNone(second['next'])
+        self.assertFalse(set(self.titles(first)) & set(self.titles(second)))
+
+    def test_index_follows_movie_changes(self):
+        movie = Movie.objects.create(title='Solaris')
+        self.assertEqual(self.titles(self.search(title='solaris')), ['Solaris'])
+        movie.keywords.add(Keyword.objects.create(name='ocean'))
+        self.assertEqual(self.titles(self.search(title='ocean')), ['Solaris'])
+        movie.delete()
+        self.assertEqual(self.titles(self.search(title='solaris')), [])
+
+    def test_query_without_terms(self):
+        self.assertEqual(self.search(title='?!')['results'], [])
+        self.assertEqual(self.client.get(reverse('movie_search')).status_code, 400)
+
+
+class MovieSuggestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        suggestions.clear()
+        self.user = User.objects.create_user(username='typist', email='typist@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        Movie.objects.create(title='The Godfather', popularity_score=4.5)
+        Movie.objects.create(title='The Godfather: Part II', popularity_score=4.4)
+        Movie.objects.create(title='Godzilla', popularity_score=3.0)
+        Movie.objects.create(title='Gods and Monsters', popularity_score=3.5)
+
+    def titles(self, service, text):
+        return [movie['title'] for movie in service.suggest(text)]
+
+    def test_title_prefix_ranks_above_word_prefix(self):
+        service = SuggestionService()
+        self.assertEqual(
+            self.titles(service, 'god'),
+            ['Gods and Monsters', 'Godzilla', 'The Godfather', 'The Godfather: Part II'],
+        )
+        self.assertEqual(self.titles(service, 'the god'), ['The Godfather', 'The Godfather: Part II'])
+
+    def test_fuzzy_match_for_misspelt_title(self):
+        self.assertEqual(self.titles(SuggestionService(), 'godfater')[0], 'The Godfather')
+
+    def test_suggestions_need_no_queries(self):
+        service = SuggestionService()
+        service.suggest('god')
+        with self.assertNumQueries(0):
+            service.suggest('godz')
+
+    def test_new_movies_are_added_incrementally(self):
+        service = SuggestionService(refresh_interval=0)
+        index = service.get_index()
+        Movie.objects.create(title='Godland')
+        self.assertIn('Godland', self.titles(service, 'godl'))
+        self.assertIs(service.index, index)
+
+        # Every earlier query term must be a word of the title, as for the indexed movies
+        Movie.objects.create(title='Star Wars')
+        Movie.objects.create(title='Walking Tall')
+        self.assertEqual(self.titles(service, 'star wa'), ['Star Wars'])
+        self.assertIs(service.index, index)
+
+    def test_edited_titles_rebuild_the_index(self):
+        service = SuggestionService(refresh_interval=0)
+        service.get_index()
+        movie = Movie.objects.get(title='Godzilla')
+        movie.title = 'Gojira'
+        movie.save()
+        self.assertEqual(self.titles(service, 'goj'), ['Gojira'])
+
+    def test_suggest_endpoint(self):
+        response = self.client.get(reverse('movie_suggest'), {'q': 'Godz'})
+        self.assertEqual(response.data, [{'id': Movie.objects.get(title='Godzilla').id, 'title': 'Godzilla'}])
+        self.assertEqual(self.client.get(reverse('movie_suggest')).status_code, 400)
+
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        self.user = self.create_user('alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_user(self, username, is_private=False):
+        return User.objects.create_user(
+            username=username, email=f'{username}@example.com', password='password', is_private=is_private,
+        )
+
+    def befriend(self, other):
+        FriendRequest.objects.create(from_user=other, to_user=self.user, accepted=True)
+
+    def search(self, **params):
+        response = self.client.get(reverse('user_search'), params)
+        self.assertEqual(response.status_code, 200)
+        return [user['username'] for user in response.data['results']], response.data
+
+    def test_friends_first_then_prefix_matches(self):
+        self.create_user('bobby')
+        self.create_user('tombob')
+        self.befriend(self.create_user('jimbob'))
+        self.befriend(self.create_user('bob'))
+        usernames, _ = self.search(username='bob')
+        self.assertEqual(usernames, ['bob', 'jimbob', 'bobby', 'tombob'])
+
+    def test_private_users_only_visible_to_friends(self):
+        self.create_user('carol', is_private=True)
+        self.befriend(self.create_user('carl', is_private=True))
+        FriendRequest.objects.create(from_user=self.user, to_user=self.create_user('cara', is_private=True))
+        usernames, _ = self.search(username='car')
+        self.assertEqual(usernames, ['carl'])
+
+    def test_short_queries_match_prefixes_only(self):
+        self.create_user('eddie')
+        self.create_user('freddie')
+        usernames, _ = self.search(username='ed')
+        self.assertEqual(usernames, ['eddie'])
+
+    def test_cursor_pagination_and_limit(self):
+        for i in range(5):
+            self.create_user(f'user{i}')
+        usernames, data = self.search(username='user', page_size=3)
+        self.assertEqual(usernames, ['user0', 'user1', 'user2'])
+        response = self.client.get(data['next'])
+        self.assertEqual([user['username'] for user in response.data['results']], ['user3', 'user4'])
+        _, data = self.search(username='user', page_size=1000)
+        self.assertEqual(len(data['results']), 5)
+
+    def test_caller_is_not_listed(self):
+        usernames, _ = self.search(username='alice')
+        self.assertEqual(usernames, [])
+
+
+class FriendshipTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(username=f'friend{i}', email=f'friend{i}@example.com', password='password')
+            for i in range(4)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def edges(self):
+        return set(Friendship.objects.values_list('user_id', 'friend_id'))
+
+    def test_edges_follow_accept_and_remove(self):
+        me, other = self.users[0], self.users[1]
+        friend_request = FriendRequest.objects.create(from_user=other, to_user=me)
+        self.assertEqual(self.edges(), set())
+
+        self.client.post(reverse('update_friend_request', args=[friend_request.id]))
+        self.assertEqual(self.edges(), {(me.id, other.id), (other.id, me.id)})
+
+        self.client.delete(reverse('remove-friend', args=[other.id]))
+        self.assertEqual(self.edges(), set())
+
+    def test_friend_lists_are_one_query(self):
+        for other in self.users[1:]:
+            FriendRequest.objects.create(from_user=self.users[0], to_user=other, accepted=True)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('list_friends'))
+        self.assertEqual([user['username'] for user in response.data], ['friend1', 'friend2', 'friend3'])
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('list_user_friends', args=[self.users[2].id]))
+        self.assertEqual([user['username'] for user in response.data], ['friend0'])
+
+    def test_profile_relationship_status_is_one_query(self):
+        accepted = FriendRequest.objects.create(from_user=self.users[1], to_user=self.users[0], accepted=True)
+        outgoing = FriendRequest.objects.create(from_user=self.users[0], to_user=self.users[2])
+        incoming = FriendRequest.objects.create(from_user=self.users[3], to_user=self.users[0])
+
+        # user + relationship
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('retrieve_other_user_profile', args=[self.users[1].id]))
+        self.assertEqual((response.data['is_friend'], response.data['is_outgoing'], response.data['is_incoming']), (accepted.id, None, None))
+        response = self.client.get(reverse('retrieve_other_user_profile', args=[self.users[2].id]))
+        self.assertEqual((response.data['is_friend'], response.data['is_outgoing'], response.data['is_incoming']), (None, outgoing.id, None))
+        response = self.client.get(reverse('retrieve_other_user_profile', args=[self.users[3].id]))
+        self.assertEqual((response.data['is_friend'], response.data['is_outgoing'], response.data['is_incoming']), (None, None, incoming.id))
+
+    def test_install_friendships_backfills_edges(self):
+        FriendRequest.objects.create(from_user=self.users[0], to_user=self.users[1], accepted=True)
+        FriendRequest.objects.create(from_user=self.users[2], to_user=self.users[0])
+        Friendship.objects.all().delete()
+        call_command('install_friendships', stdout=StringIO())
+        self.assertEqual(self.edges(), {(self.users[0].id, self.users[1].id), (self.users[1].id, self.users[0].id)})
+
+
+class FriendRecommendationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.me, self.alike, self.unlike, self.distant = [
+            User.objects.create_user(username=name, email=f'{name}@example.com', password='password')
+            for name in ('me', 'alike', 'unlike', 'distant')
+        ]
+        self.movies = {title: Movie.objects.create(title=title) for title in 'ABCDEF'}
+        for friend in (self.alike, self.unlike):
+            FriendRequest.objects.create(from_user=self.me, to_user=friend, accepted=True)
+        FriendRequest.objects.create(from_user=self.alike, to_user=self.distant, accepted=True)
+
+        self.rate(self.me, A=5, B=1)
+        self.rate(self.alike, A=5, B=1, C=5, F=2)
+        self.rate(self.unlike, A=2, B=4, D=5, F=1)
+        self.rate(self.distant, A=5, B=1, E=5, F=1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def rate(self, user, **ratings):
+        Rating.objects.bulk_create([Rating(user=user, movie=self.movies[title], rating=value) for title, value in ratings.items()])
+
+    def titles(self):
+        response = self.client.get(reverse('retrieve_friend_movies'))
+        self.assertEqual(response.status_code, 200)
+        return [movie['title'] for movie in response.data]
+
+    def test_similar_friends_count_most(self):
+        # C is liked by a like-minded friend, D by a less like-minded one, E by a friend-of-friend
+        self.assertEqual(self.titles(), ['C', 'D', 'E'])
+
+    def test_watchlisted_movies_are_excluded_and_cache_invalidated(self):
+        self.titles()
+        # only the movies; the ranked ids are cached
+        with self.assertNumQueries(1):
+            self.titles()
+        self.me.watchlist.add(self.movies['C'])
+        self.assertEqual(self.titles(), ['D', 'E'])
+
+    def test_changes_in_another_process_invalidate_the_cache(self):
+        self.titles()
+        # The watchlist change runs with a separate local memory cache, as another gunicorn worker would
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'other-worker'}}):
+            self.me.watchlist.add(self.movies['C'])
+        with versions_expire():
+            self.assertEqual(self.titles(), ['D', 'E'])
+
+    def test_user_without_friends(self):
+        self.client.force_authenticate(User.objects.create_user(username='loner', email='loner@example.com', password='password'))
+        self.assertEqual(self.titles(), [])
+
+
+class SVDFactorTests(TestCase):
+    def setUp(self):
+        self.movies = [Movie.objects.create(title=f'Movie {i}') for i in range(6)]
+        self.users = [User.objects.create_user(username=f'svd{i}', email=f'svd{i}@example.com', password='password') for i in range(5)]
+        # Two tastes: movies 0-2 and movies 3-5
+        ratings = [
+            (0, {0: 5, 1: 4, 2: 5}), (1, {0: 4, 1: 5, 3: 1}), (2, {3: 5, 4: 4, 5: 5}),
+            (3, {3: 4, 4: 5, 0: 1}), (4, {0: 5, 2: 4, 5: 1}),
+        ]
+        Rating.objects.bulk_create([
+            Rating(user=self.users[user], movie=self.movies[movie], rating=value)
+            for user, rated in ratings for movie, value in rated.items()
+        ])
+        self.factors = get_user_factors_items_factors(n_components=2)
+
+    def test_fold_in_matches_the_fitted_user_factors(self):
+        for user in self.users:
+            ratings = list(Rating.objects.filter(user=user).values_list('movie_id', 'rating'))
+            row = self.factors.user_index[user.id]
+            np.testing.assert_allclose(self.factors.fold_in(ratings), self.factors.user_factors[row], rtol=1e-4, atol=1e-4)
+
+    def test_recommendations_exclude_rated_and_excluded_movies(self):
+        ratings = [(self.movies[0].id, 5.0), (self.movies[1].id, 4.0)]
+        ranked = factor_movie_ids(self.factors, -1, ratings, top_n=6)
+        # A new user is folded in; their taste's unrated movie comes first
+        self.assertEqual(ranked[0], self.movies[2].id)
+        self.assertEqual(set(ranked), {movie.id for movie in self.movies[2:]})
+        self.assertNotIn(self.movies[2].id, factor_movie_ids(self.factors, -1, ratings, top_n=6, exclude={self.movies[2].id}))
+        self.assertEqual(factor_movie_ids(self.factors, -1, [], top_n=6), [])
+
+    def test_command_saves_factors_the_request_path_loads(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'svd_factors.npz'
+            with mock.patch.object(registry, 'path', return_value=path):
+                call_command('build_svd_factors', '--components', '2', stdout=StringIO())
+            loaded = load_svd_factors(path)
+        self.assertEqual(sorted(loaded.user_ids.tolist()), sorted(user.id for user in self.users))
+        with mock.patch.object(registry, 'get', return_value=loaded):
+            ranked = recommend_movie_ids(self.users[1], top_n=3)
+        # User 1 rated 0, 1 and 3; 2 is the remaining movie of their taste
+        self.assertEqual(ranked[0], self.movies[2].id)
+        self.assertFalse({movie.id for movie in self.movies[:2]} & set(ranked))
+
+
+class RecommendationEventTests(TestCase):
+    def setUp(self):
+        self.user, self.other = [
+            User.objects.create_user(username=name, email=f'{name}@example.com', password='password') for name in ('events', 'other')
+        ]
+        self.movie = Movie.objects.create(title='Movie', movie_id=1)
+
+    def events(self):
+        return list(RecommendationEvent.objects.order_by('id').values_list('user_id', 'reason'))
+
+    def test_ratings_watches_and_watchlist_changes_enqueue_events(self):
+        rating = Rating.objects.create(user=self.user, movie=self.movie, rating=4.0)
+        rating.delete()
+        watched = WatchedMovie.objects.create(user=self.user, movie=self.movie)
+        watched.delete()
+        self.user.watchlist.add(self.movie)
+        self.user.watchlist.remove(self.movie)
+        RATING, WATCHED, WATCHLIST = RecommendationEvent.RATING, RecommendationEvent.WATCHED, RecommendationEvent.WATCHLIST
+        self.assertEqual(self.events(), [(self.user.id, reason) for reason in (RATING, RATING, WATCHED, WATCHED, WATCHLIST, WATCHLIST)])
+
+    def test_watchlist_changes_from_the_movie_side_enqueue_every_user(self):
+        self.movie.watchlisted_by.add(self.user, self.other)
+        RecommendationEvent.objects.all().delete()
+        self.movie.watchlisted_by.clear()
+        self.assertEqual(sorted(self.events()), [(self.user.id, 'watchlist'), (self.other.id, 'watchlist')])
+
+    def test_deleting_a_user_enqueues_nothing(self):
+        Rating.objects.create(user=self.user, movie=self.movie, rating=4.0)
+        WatchedMovie.objects.create(user=self.user, movie=self.movie)
+        self.user.delete()
+        self.assertEqual(self.events(), [])
+
+    def test_worker_once_processes_pending_events_and_purges_old_ones(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        old = RecommendationEvent.objects.create(user=self.other, reason='rating', processed_at=now - datetime.timedelta(days=30))
+        Rating.objects.create(user=self.user, movie=self.movie, rating=4.0)
+        self.movie.watchlisted_by.add(self.other)
+
+        with mock.patch('api.algorithms.recommendations.top_movies_for_users',
+                        side_effect=lambda user_ids, top_n: {user_id: [(1, 0.9)] for user_id in user_ids}) as score:
+            call_command('process_recommendation_events', '--once', '--batch-size', '1', stdout=StringIO())
+        self.assertEqual([call.args[0] for call in score.call_args_list], [[self.user.id], [self.other.id]])
+        self.assertFalse(RecommendationEvent.objects.filter(id=old.id).exists())
+        self.assertFalse(RecommendationEvent.objects.filter(processed_at__isnull=True).exists())
+        self.assertEqual(list(UserRecommendation.objects.values_list('user_id', flat=True).order_by('user_id')), [self.user.id, self.other.id])
+
+    def test_worker_keeps_running_after_a_failed_batch(self):
+        class Stop(BaseException):
+            pass
+
+        Rating.objects.create(user=self.user, movie=self.movie, rating=4.0)
+        results = [FileNotFoundError('svd_factors.npz'), {self.user.id: [(1, 0.9)]}]
+
+        def score(user_ids, top_n):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        command = 'api.management.commands.process_recommendation_events'
+        # The second sleep (with nothing left to do) ends the loop
+        with mock.patch('api.algorithms.recommendations.top_movies_for_users', side_effect=score), \
+                mock.patch(f'{command}.close_old_connections'), \
+                mock.patch(f'{command}.time.sleep', side_effect=[None, Stop]), \
+                self.assertLogs(command, 'ERROR'):
+            with self.assertRaises(Stop):
+                call_command('process_recommendation_events', '--interval', '0', stdout=StringIO())
+        self.assertEqual(results, [])
+        self.assertFalse(RecommendationEvent.objects.filter(processed_at__isnull=True).exists())
+
+
+class StoredRecommendationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='stored', email='stored@example.com', password='password')
+        self.movies = [Movie.objects.create(title=f'Movie {i}', movie_id=100 + i) for i in range(3)]
+        patcher = mock.patch('api.algorithms.recommendations.top_movies_for_users')
+        self.score = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.score.side_effect = lambda user_ids, top_n: {user_id: [(102, 0.9), (100, 0.8)] for user_id in user_ids}
+
+    def test_missing_list_is_scored_and_stored(self):
+        self.assertEqual(get_recommendations(self.user), [self.movies[2].id, self.movies[0].id])
+        self.assertEqual(UserRecommendationState.objects.get(user=self.user).count, 2)
+        self.assertEqual(self.score.call_count, 1)
+
+    def test_fresh_list_is_served_without_scoring(self):
+        get_recommendations(self.user)
+        # freshness + list
+        with self.assertNumQueries(2):
+            self.assertEqual(get_recommendations(self.user), [self.movies[2].id, self.movies[0].id])
+        self.assertEqual(self.score.call_count, 1)
+
+    def test_stale_list_is_rescored_and_its_events_processed(self):
+        get_recommendations(self.user)
+        Rating.objects.create(user=self.user, movie=self.movies[1], rating=4.0)
+        self.score.side_effect = lambda user_ids, top_n: {user_id: [(100, 0.7)] for user_id in user_ids}
+        self.assertEqual(get_recommendations(self.user), [self.movies[0].id])
+        self.assertFalse(RecommendationEvent.objects.filter(processed_at__isnull=True).exists())
+        self.assertEqual(self.score.call_count, 2)
+
+    def test_events_recorded_while_scoring_stay_pending(self):
+        def score(user_ids, top_n):
+            RecommendationEvent.objects.create(user=self.user, reason=RecommendationEvent.RATING,
+                                               created_at=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=1))
+            return {user_id: [] for user_id in user_ids}
+        self.score.side_effect = score
+        get_recommendations(self.user)
+        self.assertEqual(RecommendationEvent.objects.filter(processed_at__isnull=True).count(), 1)
+        get_recommendations(self.user)
+        self.assertEqual(self.score.call_count, 2)
+
+    def test_empty_list_counts_as_fresh(self):
+        self.score.side_effect = lambda user_ids, top_n: {user_id: [] for user_id in user_ids}
+        self.assertEqual(get_recommendations(self.user), [])
+        self.assertEqual(get_recommendations(self.user), [])
+        self.assertEqual(self.score.call_count, 1)
+        self.assertEqual(UserRecommendationState.objects.get(user=self.user).count, 0)
+
+
+class FeatureMatrixTests(TestCase):
+    def setUp(self):
+        self.movie_df = pd.DataFrame({
+            'movie_id': [10, 20, 30],
+            'runtime': [90.0, 120.0, 101.0],
+            'adult': [0, 1, 0],
+            'genres': ['Action, Comedy', 'Drama', ''],
+            'directors': ['Nolan Scott', 'Scott', 'Unknown'],
+            'keywords': ['heist heist space', '', 'space'],
+        })
+        self.vectorizer = TfidfVectorizer(stop_words='english').fit(self.movie_df['genres'])
+        self.w2v_director = Word2Vec([['Nolan', 'Scott'], ['Scott']], vector_size=50, min_count=1, workers=1, seed=1)
+        self.w2v_keyword = Word2Vec([['heist', 'space']], vector_size=50, min_count=1, workers=1, seed=1)
+        self.genres = list(self.vectorizer.get_feature_names_out())
+        self.feature_names = ['movie_id', 'runtime', 'adult', 'user_id'] + self.genres + \
+            [f'{i+1}director' for i in range(50)] + [f'{i+1}keyword' for i in range(50)]
+
+    def per_row_features(self, user_id):
+        # The features as the recommenders used to build them, one movie at a time
+        def mean(model, words):
+            vectors = [model.wv[word] for word in words if word in model.wv]
+            return np.mean(vectors, axis=0) if vectors else np.zeros(50)
+
+        genres = self.vectorizer.transform(self.movie_df['genres']).toarray()
+        rows = []
+        for index, movie in self.movie_df.iterrows():
+            rows.append([movie['movie_id'], movie['runtime'], movie['adult'], user_id, *genres[index],
+                         *mean(self.w2v_director, movie['directors'].split()), *mean(self.w2v_keyword, movie['keywords'].split())])
+        return np.array(rows, dtype=np.float32)
+
+    def test_vectorised_matrix_matches_per_row_features(self):
+        matrix = build_feature_matrix(self.movie_df, self.feature_names, self.vectorizer, self.w2v_director, self.w2v_keyword)
+        self.assertEqual(matrix.movie_ids.tolist(), [10, 20, 30])
+        np.testing.assert_allclose(matrix.for_user(7), self.per_row_features(7), rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(matrix.for_users([7, 8])[3:], self.per_row_features(8), rtol=1e-5, atol=1e-6)
+
+    def test_saved_matrix_loads_the_same(self):
+        matrix = build_feature_matrix(self.movie_df, self.feature_names, self.vectorizer, self.w2v_director, self.w2v_keyword)
+        with tempfile.TemporaryDirectory() as directory:
+            matrix.save(f'{directory}/features.npz')
+            loaded = load_feature_matrix(f'{directory}/features.npz')
+        self.assertEqual(loaded.feature_names, self.feature_names)
+        self.assertEqual(loaded.movie_index, {10: 0, 20: 1, 30: 2})
+        np.testing.assert_array_equal(loaded.features, matrix.features)
+
+
+class ModelRegistryTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'model.txt'
+        self.path.write_text('first')
+        self.loads = []
+        self.registry = ModelRegistry(check_interval=0)
+        self.registry.register('model', self.path, self.load)
+
+    def load(self, path):
+        self.loads.append(path)
+        return Path(path).read_text()
+
+    def test_artifacts_load_lazily_and_once(self):
+        self.assertEqual(self.loads, [])
+        self.assertEqual(self.registry.get('model'), 'first')
+        self.assertEqual(self.registry.get('model'), 'first')
+        self.assertEqual(len(self.loads), 1)
+
+    def test_changed_file_is_reloaded(self):
+        self.registry.get('model')
+        self.path.write_text('second')
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.registry.get('model'), 'second')
+        self.assertEqual(len(self.loads), 2)
+
+    def test_touched_file_with_same_checksum_is_not_reloaded(self):
+        self.registry.get('model')
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.registry.get('model'), 'first')
+        self.assertEqual(len(self.loads), 1)
+
+    def test_missing_file_keeps_the_loaded_copy(self):
+        self.registry.get('model')
+        self.path.unlink()
+        self.assertEqual(self.registry.get('model'), 'first')
+
+    def test_file_is_only_checked_once_per_interval(self):
+        self.registry.check_interval = 60
+        self.registry.get('model')
+        self.path.write_text('second')
+        self.assertEqual(self.registry.get('model'), 'first')
+
+    def register_pair(self):
+        # A "model" and "matrix" that only work together when their versions match
+        self.matrix_path = self.path.with_name('matrix.txt')
+        self.matrix_path.write_text('first')
+        self.registry.register('matrix', self.matrix_path, self.load)
+        self.registry.register_group(['model', 'matrix'], lambda model, matrix: model == matrix)
+        self.assertEqual((self.registry.get('model'), self.registry.get('matrix')), ('first', 'first'))
+
+    def replace(self, path, text):
+        path.write_text(text)
+        os.utime(path, (time.time() + 10, time.time() + 10))
+
+    def test_group_keeps_serving_the_old_pair_until_both_files_match(self):
+        self.register_pair()
+        self.replace(self.path, 'second')
+        with self.assertLogs('api.algorithms.registry', 'WARNING'):
+            self.assertEqual(self.registry.get('model'), 'first')
+        self.assertEqual(self.registry.get('matrix'), 'first')
+
+        self.replace(self.matrix_path, 'second')
+        self.assertEqual(self.registry.get('model'), 'second')
+        self.assertEqual(self.registry.get('matrix'), 'second')
+
+    def test_group_reloads_together_from_either_member(self):
+        self.register_pair()
+        self.replace(self.path, 'second')
+        self.replace(self.matrix_path, 'second')
+        # Looking up the matrix reloads the model in the same step
+        self.assertEqual(self.registry.get('matrix'), 'second')
+        self.assertEqual(self.loads[-2:], [self.path, self.matrix_path])
+        self.registry.check_interval = 60
+        self.assertEqual(self.registry.get('model'), 'second')
+
+    def test_group_is_read_from_one_snapshot(self):
+        self.register_pair()
+        load = self.load
+
+        def load_and_install_matrix(path):
+            # The install replaces the matrix while the new model is being loaded
+            if path == self.path:
+                self.replace(self.matrix_path, 'second')
+            return load(path)
+        self.registry._artifacts['model'].loader = load_and_install_matrix
+
+        self.replace(self.path, 'second')
+        with self.assertLogs('api.algorithms.registry', 'WARNING'):
+            self.assertEqual(self.registry.get_group(['model', 'matrix']), ('first', 'first'))
+        self.assertEqual(self.registry.get_group(['model', 'matrix']), ('second', 'second'))
+
+    def test_features_match_compares_the_booster_with_the_matrix_columns(self):
+        names = ['movie_id', 'runtime', 'user_id']
+        model = XGBClassifier(n_estimators=2, max_depth=2)
+        model.fit(pd.DataFrame(np.eye(3, dtype=np.float32), columns=names), [0, 1, 1])
+        matrix = FeatureMatrix(np.array([1, 2, 3]), np.eye(3, dtype=np.float32), names)
+        self.assertTrue(features_match(model, matrix))
+        self.assertFalse(features_match(model, FeatureMatrix(matrix.movie_ids, matrix.features, ['movie_id', 'adult', 'user_id'])))
+        self.assertFalse(features_match(model, FeatureMatrix(matrix.movie_ids, np.eye(3, 4, dtype=np.float32), names + ['adult'])))
+
+    @override_settings(RECOMMENDER_PRELOAD=True)
+    def test_management_commands_do_not_preload(self):
+        with mock.patch.object(registry, 'preload') as preload:
+            apps.get_app_config('api').ready()
+        preload.assert_not_called()
+
+
+class UserProfileFeatureTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        names = ['movie_id', 'runtime', 'adult', 'action', 'comedy'] + \
+                [f'{i+1}director' for i in range(50)] + [f'{i+1}keyword' for i in range(50)] + \
+                PROFILE_FEATURES + ['user_action', 'user_comedy']
+        rng = np.random.default_rng(0)
+        features = np.zeros((3, len(names)), dtype=np.float32)
+        features[:, 0] = [1, 2, 3]
+        features[:, 3:105] = rng.random((3, 102))
+        self.matrix = FeatureMatrix(np.array([1, 2, 3]), features, names)
+        self.movies = [Movie.objects.create(title=f'Movie {i}', movie_id=i) for i in (1, 2, 3)]
+        self.user = User.objects.create_user(username='profiled', password='pass')
+
+    def column(self, matrix, name):
+        return matrix[:, self.matrix.feature_names.index(name)]
+
+    def test_catalog_and_pairwise_layouts_agree(self):
+        profiles = UserProfiles.from_ratings(self.matrix, np.array([0, 0, 1]), np.array([0, 1, 2]), np.array([5.0, 2.0, 4.0]), 2)
+        catalog = self.matrix.for_users([10, 11], profiles)
+        pairs = self.matrix.features[[0, 1, 2, 0, 1, 2]]
+        self.matrix.fill_profiles(pairs, profiles.take([0, 0, 0, 1, 1, 1]), np.array([0, 1, 2, 0, 1, 2]))
+        np.testing.assert_allclose(catalog, pairs, rtol=1e-5)
+        self.assertEqual(self.column(catalog, 'user_mean_rating').tolist(), [3.5] * 3 + [4.0] * 3)
+        self.assertEqual(self.column(catalog, 'user_rating_count').tolist(), [2] * 3 + [1] * 3)
+
+    def test_new_user_has_an_empty_profile(self):
+        matrix = self.matrix.for_users([self.user.id], load_user_profiles(self.matrix, [self.user.id]))
+        self.assertTrue(np.isnan(self.column(matrix, 'user_mean_rating')).all())
+        self.assertEqual(self.column(matrix, 'genre_affinity').tolist(), [0, 0, 0])
+
+    def test_cached_profile_follows_new_ratings(self):
+        self.assertEqual(load_user_profiles(self.matrix, [self.user.id]).counts.tolist(), [0])
+        Rating.objects.create(user=self.user, movie=self.movies[0], rating=4.0)
+        profiles = load_user_profiles(self.matrix, [self.user.id])
+        self.assertEqual((profiles.counts.tolist(), profiles.totals.tolist()), ([1], [4.0]))
+        # only the rating state
+        with self.assertNumQueries(1):
+            load_user_profiles(self.matrix, [self.user.id])
+
+    def test_cached_profile_follows_changes_that_skip_the_signals(self):
+        rating = Rating.objects.create(user=self.user, movie=self.movies[0], rating=4.0)
+        self.assertEqual(load_user_profiles(self.matrix, [self.user.id]).totals.tolist(), [4.0])
+        # A bulk update (or a rating made by another process) bumps no cache version
+        Rating.objects.filter(id=rating.id).update(rating=2.0)
+        self.assertEqual(load_user_profiles(self.matrix, [self.user.id]).totals.tolist(), [2.0])
+        Rating.objects.filter(id=rating.id).delete()
+        Rating.objects.bulk_create([Rating(user=self.user, movie=self.movies[1], rating=2.0)])
+        profiles = load_user_profiles(self.matrix, [self.user.id])
+        self.assertEqual(profiles.sums['genres'].tolist(), compute_user_profiles(self.matrix, [self.user.id]).sums['genres'].tolist())
+
+
+class TwoStageRecommendationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.movies = [
+            Movie.objects.create(title=f'Movie {i}', movie_id=100 + i, runtime=10 * i, popularity_score=10 - i)
+            for i in range(10)
+        ]
+        self.pks = np.array([movie.id for movie in self.movies])
+        self.user = User.objects.create_user(username='twostage', email='twostage@example.com', password='password')
+        Rating.objects.create(user=self.user, movie=self.movies[0], rating=5.0)
+        Rating.objects.create(user=self.user, movie=self.movies[1], rating=2.0)
+        self.user.watchlist.add(self.movies[2])
+        Movie.similar_movies.through.objects.bulk_create([
+            Movie.similar_movies.through(from_movie_id=self.pks[0], to_movie_id=self.pks[5]),
+            Movie.similar_movies.through(from_movie_id=self.pks[0], to_movie_id=self.pks[6]),
+            Movie.similar_movies.through(from_movie_id=self.pks[1], to_movie_id=self.pks[7]),
+        ])
+
+        # Only movies 0, 1 and 3 are in the SVD fit; 3 points the same way as the liked 0
+        factor_movies = self.pks[[0, 1, 3]]
+        item_factors = np.array([[1, 0], [0, 1], [1, 0.1]], dtype=np.float32)
+        # Movies 3 and 4 look the same, the rest are orthogonal
+        embeddings = np.eye(10, dtype=np.float32)
+        embeddings[4] = embeddings[3]
+        self.artifacts = {
+            'svd_factors': SVDFactors(np.array([], dtype=np.int64), factor_movies, np.zeros((0, 2), dtype=np.float32), item_factors),
+            'similar_index': SimilarityIndex(self.pks, embeddings, embeddings[:1], np.zeros(10, dtype=np.int64)),
+        }
+        patcher = mock.patch.object(registry, 'get', side_effect=self.artifacts.__getitem__)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_candidates_come_from_each_source_without_seen_movies(self):
+        # factors, then neighbours of the liked movie, then popular movies
+        expected = self.pks[[3, 5, 6, 4, 7, 8, 9]].tolist()
+        self.assertEqual(generate_candidates([self.user.id])[self.user.id], expected)
+        self.assertEqual(generate_candidates([self.user.id], count=4)[self.user.id], expected[:4])
+
+    def test_model_scores_only_the_candidates(self):
+        names = ['movie_id', 'runtime', 'user_id']
+        features = FeatureMatrix(np.arange(100, 110), np.column_stack([np.arange(100, 110), np.arange(10) * 10, np.zeros(10)]).astype(np.float32), names)
+        model = mock.Mock()
+        model.predict_proba.side_effect = lambda matrix: np.column_stack([1 - matrix[:, 1] / 100, matrix[:, 1] / 100])
+
+        candidates = {self.user.id: self.pks[[8, 3, 6]].tolist()}
+        pks, movie_ids, scores = score_candidates(model, features, [self.user.id], candidates)[self.user.id]
+        matrix = model.predict_proba.call_args[0][0]
+        self.assertEqual(matrix.shape, (3, 3))
+        self.assertEqual(matrix[:, 2].tolist(), [self.user.id] * 3)
+        self.assertEqual(movie_ids.tolist(), [108, 103, 106])
+        np.testing.assert_allclose(scores, [0.8, 0.3, 0.6])
+
+    def test_rerank_is_deterministic_and_spreads_similar_movies(self):
+        pks = self.pks[[3, 4, 7]]
+        scores = np.array([0.9, 0.89, 0.8])
+        index = self.artifacts['similar_index']
+        order = diversify(self.user.id, pks, scores, index, 3)
+        # 4 is as likely as 3 but the same kind of movie, so 7 goes between them
+        self.assertEqual(pks[order].tolist(), self.pks[[3, 7, 4]].tolist())
+        self.assertEqual(diversify(self.user.id, pks, scores, index, 3), order)
+        self.assertEqual(diversify(self.user.id, pks, scores, index, 2), order[:2])
+
+    def test_missing_sources_are_skipped(self):
+        def get(name):
+            if name in self.missing:
+                raise FileNotFoundError(name)
+            return self.artifacts[name]
+        registry.get.side_effect = get
+        self.missing = {'svd_factors', 'similar_index'}
+
+        # Without the factors the neighbours of the liked movie come first
+        with self.assertLogs('api.algorithms.registry', 'WARNING') as logs:
+            candidates = generate_candidates([self.user.id])[self.user.id]
+        self.assertIn('svd_factors', logs.output[0])
+        self.assertEqual(candidates, self.pks[[5, 6, 3, 4, 7, 8, 9]].tolist())
+
+        names = ['movie_id', 'runtime', 'user_id']
+        features = FeatureMatrix(np.arange(100, 110), np.column_stack([np.arange(100, 110), np.arange(10) * 10, np.zeros(10)]).astype(np.float32), names)
+        model = mock.Mock()
+        model.predict_proba.side_effect = lambda matrix: np.column_stack([1 - matrix[:, 1] / 100, matrix[:, 1] / 100])
+        with self.assertLogs('api.algorithms.registry', 'WARNING'):
+            ranked = rank_movies_for_users(model, features, [self.user.id], top_n=3)[self.user.id]
+        # Without the similarity index the most likely movies come first
+        self.assertEqual([movie_id for movie_id, _ in ranked], [109, 108, 107])
+
+        self.missing = set()
+        pks = self.pks[[3, 4, 7]]
+        scores = np.array([0.9, 0.89, 0.8])
+        self.assertEqual(diversify(self.user.id, pks, scores, None, 3), [0, 1, 2])
+
+    def test_view_shows_the_stored_ranking_in_order(self):
+        UserRecommendation.objects.bulk_create([
+            UserRecommendation(user=self.user, movie=self.movies[i], rank=rank, score=0.5)
+            for rank, i in enumerate([9, 4, 7, 3, 5, 6, 8])
+        ])
+        UserRecommendationState.objects.create(user=self.user, count=7)
+        RecommendationEvent.objects.update(processed_at=datetime.datetime.now(datetime.timezone.utc))
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(reverse('retrieve_movies'))
+        self.assertEqual([movie['title'] for movie in response.data], [f'Movie {i}' for i in [9, 4, 7, 3, 5, 6, 8]])
+
+
+class SimilarMoviesIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        rng = np.random.default_rng(1)
+        # Four well separated groups of 50 movies
+        centres = normalize_rows(rng.normal(size=(4, 16)))
+        self.embeddings = normalize_rows(np.repeat(centres, 50, axis=0) + rng.normal(scale=0.05, size=(200, 16))).astype(np.float32)
+        self.movie_ids = np.arange(1000, 1200)
+        centroids, assignments = kmeans(self.embeddings, 4)
+        self.index = SimilarityIndex(self.movie_ids, self.embeddings, centroids, assignments)
+
+    def exact(self, row, k):
+        scores = self.embeddings @ self.embeddings[row]
+        scores[row] = -np.inf
+        return self.movie_ids[np.argsort(-scores)[:k]].tolist()
+
+    def test_neighbours_match_exact_search(self):
+        for row in (0, 75, 199):
+            neighbours = [movie_id for movie_id, _ in self.index.neighbours(int(self.movie_ids[row]), 5)]
+            self.assertEqual(neighbours, self.exact(row, 5))
+
+    def test_saved_index_loads_the_same(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/similar_movies.npz'
+            self.index.sources = {'tfidf_w2v': 'abc'}
+            self.index.save(path)
+            loaded = load_similarity_index(path)
+        self.assertEqual(loaded.neighbours(1010, 5), self.index.neighbours(1010, 5))
+        self.assertEqual(loaded.sources, {'tfidf_w2v': 'abc'})
+
+    def test_new_movies_are_only_embedded_with_the_models_the_index_was_built_with(self):
+        self.index.sources = {name: f'{name}-1' for name in EMBEDDING_ARTIFACTS}
+        checksums = dict(self.index.sources)
+        with mock.patch.object(registry, 'get', return_value=self.index), \
+                mock.patch.object(registry, 'checksum', side_effect=checksums.__getitem__), \
+                mock.patch('api.algorithms.similarity.embed_movies', return_value=self.embeddings[[10]]) as embed:
+            # Embedded like movie 1010, so it lands next to it
+            self.assertEqual(similar_movie_ids(5000, 5), [1010] + self.exact(10, 4))
+            self.assertEqual(embed.call_count, 1)
+
+            # After a retrain the new vectors are not comparable with the saved ones
+            checksums['w2v_keyword'] = 'w2v_keyword-2'
+            with self.assertLogs('api.algorithms.similarity', 'WARNING'):
+                self.assertEqual(similar_movie_ids(5000, 5), [])
+            self.assertEqual(embed.call_count, 1)
+
+    def test_view_keeps_rank_order_and_falls_back_to_index(self):
+        movie, first, second = [Movie.objects.create(title=title) for title in ('Heat', 'Ronin', 'Collateral')]
+        Movie.similar_movies.through.objects.bulk_create([
+            Movie.similar_movies.through(from_movie_id=movie.id, to_movie_id=second.id),
+            Movie.similar_movies.through(from_movie_id=movie.id, to_movie_id=first.id),
+        ])
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='similar', email='similar@example.com', password='password'))
+        response = client.get(reverse('similar_movies', args=[movie.id]))
+        self.assertEqual([m['title'] for m in response.data], ['Collateral', 'Ronin'])
+
+        # A movie without stored neighbours is looked up in the index
+        with mock.patch('api.views.similar_movie_ids', return_value=[movie.id, second.id]) as lookup:
+            response = client.get(reverse('similar_movies', args=[first.id]))
+        lookup.assert_called_once_with(first.id)
+        self.assertEqual([m['title'] for m in response.data], ['Heat', 'Collateral'])
+
+
+class InstallRatingsTests(TestCase):
+    def setUp(self):
+        self.toy_story = Movie.objects.create(title='Toy Story', movie_id=1)
+        self.jumanji = Movie.objects.create(title='Jumanji', movie_id=2)
+        self.csv = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        self.csv.write('userId,movieId,rating,timestamp\n1,1,4.0,964982703\n1,2,3.0,964981247\n2,1,5.0,964982224\n2,99,1.0,964982224\n')
+        self.csv.close()
+
+    def tearDown(self):
+        os.unlink(self.csv.name)
+
+    def test_bulk_import_keeps_timestamps_and_totals(self):
+        call_command('install_ratings', self.csv.name, '--chunk-size', '2', stdout=StringIO())
+        user = User.objects.get(username='user1')
+        self.assertTrue(user.check_password('genericpassword123'))
+        rating = Rating.objects.get(user=user, movie=self.toy_story)
+        self.assertEqual(rating.timestamp, datetime.datetime(2000, 7, 30, 18, 45, 3, tzinfo=datetime.timezone.utc))
+        self.toy_story.refresh_from_db()
+        self.assertEqual((self.toy_story.rating_count, self.toy_story.avg_rating), (2, 4.5))
+
+    def test_rerun_does_not_duplicate(self):
+        call_command('install_ratings', self.csv.name, stdout=StringIO())
+        call_command('install_ratings', self.csv.name, stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='user').count(), 2)
+        self.assertEqual(Rating.objects.count(), 3)
+
+
+class InstallMoviesAndLinksTests(TestCase):
+    def write_csv(self, content):
+        f = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        f.write(content)
+        f.close()
+        self.addCleanup(os.unlink, f.name)
+        return f.name
+
+    def genres(self, movie_id):
+        return sorted(Movie.objects.get(movie_id=movie_id).genres.values_list('name', flat=True))
+
+    def test_install_movies_is_idempotent_and_syncs_genres(self):
+        path = self.write_csv('movieId,title,genres\n1,Toy Story (1995),Animation|Comedy\n2,Jumanji (1995),Adventure\n')
+        call_command('install_movies', path, stdout=StringIO())
+        call_command('install_movies', path, stdout=StringIO())
+        self.assertEqual(Movie.objects.count(), 2)
+        self.assertEqual(Movie.genres.through.objects.count(), 3)
+
+        path = self.write_csv('movieId,title,genres\n1,Toy Story (1995),Animation|Children\n2,Jumanji,Adventure\n')
+        call_command('install_movies', path, stdout=StringIO())
+        self.assertEqual(self.genres(1), ['Animation', 'Children'])
+        self.assertEqual(Movie.objects.get(movie_id=2).title, 'Jumanji')
+
+    def test_install_links_skips_duplicates_and_swaps(self):
+        for movie_id in (1, 2, 3):
+            Movie.objects.create(title=f'Movie {movie_id}', movie_id=movie_id)
+        out = StringIO()
+        call_command('install_links', self.write_csv('movieId,imdbId,tmdbId\n1,1,100\n2,2,200\n3,3,100\n4,4,400\n5,5,\n'), stdout=out)
+        self.assertEqual(dict(Movie.objects.values_list('movie_id', 'tmdb_id')), {1: 100, 2: 200, 3: None})
+        self.assertIn('1 rows had duplicate', out.getvalue())
+
+        # Swapping two tmdb_ids does not trip the unique constraint
+        call_command('install_links', self.write_csv('movieId,imdbId,tmdbId\n1,1,200\n2,2,100\n'), stdout=StringIO())
+        self.assertEqual(dict(Movie.objects.values_list('movie_id', 'tmdb_id')), {1: 200, 2: 100, 3: None})
+
+
+class ExportDatasetsTests(TestCase):
+    def setUp(self):
+        self.output = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output.cleanup)
+        self.toy_story = Movie.objects.create(title='Toy Story', movie_id=1, runtime=81, release_date='1995-10-30')
+        self.toy_story.genres.add(Genre.objects.create(name='Animation'), Genre.objects.create(name='Comedy'))
+        self.toy_story.directors.add(Director.objects.create(name='John Lasseter'))
+        self.toy_story.keywords.add(Keyword.objects.create(name='toy'), Keyword.objects.create(name='friendship'))
+        self.unlinked = Movie.objects.create(title='Ünlinked', adult=True)
+        user = User.objects.create_user(username='alice', password='pass')
+        Rating.objects.create(user=user, movie=self.toy_story, rating=4.5)
+        Rating.objects.create(user=user, movie=self.unlinked, rating=2.0)
+
+    def test_exports_typed_movie_and_rating_columns(self):
+        call_command('export_datasets', '--output-dir', self.output.name, '--chunk-size', '1', stdout=StringIO())
+
+        movies = load_columns(os.path.join(self.output.name, 'movies.npz'))
+        self.assertEqual(movies['movie_id'].tolist(), [1, -1])
+        self.assertEqual(movies['title'], ['Toy Story', 'Ünlinked'])
+        self.assertEqual(movies['genres'], [['Animation', 'Comedy'], []])
+        self.assertEqual(movies['release_date'][0], np.datetime64('1995-10-30'))
+        self.assertTrue(np.isnan(movies['runtime'][1]))
+
+        ratings = load_columns(os.path.join(self.output.name, 'ratings.npz'))
+        self.assertEqual(ratings['movie_id'].tolist(), [1, -1])
+        self.assertEqual(ratings['rating'].dtype, np.float32)
+        self.assertEqual(ratings['timestamp'][0], int(Rating.objects.get(movie=self.toy_story).timestamp.timestamp()))
+
+    def test_movie_dataset_matches_feature_csv_format(self):
+        call_command('export_datasets', '--output-dir', self.output.name, '--skip-ratings', stdout=StringIO())
+        self.assertFalse(os.path.exists(os.path.join(self.output.name, 'ratings.npz')))
+        movie_df = read_movie_dataset(os.path.join(self.output.name, 'movies.npz'))
+        self.assertEqual(movie_df.to_dict('records'), [{
+            'movie_id': 1, 'runtime': 81.0, 'adult': 0, 'genres': 'Animation, Comedy',
+            'directors': 'John Lasseter', 'keywords': 'toy friendship',
+        }])
+
+
+class TrainRecommenderTests(TestCase):
+    def setUp(self):
+        self.output = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output.cleanup)
+        genres = [Genre.objects.create(name=name) for name in ('Action', 'Comedy', 'Drama')]
+        movies = []
+        for i in range(12):
+            movie = Movie.objects.create(title=f'Movie {i}', movie_id=i + 1, runtime=90 + i)
+            movie.genres.add(genres[i % 3])
+            movie.directors.add(Director.objects.get_or_create(name=f'Director {i % 4}')[0])
+            movie.keywords.add(Keyword.objects.get_or_create(name=f'kw{i % 5}')[0])
+            movies.append(movie)
+        for u in range(6):
+            user = User.objects.create_user(username=f'trainer{u}', email=f'trainer{u}@example.com', password='pass')
+            for i, movie in enumerate(movies):
+                Rating.objects.create(user=user, movie=movie, rating=5.0 if (i + u) % 3 == 0 else 2.0)
+        call_command('export_datasets', '--output-dir', self.output.name, stdout=StringIO())
+
+    def train(self, *args):
+        out = StringIO()
+        call_command(
+            'train_recommender', '--movies', os.path.join(self.output.name, 'movies.npz'),
+            '--ratings', os.path.join(self.output.name, 'ratings.npz'),
+            '--output-dir', os.path.join(self.output.name, 'versions'), '--rounds', '5', *args, stdout=out,
+        )
+        return out.getvalue()
+
+    def test_writes_versioned_artifacts_with_manifest(self):
+        self.train()
+        versions = os.listdir(os.path.join(self.output.name, 'versions'))
+        self.assertEqual(len(versions), 1)
+        version_dir = os.path.join(self.output.name, 'versions', versions[0])
+        with open(os.path.join(version_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['params']['xgboost']['tree_method'], 'hist')
+        self.assertEqual(manifest['feature_names'][:3], ['movie_id', 'runtime', 'adult'])
+        self.assertNotIn('user_id', manifest['feature_names'])
+        self.assertIn('user_mean_rating', manifest['feature_names'])
+        self.assertIn('ndcg@10', manifest['metrics'])
+        self.assertEqual(set(manifest['data']), {'movies', 'ratings'})
+        for artifact in manifest['artifacts'].values():
+            self.assertTrue(os.path.exists(os.path.join(version_dir, artifact['file'])))
+
+    def test_unchanged_data_is_not_retrained_and_installs_the_existing_version(self):
+        self.train()
+        installed = Path(self.output.name) / 'installed'
+        installed.mkdir()
+        with mock.patch.object(registry, 'path', side_effect=lambda name: installed / name):
+            out = self.train('--install')
+        self.assertIn('trained on the same data and parameters', out)
+        self.assertEqual(len(os.listdir(os.path.join(self.output.name, 'versions'))), 1)
+        self.assertEqual(sorted(os.listdir(installed)), ['features_w2v', 'tfidf_w2v', 'w2v_director', 'w2v_keyword', 'xgboost_w2v'])
+
+
+# 25 cast members listed out of billing order, with one actor in two roles
+CAST = [{'name': f'Actor {order:02}', 'order': order} for order in reversed(range(24))] + [{'name': 'Actor 03', 'order': 24}]
+
+
+class StubTMDbHandler(BaseHTTPRequestHandler):
+    # Answers /3/movie/<id> like TMDb: 404 for unknown ids and a 429 for the first request for id 2
+    requests = []
+    throttled = False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        tmdb_id = int(url.path.rsplit('/', 1)[1])
+        self.requests.append((tmdb_id, parse_qs(url.query)))
+        if tmdb_id == 404:
+            return self.reply(404, {'status_message': 'not found'})
+        if tmdb_id == 2 and not StubTMDbHandler.throttled:
+            StubTMDbHandler.throttled = True
+            return self.reply(429, {'status_message': 'slow down'}, {'Retry-After': '0'})
+        if self.headers.get('If-None-Match') == f'"v{tmdb_id}"':
+            return self.reply(304, None)
+        self.reply(200, {
+            'id': tmdb_id, 'poster_path': f'/{tmdb_id}.jpg', 'overview': f'Overview {tmdb_id}', 'runtime': 90,
+            'adult': False, 'release_date': '1999-03-31',
+            'credits': {'cast': CAST, 'crew': [{'name': 'Lana Wachowski', 'job': 'Director'}, {'name': 'Don Davis', 'job': 'Music'}]},
+            'keywords': {'keywords': [{'name': 'simulation'}, {'name': 'hacker'}]},
+        }, {'ETag': f'"v{tmdb_id}"'})
+
+    def reply(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TMDbIngestionTests(TestCase):
+    def setUp(self):
+        StubTMDbHandler.requests = []
+        StubTMDbHandler.throttled = False
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubTMDbHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/3'
+        self.movies = [Movie.objects.create(title=f'Movie {tmdb_id}', tmdb_id=tmdb_id) for tmdb_id in (1, 2, 404)]
+        directory = tempfile.mkdtemp()
+        self.log_file = os.path.join(directory, 'failed.txt')
+        cache_settings = override_settings(TMDB_CACHE_PATH=os.path.join(directory, 'tmdb_cache.sqlite3'))
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+        os.environ['TMDB_KEY'] = 'test-key'
+        self.addCleanup(os.environ.pop, 'TMDB_KEY')
+
+    def ingest(self, *args):
+        out = StringIO()
+        call_command('ingest_tmdb', '--base-url', self.base_url, '--log-file', self.log_file, *args, stdout=out)
+        return out.getvalue()
+
+    def test_one_request_per_movie_with_retry(self):
+        out = self.ingest()
+        # One request per movie plus the retried 429, each with credits and keywords appended
+        self.assertEqual(sorted(tmdb_id for tmdb_id, _ in StubTMDbHandler.requests), [1, 2, 2, 404])
+        self.assertTrue(all(query['append_to_response'] == ['credits,keywords'] for _, query in StubTMDbHandler.requests))
+        self.assertIn('2 movies updated', out)
+
+        movie = Movie.objects.get(tmdb_id=2)
+        self.assertEqual(movie.poster_url, 'https://image.tmdb.org/t/p/original/2.jpg')
+        self.assertEqual(movie.release_date, datetime.date(1999, 3, 31))
+        self.assertEqual(list(movie.directors.values_list('name', flat=True)), ['Lana Wachowski'])
+        self.assertEqual(sorted(movie.keywords.values_list('name', flat=True)), ['hacker', 'simulation'])
+        with open(self.log_file) as f:
+            self.assertEqual(f.read(), '404: not found\n')
+
+        # Movies that have everything are not fetched again; the 404 comes from the response cache
+        StubTMDbHandler.requests = []
+        self.assertIn('1 served from cache', self.ingest())
+        self.assertEqual(StubTMDbHandler.requests, [])
+
+    def test_credit_names_keep_billing_order(self):
+        data = {'credits': {
+            'cast': [{'name': 'Carrie-Anne Moss', 'order': 2}, {'name': 'Keanu Reeves', 'order': 0},
+                     {'name': 'Laurence Fishburne', 'order': 1}, {'name': 'Keanu Reeves', 'order': 3}],
+            'crew': [{'name': 'Lana Wachowski', 'job': 'Director'}, {'name': 'Lilly Wachowski', 'job': 'Director'},
+                     {'name': 'Lana Wachowski', 'job': 'Director'}],
+        }}
+        self.assertEqual(credit_names(data), (
+            ['Keanu Reeves', 'Laurence Fishburne', 'Carrie-Anne Moss'], ['Lana Wachowski', 'Lilly Wachowski'],
+        ))
+
+    def test_cast_is_linked_in_billing_order(self):
+        self.ingest()
+        movie = Movie.objects.get(tmdb_id=1)
+        billing = [f'Actor {order:02}' for order in range(24)]
+        links = Movie.actors.through.objects.filter(movie=movie).order_by('id').values_list('actor__name', flat=True)
+        self.assertEqual(list(links), billing)
+        self.assertEqual([actor.name for actor in top_actors(movie.pk)], billing[:MOVIE_DETAIL_ACTORS])
+
+        # A refetch repairs links written in another order
+        Movie.actors.through.objects.filter(movie=movie).delete()
+        movie.actors.add(*Actor.objects.filter(name__in=billing).order_by('-name'))
+        self.ingest('--all', '--only', 'credits')
+        links = Movie.actors.through.objects.filter(movie=movie).order_by('id').values_list('actor__name', flat=True)
+        self.assertEqual(list(links), billing)
+
+    def test_batches_share_names_and_query_count_does_not_grow(self):
+        command = IngestCommand()
+        Actor.objects.create(name='Actor 05')
+
+        def response(tmdb_id, cast):
+            return {'id': tmdb_id, 'credits': {'cast': [{'name': name, 'order': i} for i, name in enumerate(cast)], 'crew': []}}
+
+        with CaptureQueriesContext(connection) as small:
+            rows = command.apply_batch({self.movies[0].pk: response(1, ['Actor 05', 'Actor 06'])}, ('credits',))
+        self.assertEqual(rows, 2)
+
+        names = [f'Actor {i:02}' for i in range(40)]
+        batch = {movie.pk: response(movie.tmdb_id, names[i::2]) for i, movie in enumerate(self.movies[:2])}
+        with CaptureQueriesContext(connection) as large:
+            rows = command.apply_batch(batch, ('credits',))
+        self.assertEqual(rows, 40)
+        self.assertEqual(len(large), len(small))
+        # Names are created once and shared, existing ones reused
+        self.assertEqual(Actor.objects.filter(name__in=names).count(), 40)
+        self.assertEqual(Actor.objects.filter(name='Actor 05').count(), 1)
+        links = Movie.actors.through.objects.filter(movie=self.movies[0]).order_by('id').values_list('actor__name', flat=True)
+        self.assertEqual(list(links), names[0::2])
+
+    def test_query_keywords_only_writes_keywords(self):
+        out = StringIO()
+        call_command('query_keywords', '--base-url', self.base_url, '--log-file', self.log_file, stdout=out)
+        movie = Movie.objects.get(tmdb_id=1)
+        self.assertEqual(movie.keywords.count(), 2)
+        self.assertIsNone(movie.overview)
+        self.assertFalse(movie.actors.exists())
+        self.assertTrue(all(query['append_to_response'] == ['keywords'] for _, query in StubTMDbHandler.requests))
+
+    def test_rerun_is_served_from_cache_and_revalidated(self):
+        self.ingest()
+        StubTMDbHandler.requests = []
+        out = self.ingest('--all')
+        self.assertEqual(StubTMDbHandler.requests, [])
+        self.assertIn('3 served from cache', out)
+
+        # Stale entries are revalidated with their ETag; the 304s keep the stored bodies
+        with override_settings(TMDB_CACHE_TTL=0):
+            out = self.ingest('--all')
+        self.assertEqual(sorted(tmdb_id for tmdb_id, _ in StubTMDbHandler.requests), [1, 2, 404])
+        self.assertIn('2 revalidated', out)
+        self.assertEqual(Movie.objects.get(tmdb_id=1).overview, 'Overview 1')
+
+    def test_offline_ingestion_and_print(self):
+        self.ingest('--only', 'keywords')
+        Movie.keywords.through.objects.all().delete()
+        StubTMDbHandler.requests = []
+        del os.environ['TMDB_KEY']
+        self.addCleanup(os.environ.setdefault, 'TMDB_KEY', 'test-key')
+
+        out = self.ingest('--offline', '--only', 'keywords')
+        self.assertEqual(StubTMDbHandler.requests, [])
+        self.assertEqual(Movie.objects.get(tmdb_id=2).keywords.count(), 2)
+        self.assertIn('2 movies updated', out)
+
+        # Only the cached variant of a request is available offline
+        out = StringIO()
+        call_command('print_tmdb_query', '1', '--append', 'keywords', '--offline', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['id'], 1)
+        with self.assertRaises(CommandError):
+            call_command('print_tmdb_query', '1', '--offline', stdout=StringIO())
+        requests = len(StubTMDbHandler.requests)
+        with self.assertRaisesMessage(CommandError, 'TMDB_KEY'):
+            call_command('print_tmdb_query', '1', stdout=StringIO())
+        self.assertEqual(len(StubTMDbHandler.requests), requests)
+
+    def test_token_bucket_limits_rate(self):
+        async def take(count):
+            bucket = TokenBucket(rate=50, capacity=1)
+            for _ in range(count):
+                await bucket.acquire()
+        start = time.perf_counter()
+        asyncio.run(take(6))
+        self.assertGreaterEqual(time.perf_counter() - start, 0.09)
+
+    def test_retry_after_header(self):
+        class Response:
+            def __init__(self, value):
+                self.headers = {'Retry-After': value} if value else {}
+        self.assertEqual(retry_after(Response('3')), 3.0)
+        self.assertIsNone(retry_after(Response(None)))
+        self.assertEqual(retry_after(Response('Wed, 21 Oct 2015 07:28:00 GMT')), 0.0)
@@ -0,0 +1,366 @@
+import asyncio
+import email.utils
+import hashlib
+import json
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlencode
+
+import httpx
+from django.conf import settings
+
+# Concurrent TMDb client used by the ingestion commands (ingest_tmdb, query_metadata,
+# query_credits, query_keywords).
+#
+# One request per movie fetches its details, credits and keywords together
+# (append_to_response). Requests run on an asyncio event loop in a background
+# thread with at most CONCURRENCY in flight, and every request takes a token from
+# one shared TokenBucket so the whole run stays under TMDb's rate limit. A 429
+# pauses the bucket for everyone for the Retry-After the server asked for;
+# other failures are retried with exponential backoff.
+#
+# fetch_movies() hands the results back to the calling (synchronous) thread
+# through a bounded queue, so the Django ORM is only ever used outside the event
+# loop. Point TMDB_API_URL (or --base-url) at a local stub server to test it.
+#
+# Raw responses are kept in an on-disk ResponseCache (SQLite at TMDB_CACHE_PATH),
+# keyed by endpoint and parameters, with the bodies stored compressed under their
+# SHA-256 so identical responses are stored once. Entries younger than
+# TMDB_CACHE_TTL are served without a request; older ones are revalidated with
+# If-None-Match and a 304 keeps the stored body. In offline mode only the cache is
+# read, so ingestion can be rerun without network access or an API key.
+
+logger = logging.getLogger(__name__)
+
+REQUESTS_PER_SECOND = 40
+CONCURRENCY = 20
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+TIMEOUT = 10.0
+APPEND_TO_RESPONSE = ('credits', 'keywords')
+
+# Responses buffered between the fetching thread and the consumer
+RESULT_BUFFER = 500
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TMDbError(Exception):
+    pass
+
+
+class CachedResponse:
+    def __init__(self, status, content, etag, fetched_at):
+        self.status = status
+        self.content = content
+        self.etag = etag
+        self.fetched_at = fetched_at
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def json(self):
+        # None for a cached 404
+        return json.loads(self.content) if self.content is not None else None
+
+
+class ResponseCache:
+    def __init__(self, path=None, ttl=None):
+        self.path = str(path or settings.TMDB_CACHE_PATH)
+        self.ttl = settings.TMDB_CACHE_TTL if ttl is None else ttl
+        # Only used from one thread at a time (the fetching thread or a command)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                status INTEGER NOT NULL,
+                content_hash TEXT,
+                etag TEXT,
+                fetched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS contents (
+                hash TEXT PRIMARY KEY,
+                body BLOB NOT NULL
+            );
+        ''')
+
+    @staticmethod
+    def key(path, params):
+        # Endpoint and parameters without the API key, e.g. /movie/603?append_to_response=credits,keywords
+        params = sorted((name, value) for name, value in params.items() if name != 'api_key')
+        return f'{path}?{urlencode(params, safe=",")}' if params else path
+
+    def get(self, key):
+        row = self.connection.execute(
+            'SELECT r.status, c.body, r.etag, r.fetched_at FROM responses r '
+            'LEFT JOIN contents c ON c.hash = r.content_hash WHERE r.key = ?', (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        status, body, etag, fetched_at = row
+        return CachedResponse(status, zlib.decompress(body) if body is not None else None, etag, fetched_at)
+
+    def put(self, key, status, content=None, etag=None):
+        content_hash = None
+        with self.connection:
+            self.connection.execute('BEGIN')
+            if content is not None:
+                content_hash = hashlib.sha256(content).hexdigest()
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO contents (hash, body) VALUES (?, ?)', (content_hash, zlib.compress(content)),
+                )
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (key, status, content_hash, etag, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                (key, status, content_hash, etag, time.time()),
+            )
+
+    def touch(self, key):
+        # A 304 revalidated the stored response
+        self.connection.execute('UPDATE responses SET fetched_at = ? WHERE key = ?', (time.time(), key))
+
+    def close(self):
+        self.connection.close()
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        # Hold every request back for `seconds` (a 429's Retry-After)
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    await asyncio.sleep(self.resume_at - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def retry_after(response):
+    # Seconds to wait from a Retry-After header (delta-seconds or an HTTP date), or None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TMDbClient:
+    def __init__(self, api_key, base_url=None, rate=REQUESTS_PER_SECOND, concurrency=CONCURRENCY,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF_BASE, transport=None, cache=None, offline=False, refresh=False):
+        # cache: a ResponseCache or None; offline: only read the cache; refresh: revalidate fresh entries too
+        self.api_key = api_key
+        self.base_url = (base_url or settings.TMDB_API_URL).rstrip('/')
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.transport = transport
+        self.cache = cache
+        self.offline = offline
+        self.refresh = refresh
+        self.requests = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.revalidated = 0
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url, timeout=TIMEOUT, transport=self.transport,
+            limits=httpx.Limits(max_connections=self.concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    def stats(self):
+        return {'requests': self.requests, 'retries': self.retries, 'cache_hits': self.cache_hits, 'revalidated': self.revalidated}
+
+    def backoff_delay(self, attempt):
+        return min(BACKOFF_MAX, self.backoff * 2 ** attempt) * (1 + random.random() / 4)
+
+    async def get(self, path, **params):
+        # JSON body of a GET, None on 404; raises TMDbError once the retries are used up
+        key = ResponseCache.key(path, params)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None and (self.offline or not self.refresh and cached.age < self.cache.ttl):
+            self.cache_hits += 1
+            return cached.json()
+        if self.offline:
+            raise TMDbError(f'{key} is not cached')
+
+        params['api_key'] = self.api_key
+        headers = {'If-None-Match': cached.etag} if cached is not None and cached.etag else {}
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            self.requests += 1
+            try:
+                response = await self.client.get(path, params=params, headers=headers)
+            except httpx.TransportError as e:
+                error = f'{type(e).__name__}: {e}'
+                delay = self.backoff_delay(attempt)
+            else:
+                if response.status_code == 304 and cached is not None:
+                    self.cache.touch(key)
+                    self.revalidated += 1
+                    return cached.json()
+                if response.status_code in (200, 404):
+                    content = response.content if response.status_code == 200 else None
+                    if self.cache is not None:
+                        self.cache.put(key, response.status_code, content, response.headers.get('ETag'))
+                    return json.loads(content) if content is not None else None
+                if response.status_code not in RETRY_STATUSES:
+                    raise TMDbError(f'{path} returned HTTP {response.status_code}')
+                error = f'HTTP {response.status_code}'
+                delay = retry_after(response)
+                if delay is not None and response.status_code == 429:
+                    self.bucket.pause(delay)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+            if attempt < self.max_retries:
+                self.retries += 1
+                logger.debug('Retrying %s in %.2f s after %s', path, delay, error)
+                await asyncio.sleep(delay)
+        raise TMDbError(f'{path} failed after {self.max_retries + 1} attempts ({error})')
+
+    async def get_movie(self, tmdb_id, append=APPEND_TO_RESPONSE):
+        params = {'append_to_response': ','.join(append)} if append else {}
+        return await self.get(f'/movie/{tmdb_id}', **params)
+
+    async def get_movies(self, tmdb_ids, results, append=APPEND_TO_RESPONSE):
+        # Puts (tmdb_id, data, error) on `results` for every id, CONCURRENCY at a time
+        pending = iter(tmdb_ids)
+
+        async def worker():
+            for tmdb_id in pending:
+                try:
+                    data, error = await self.get_movie(tmdb_id, append), None
+                except TMDbError as e:
+                    data, error = None, str(e)
+                await results(tmdb_id, data, error)
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+
+
+_DONE = object()
+
+
+def fetch_movies(tmdb_ids, api_key, append=APPEND_TO_RESPONSE, stats=None, **options):
+    # Iterates over (tmdb_id, data, error) in completion order; data is None for movies
+    # TMDb does not know. Options are passed to TMDbClient; its request and cache
+    # counters are written to the `stats` dict when given
+    results = queue.Queue(maxsize=RESULT_BUFFER)
+    stop = threading.Event()
+    stats = {} if stats is None else stats
+
+    async def put(*result):
+        # Waits while the queue is full so a slow consumer applies backpressure
+        while not stop.is_set():
+            try:
+                results.put_nowait(result)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.05)
+        raise asyncio.CancelledError
+
+    async def produce():
+        async with TMDbClient(api_key, **options) as client:
+            try:
+                await client.get_movies(tmdb_ids, put, append)
+            finally:
+                stats.update(client.stats())
+
+    def run():
+        try:
+            asyncio.run(produce())
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(_DONE)
+
+    thread = threading.Thread(target=run, name='tmdb-fetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def fetch_movie(tmdb_id, api_key, append=APPEND_TO_RESPONSE, **options):
+    # One movie, for scripts; options are passed to TMDbClient
+    async def get():
+        async with TMDbClient(api_key, **options) as client:
+            return await client.get_movie(tmdb_id, append)
+    return asyncio.run(get())
+
+
+def movie_metadata(data):
+    # Movie fields from a /movie/{id} response
+    poster_path = data.get('poster_path')
+    return {
+        'poster_url': f'https://image.tmdb.org/t/p/original{poster_path}' if poster_path else None,
+        'overview': data.get('overview'),
+        'runtime': data.get('runtime'),
+        'adult': data.get('adult', False),
+        'release_date': data.get('release_date') or None,
+    }
+
+
+def credit_names(data):
+    # (actor names, director names) from the appended credits, in billing order and
+    # without repeats (an actor is listed once per role). The movie page treats the
+    # first through rows as the leads, so the links must be written in this order
+    credits = data.get('credits') or {}
+    cast = credits.get('cast', [])
+    cast = sorted(cast, key=lambda person: person.get('order', len(cast)))
+    actors = list(dict.fromkeys(person['name'] for person in cast))
+    directors = list(dict.fromkeys(person['name'] for person in credits.get('crew', []) if person.get('job') == 'Director'))
+    return actors, directors
+
+
+def keyword_names(data):
+    return [keyword['name'] for keyword in (data.get('keywords') or {}).get('keywords', [])]
@@ -29,6 +29,10 @@ from .views import (
     SimilarMoviesView,
     ManageWatchlistView, 
     ViewWatchlist,
+    MovieActorsView,
+    CacheStatsView,
+    MovieSuggestView,
+    RetrieveFriendMovies,
     )
 
 urlpatterns = [
@@ -57,16 +61,19 @@ urlpatterns = [
 
     # Movie Lists
     path('user/movies/', RetrieveMovies.as_view(), name='retrieve_movies'), # Get primary movie recommendation list for user
+    path('user/movies/friends/', RetrieveFriendMovies.as_view(), name='retrieve_friend_movies'), # Get movies the user's friends liked
     path('movies/popular/', MostPopularMoviesView.as_view(), name='most_popular_movies'), # Get most popular movies
     path('movies/watch/', ViewWatchlist.as_view(), name='view_watchlist'), # Get watchlist for signed-in user
 
     # Searching
     path('movie/search/', MovieSearchView.as_view(), name='movie_search'), # Search for movies by title
+    path('movie/suggest/', MovieSuggestView.as_view(), name='movie_suggest'), # Type-ahead title suggestions
     path('user/search/', UserSearchView.as_view(), name='user_search'), # Search for users by username
 
     # Movie Page
     path('movie/<int:pk>/', RetrieveMovieDetail.as_view(), name='retrieve_movie'), # Get movie details
     path('movie/<int:pk>/comments/', MovieCommentsView.as_view(), name='movie_comments'), # Get Movie comments
+    path('movie/<int:pk>/actors/', MovieActorsView.as_view(), name='movie_actors'), # Get a movie's full cast (paginated)
     path('movie/<int:pk>/similar/', SimilarMoviesView.as_view(), name='similar_movies'),  # Get similar movies
     path('movie/<int:pk>/rate/', RateMovieView.as_view(), name='rate_movie'), # Add/Update a movie rating
     path('movie/<int:pk>/comment/', CommentView.as_view(), name='movie_comment'), # Add/Delete comment on a movie
@@ -77,4 +84,7 @@ urlpatterns = [
     path('user/<int:user_id>/friends/', ListUserFriendsView.as_view(), name='list_user_friends'), # Get friends list for another user
     path('user/<int:user_id>/movies/rated/', ListUserRatedMoviesView.as_view(), name='list_user_rated_movies'), # Get already-rated movies list for another user
     path('send-friend-request/<int:to_user_id>/', SendFriendRequestView.as_view(), name='send_friend_request'), # Send friend request
+
+    # Admin
+    path('cache/stats/', CacheStatsView.as_view(), name='cache_stats'), # Response cache hit/miss counters
 ]
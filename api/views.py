@@ -5,14 +5,19 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.http import JsonResponse
 from django.conf import settings
-from .serializers import UserSignUpSerializer, UserProfileSerializer, DisplayMovieSerializer, MovieDetailSerializer, CommentSerializer, RatingSerializer, FriendRequestSerializer, UserNameSerializer, UserInfoSerializer, UpdateProfileSerializer, OtherUserProfileSerializer, UserRatedMoviesSerializer
-from rest_framework.permissions import IsAuthenticated
+from .serializers import UserSignUpSerializer, UserProfileSerializer, DisplayMovieSerializer, MovieDetailSerializer, CommentSerializer, RatingSerializer, FriendRequestSerializer, UserNameSerializer, UserInfoSerializer, UpdateProfileSerializer, OtherUserProfileSerializer, UserRatedMoviesSerializer, CastMemberSerializer, movie_user_fields
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from .models import Movie, Rating, Comment, FriendRequest
-from django.db.models import Q
+from .pagination import StandardResultsSetPagination, PopularMoviesPagination, SearchResultsPagination, UserSearchPagination
+from .search import search_movies, search_users
+from .suggest import suggestions
+from .cache import cached, cache_get, cache_set, build_key, cache_stats, MISSING
+from django.db.models import Q, Count, Exists, OuterRef, Subquery
 from rest_framework.exceptions import NotFound
 from django.contrib.auth import get_user_model
-from .algorithms.xgboost_w2v_opt import recommend_movies
-from django.db.models import Avg
+from .algorithms.recommendations import get_recommendations
+from .algorithms.friends import friend_recommendations
+from .algorithms.similarity import similar_movie_ids
 
 User = get_user_model()
 
@@ -130,86 +135,132 @@ class RetrieveMovies(APIView):
     permission_classes = [IsAuthenticated]
  
     def get(self, request):
-        username = request.user.username
-        recommended_titles = recommend_movies(username, top_n=100)
-        movies = Movie.objects.filter(title__in=recommended_titles)
-        serializer = DisplayMovieSerializer(movies, many=True)
+        # Served from the precomputed UserRecommendation table (see build_recommendations),
+        # whose ranks are already diversified, so the first 20 are shown in order
+        final_selection = 20
+        recommended_ids = get_recommendations(request.user)[:final_selection]
+        movies = Movie.objects.in_bulk(recommended_ids)
+        serializer = DisplayMovieSerializer([movies[pk] for pk in recommended_ids if pk in movies], many=True)
+        return Response(serializer.data)
+
+
+# Retrieves the movies the user's friends (and their friends) liked, best first
+class RetrieveFriendMovies(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        recommended_ids = friend_recommendations(request.user)
+        movies = Movie.objects.in_bulk(recommended_ids)
+        serializer = DisplayMovieSerializer([movies[pk] for pk in recommended_ids if pk in movies], many=True)
         return Response(serializer.data)
 
 
 # Retrieves the popular movies list for the user
+# Ordered by the indexed popularity_score (Bayesian average rating weighted by recency)
+# Optional ?genre= filter (genre name); pages are served from the shared response cache when warm
 class MostPopularMoviesView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = PopularMoviesPagination
 
-    # Currently returns 10 movies
     def get(self, request, format=None):
-        number_of_movies = 30
-        popular_movies = Movie.objects.filter(avg_rating__isnull=False).order_by('-avg_rating')[:number_of_movies]
-        serializer = DisplayMovieSerializer(popular_movies, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
-
-
-# Retrieves the similar movies list for a movie
+        genre = request.query_params.get('genre', '')
+        paginator = self.pagination_class()
+
+        def build():
+            popular_movies = Movie.objects.filter(popularity_score__isnull=False).order_by('-popularity_score', '-id')
+            if genre:
+                popular_movies = popular_movies.filter(genres__name__iexact=genre)
+            page = paginator.paginate_queryset(popular_movies, request, view=self)
+            serializer = DisplayMovieSerializer(page, many=True)
+            # The links depend on the request's host, so only the count and results are cached
+            return {'count': paginator.page.paginator.count, 'results': list(serializer.data)}
+
+        page_size = paginator.get_page_size(request)
+        name = f"popular:{genre.lower()}:{request.query_params.get('page', 1)}:{page_size}"
+        popular_page = cached(name, ['popular', 'catalog'], build)
+        paginator.paginate_count(request, popular_page['count'])
+        return paginator.get_paginated_response(popular_page['results'])
+
+
+# Retrieves the similar movies list for a movie, served from the shared response cache when warm
 class SimilarMoviesView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, pk, format=None):
-        try:
-            movie = Movie.objects.get(pk=pk)
-            similar_movies = movie.similar_movies.all()
-            serializer = DisplayMovieSerializer(similar_movies, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        except Movie.DoesNotExist:
+        def build():
+            if not Movie.objects.filter(pk=pk).exists():
+                return None
+            # Neighbours in rank order (see build_similar_movies); movies added since the
+            # last build are looked up in the similarity index instead
+            similar_ids = list(
+                Movie.similar_movies.through.objects.filter(from_movie_id=pk).order_by('id').values_list('to_movie_id', flat=True)
+            )
+            if not similar_ids:
+                try:
+                    similar_ids = similar_movie_ids(pk)
+                except OSError:
+                    similar_ids = []
+            movies = Movie.objects.in_bulk(similar_ids)
+            return list(DisplayMovieSerializer([movies[i] for i in similar_ids if i in movies], many=True).data)
+
+        similar_movies = cached(f'similar:{pk}', [f'similar:{pk}', 'catalog'], build)
+        if similar_movies is None:
             return Response({'message': 'Movie not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(similar_movies, status=status.HTTP_200_OK)
 
 
-# Retrieves the already-rated movies list for the user
-class ListRatedMoviesView(APIView):
+# Retrieves the already-rated movies list for the user (paginated, most recently rated first)
+class ListRatedMoviesView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    serializer_class = UserRatedMoviesSerializer
+    pagination_class = StandardResultsSetPagination
 
-    def get(self, request):
-        # Find all ratings made by the user
-        user_ratings = Rating.objects.filter(user=request.user).values_list('movie', flat=True)
-        
-        # Retrieve the corresponding movies
-        rated_movies = Movie.objects.filter(id__in=user_ratings)
-        
-        # Serialize the movies
-        serializer = UserRatedMoviesSerializer(rated_movies, many=True, context={'user': request.user})
-        return Response(serializer.data)
+    def get_queryset(self):
+        # Each rating row carries its movie, so the whole page is a single query
+        return Rating.objects.filter(user=self.request.user).select_related('movie').order_by('-timestamp', '-id')
 
 
-# List all rated movies for another user
-class ListUserRatedMoviesView(APIView):
+# List all rated movies for another user (paginated, most recently rated first)
+class ListUserRatedMoviesView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    serializer_class = UserRatedMoviesSerializer
+    pagination_class = StandardResultsSetPagination
 
     def get(self, request, user_id):
-        try:
-            target_user = User.objects.get(pk=user_id)
-        except User.DoesNotExist:
+        if not User.objects.filter(pk=user_id).exists():
             return Response({'message': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return self.list(request)
 
-        user_ratings = Rating.objects.filter(user=target_user).values_list('movie', flat=True)
-        rated_movies = Movie.objects.filter(id__in=user_ratings)
-        
-        # Pass the target user to the serializer's context
-        serializer = UserRatedMoviesSerializer(rated_movies, many=True, context={'user': target_user})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    def get_queryset(self):
+        return Rating.objects.filter(user_id=self.kwargs['user_id']).select_related('movie').order_by('-timestamp', '-id')
 
 
 # Returns a search query list of movies by title (/api/movie/search?title=avengers)
+# Full-text search over title, keywords and overview, best match first (see api/search.py)
 class MovieSearchView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = SearchResultsPagination
 
     def get(self, request):
         search_query = request.query_params.get('title', '')
         if not search_query:
             return Response({'message': 'No search query provided.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        found_movies = Movie.objects.filter(title__icontains=search_query)
+        paginator = self.pagination_class()
+        found_movies = paginator.paginate_queryset(search_movies(search_query), request, view=self)
         serializer = DisplayMovieSerializer(found_movies, many=True)
-        print(f"Found movies: {serializer.data}")
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
+
+
+# Type-ahead title suggestions from the in-process title index (see api/suggest.py)
+class MovieSuggestView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        search_query = request.query_params.get('q', '')
+        if not search_query:
+            return Response({'message': 'No search query provided.'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(suggestions.suggest(search_query))
 
 
 # Returns a list of movies in the user's watchlist
@@ -225,18 +276,69 @@ class ViewWatchlist(APIView):
 
 ### MOVIE VIEWS ###
 
+# Number of cast members included on the movie page (the full cast is paginated by MovieActorsView)
+MOVIE_DETAIL_ACTORS = 20
+
+
+# Movie page queryset: per-user rating and watchlist state are annotated onto the movie row
+# With shared=False only the per-user state is selected (the rest comes from the cache)
+def movie_detail_queryset(user, shared=True):
+    if shared:
+        queryset = Movie.objects.prefetch_related('genres', 'directors').annotate(
+            actor_count=Subquery(
+                Movie.actors.through.objects.filter(movie_id=OuterRef('pk'))
+                .order_by().values('movie_id').annotate(count=Count('id')).values('count')
+            ),
+        )
+    else:
+        queryset = Movie.objects.only('id')
+    if user.is_authenticated:
+        queryset = queryset.annotate(
+            user_rating=Subquery(Rating.objects.filter(user=user, movie=OuterRef('pk')).values('rating')[:1]),
+            on_watchlist=Exists(User.watchlist.through.objects.filter(genericuser_id=user.id, movie_id=OuterRef('pk'))),
+        )
+    return queryset
+
+
+# First cast members of a movie in credits order (TMDb lists the leads first)
+def top_actors(movie_id, limit=MOVIE_DETAIL_ACTORS):
+    credits = Movie.actors.through.objects.filter(movie_id=movie_id).select_related('actor').order_by('id')[:limit]
+    return [credit.actor for credit in credits]
+
 # Retrieve all movie details for displaying a single movie
 class RetrieveMovieDetail(APIView):
     def get(self, request, pk, format=None):
-        movie = Movie.objects.filter(pk=pk).first()
+        # The shared part of the page is cached; on a hit only the user's rating and
+        # watchlist state are queried
+        key = build_key(f'movie:{pk}', [f'movie:{pk}'])
+        movie_data = cache_get(key)
+        if movie_data is not MISSING:
+            user_state = None
+            if request.user.is_authenticated:
+                user_state = movie_detail_queryset(request.user, shared=False).filter(pk=pk).first()
+            return Response({**movie_data, **movie_user_fields(user_state)})
+
+        # One annotated query for the movie and the user's rating/watchlist state,
+        # plus one query each for genres, directors and the capped cast list
+        movie = movie_detail_queryset(request.user).filter(pk=pk).first()
         if movie is not None:
-            serializer = MovieDetailSerializer(movie, context={'request': request})
-            print(f"Movie details: {serializer.data}")
-            return Response(serializer.data)
+            movie.top_actors = top_actors(movie.pk)
+            movie_data = dict(MovieDetailSerializer(movie).data)
+            cache_set(key, movie_data)
+            return Response({**movie_data, **movie_user_fields(movie)})
         else:
             return Response({'message': 'Movie not found'}, status=status.HTTP_404_NOT_FOUND)
 
 
+# Retrieve the full cast of a movie, paginated in credits order
+class MovieActorsView(generics.ListAPIView):
+    serializer_class = CastMemberSerializer
+    pagination_class = StandardResultsSetPagination
+
+    def get_queryset(self):
+        return Movie.actors.through.objects.filter(movie_id=self.kwargs['pk']).select_related('actor').order_by('id')
+
+
 # Retrieve all comments for a given movie
 class MovieCommentsView(APIView):
     def get(self, request, pk, format=None):
@@ -304,15 +406,11 @@ class RateMovieView(APIView):
         )
         
         # If the rating instance was found and not created, update it
+        # The movie's rating totals and avg_rating are updated by the Rating signals
         if not created:
             rating_instance.rating = rating_value
             rating_instance.save()
 
-        # Recalculate the average rating for the movie
-        new_avg_rating = movie.movie_ratings.aggregate(Avg('rating'))['rating__avg']
-        movie.avg_rating = new_avg_rating
-        movie.save()
-
         # Serialize the rating instance
         serializer = RatingSerializer(rating_instance, context={'request': request})
         return Response({'message': 'Rating submitted successfully', 'data': serializer.data}, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
@@ -344,19 +442,20 @@ class ManageWatchlistView(APIView):
 ### FRIEND VIEWS ###
 
 # Search for users by username (/api/user/search?username=johndoe)
+# Friends first, then usernames starting with the query; private users only appear to their friends
 class UserSearchView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = UserSearchPagination
 
     def get(self, request):
-        search_query = request.query_params.get('username', '')
+        search_query = request.query_params.get('username', '').strip()
         if not search_query:
             return Response({'message': 'No search query provided.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Find users whose username contains the search_query
-        found_users = User.objects.filter(username__icontains=search_query)
+        paginator = self.pagination_class()
+        found_users = paginator.paginate_queryset(search_users(search_query, request.user), request, view=self)
         serializer = UserInfoSerializer(found_users, many=True)
-        print(f"Found users: {serializer.data}")
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
 
 # Retrieve another user's profile
@@ -424,23 +523,8 @@ class ListFriendsView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        user = request.user
-
-        # Get all users who sent a friend request to the user and was accepted
-        friends_from_requests = User.objects.filter(
-            received_requests__from_user=user,
-            received_requests__accepted=True
-        )
-
-        # Get all users to whom the user sent a friend request and was accepted
-        friends_to_requests = User.objects.filter(
-            sent_requests__to_user=user,
-            sent_requests__accepted=True
-        )
-
-        # Combine and deduplicate the two lists
-        friends = (friends_from_requests | friends_to_requests).distinct()
-
+        # One indexed lookup on the Friendship edge table
+        friends = User.objects.filter(friend_of__user=request.user).order_by('friend_of__id')
         serializer = UserInfoSerializer(friends, many=True)
         return Response(serializer.data)
 
@@ -450,25 +534,10 @@ class ListUserFriendsView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, user_id):
-        try:
-            target_user = User.objects.get(pk=user_id)
-        except User.DoesNotExist:
+        if not User.objects.filter(pk=user_id).exists():
             return Response({'message': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-        # Get all users who have accepted a friend request from or to the target user
-        friends_from_requests = User.objects.filter(
-            received_requests__from_user=target_user,
-            received_requests__accepted=True
-        )
-
-        friends_to_requests = User.objects.filter(
-            sent_requests__to_user=target_user,
-            sent_requests__accepted=True
-        )
-
-        # Combine and deduplicate the two lists
-        friends = (friends_from_requests | friends_to_requests).distinct()
-
+        friends = User.objects.filter(friend_of__user_id=user_id).order_by('friend_of__id')
         serializer = UserInfoSerializer(friends, many=True)
         return Response(serializer.data)
 
@@ -530,3 +599,13 @@ class ListOutgoingFriendRequestsView(APIView):
         serializer = FriendRequestSerializer(outgoing_requests, many=True)
         return Response(serializer.data)
 
+
+
+### ADMIN VIEWS ###
+
+# Hit/miss counters of the shared response cache
+class CacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(cache_stats())
@@ -180,3 +180,20 @@ CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',  
 ]
+
+# Cache used for shared responses (see api/cache.py)
+# Defaults to a per-worker local memory cache. Set CACHE_URL to share it between workers,
+# e.g. filecache:///var/tmp/mcbackend_cache or rediscache://redis:6379/1 (needs the redis package)
+CACHES = {
+    'default': environ.Env().cache_url('CACHE_URL', default='locmemcache://'),
+}
+
+# Recommender artifacts (see api/algorithms/registry.py)
+# Set RECOMMENDER_PRELOAD=True to load every model when a gunicorn worker starts
+RECOMMENDER_PRELOAD = os.getenv('RECOMMENDER_PRELOAD', 'False').lower() in ('1', 'true', 'yes')
+
+# TMDb API used by the ingestion commands (see api/tmdb.py); point it at a stub server for testing
+TMDB_API_URL = os.getenv('TMDB_API_URL', 'https://api.themoviedb.org/3')
+# On-disk cache of raw TMDb responses; entries older than TMDB_CACHE_TTL seconds are revalidated
+TMDB_CACHE_PATH = os.getenv('TMDB_CACHE_PATH', str(BASE_DIR / 'data' / 'tmdb_cache.sqlite3'))
+TMDB_CACHE_TTL = int(os.getenv('TMDB_CACHE_TTL', 30 * 24 * 60 * 60))
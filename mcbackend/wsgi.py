@@ -14,3 +14,19 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mcbackend.settings')
 
 application = get_wsgi_application()
+
+# Build the in-memory title suggestion index when the worker starts (see api/suggest.py)
+try:
+    from api.suggest import suggestions
+    suggestions.get_index()
+except Exception:
+    import logging
+    logging.getLogger(__name__).exception('Could not build the title suggestion index at startup')
+
+# Load the recommender artifacts when the worker starts instead of on the first request
+# (only here, so management commands such as migrate or shell never load them)
+from django.conf import settings
+
+if settings.RECOMMENDER_PRELOAD:
+    from api.algorithms.registry import registry
+    registry.preload()